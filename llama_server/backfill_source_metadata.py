@@ -0,0 +1,89 @@
+"""
+One-off backfill of the source and pdf_filename metadata for vectors stored before
+ingestion recorded them.
+
+Walks the index by ID page, fetches each page's metadata, infers the source from
+the document header (see utils/source_metadata.py) and writes the fields back by
+upserting the vectors with their existing values. Vectors that already have a
+source, or whose source cannot be inferred, are left alone. Chunks of a split
+document inherit the source found on the document's first chunk. Vectors left
+without a source (JSON profiles have no header) are still found by deleting their
+source, through the text match in utils/source_metadata.py.
+
+Usage:
+    python backfill_source_metadata.py [--user USERNAME] [--dry-run]
+"""
+import argparse
+from collections import Counter
+
+from utils.source_metadata import infer_source_metadata
+
+def backfill(store, prefixes, dry_run=False, page_size=100):
+    """Backfill every vector whose ID starts with one of prefixes. Returns counters."""
+    counts = Counter()
+    parent_sources = {}
+    pending_chunks = []
+
+    def write(records):
+        if records and not dry_run:
+            store.upsert(records)
+
+    for prefix in prefixes:
+        for ids in store.iter_ids(prefix, page_size=page_size):
+            updates = []
+            for vector_id, vector in store.fetch(ids).items():
+                metadata = vector["metadata"]
+                counts["scanned"] += 1
+                if metadata.get("source"):
+                    counts["already_set"] += 1
+                    parent_sources[vector_id] = {k: metadata[k] for k in ("source", "pdf_filename") if k in metadata}
+                    continue
+
+                if metadata.get("parent_id", vector_id) != vector_id:
+                    # The header is on the first chunk, which may not have been seen yet
+                    pending_chunks.append(vector_id)
+                    continue
+                fields = infer_source_metadata(metadata.get("text", ""))
+                if not fields:
+                    counts["unknown"] += 1
+                    continue
+
+                parent_sources[vector_id] = fields
+                updates.append((vector_id, vector["values"], dict(metadata, **fields)))
+                counts[fields["source"]] += 1
+            write(updates)
+            counts["updated"] += len(updates)
+
+    for start in range(0, len(pending_chunks), page_size):
+        updates = []
+        for vector_id, vector in store.fetch(pending_chunks[start:start + page_size]).items():
+            fields = parent_sources.get(vector["metadata"]["parent_id"])
+            if fields:
+                updates.append((vector_id, vector["values"], dict(vector["metadata"], **fields)))
+            else:
+                counts["unknown"] += 1
+        write(updates)
+        counts["updated"] += len(updates)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill source metadata on stored vectors.")
+    parser.add_argument("--user", help="Only backfill this user's vectors")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+    args = parser.parse_args()
+
+    # Imported here so backfill() can be used without the server's configuration
+    from llama_service import get_vector_store, user_id_prefixes
+
+    prefixes = user_id_prefixes(args.user) if args.user else [""]
+    counts = backfill(get_vector_store(), prefixes, dry_run=args.dry_run)
+
+    print(f"Scanned {counts['scanned']} vectors: {counts['updated']} "
+          f"{'would be ' if args.dry_run else ''}updated, {counts['already_set']} already had a source, "
+          f"{counts['unknown']} without a recognizable source")
+    for source, count in sorted(counts.items()):
+        if source not in ("scanned", "updated", "already_set", "unknown"):
+            print(f"  {source}: {count}")
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,39 @@
-from flask import Flask, request, jsonify, session
-from pinecone import Pinecone, ServerlessSpec
+from flask import Flask, Response, request, jsonify, stream_with_context
 import os
-from sentence_transformers import SentenceTransformer
+import json
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
-from langchain.retrievers import ContextualCompressionRetriever
-from langchain.retrievers.document_compressors import LLMChainExtractor
-from langchain_community.vectorstores import Pinecone as LangchainPinecone
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_core.documents import Document
-from langchain.chains.query_constructor.base import AttributeInfo
-from langchain.retrievers.self_query.base import SelfQueryRetriever
 from langchain_core.prompts import PromptTemplate
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.llms import HuggingFaceHub
-from huggingface_hub import InferenceClient
 import uuid  # Import uuid to generate unique IDs
 import secrets
+import hashlib
 import re
+import threading
+import atexit
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from waitress import serve
-import google.generativeai as genai  # Import Google's Gemini API
 from dotenv import load_dotenv
 import numpy as np
-from utils.gemini_key_manager import with_key_rotation  # Import our key rotation decorator
+from utils.gemini_key_manager import with_key_rotation, get_key_manager, is_rate_limit_error  # Import our key rotation decorator
+from utils.gemini_client import gemini_model
+from utils.embedding_cache import get_embedding_cache
+from utils.query_analyzer import LocalQueryAnalyzer
+from utils.memory_retrieval import detect_query_categories, memory_candidate_query, select_memories
+from utils.memory_analysis_jobs import MemoryAnalysisJobs
+from utils.single_flight import SingleFlight
+from utils.response_cache import ResponseCache
+from utils.corpus_versions import SqliteCorpusVersions
+from utils.semantic_cache import SemanticAnswerCache
+from utils.vector_store import LocalVectorStore, PineconeVectorStore
+from utils.vector_hot_tier import HotTierVectorStore
+from utils.vector_manifest import ManifestVectorStore, SqliteVectorManifest
+from utils.vector_write_behind import WriteBehindVectorStore
+from utils.source_metadata import source_deletion_pages, source_metadata
+from utils.ingestion_jobs import IngestionJobs, IngestionQueueFull
 import datetime
 import time
+from functools import wraps
 
 load_dotenv()
 
@@ -37,30 +45,185 @@ app.secret_key = secrets.token_hex(32)
 def health():
     return jsonify({"status": "ok"}), 200
 
-# Initialize Pinecone
-pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY'))
+# Internal counters for caches and other performance-related components
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({
+        "embedding_cache": get_embedding_cache().stats(),
+        "query_analyzer": local_query_analyzer.stats(),
+        "memory_analysis": memory_analysis_jobs.stats(),
+        "gemini_keys": get_key_manager().stats(),
+        "ask_embed_coalescing": ask_embed_flight.stats(),
+        "embed_response_cache": embed_response_cache.stats(),
+        "semantic_answer_cache": semantic_answer_cache.stats(),
+        "vector_hot_tier": _vector_hot_tier.stats() if _vector_hot_tier else None,
+        "vector_manifest": _vector_manifest_store.stats() if _vector_manifest_store else None,
+        "vector_write_behind": _vector_write_behind.stats() if _vector_write_behind else None,
+        "ingestion_jobs": ingestion_jobs.stats()
+    }), 200
 
 index_name = "user-embeddings"
 user_id = "1234(test)"
-
-
-# Create index if it doesn't exist
-if index_name not in pc.list_indexes().names():
-    pc.create_index(index_name, dimension=768, metric="cosine", spec=ServerlessSpec(
-        cloud='aws',
-        region='us-east-1'
-    ))
-
-# Connect to Pinecone index
-index = pc.Index(index_name)
-
-# Initialize embedding model
-embedding_model = SentenceTransformer("sentence-transformers/all-mpnet-base-v2")
-langchain_embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
-
-# Initialize Gemini API
-# We no longer need to explicitly configure here as the key manager handles this
-genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
+EMBEDDING_DIMENSION = 768
+
+# Vector storage backend: "pinecone", or "local" for the in-process store kept
+# under LOCAL_VECTOR_STORE_PATH (small deployments, offline tests and benchmarks)
+VECTOR_STORE = os.getenv('VECTOR_STORE', 'pinecone').lower()
+LOCAL_VECTOR_STORE_PATH = os.getenv('LOCAL_VECTOR_STORE_PATH', 'vector_store')
+
+# Active users' vectors are kept in process in front of Pinecone, so their queries
+# are answered locally instead of over the network
+VECTOR_HOT_TIER = os.getenv('VECTOR_HOT_TIER', 'true').lower() == 'true'
+VECTOR_HOT_TIER_MAX_MB = int(os.getenv('VECTOR_HOT_TIER_MAX_MB', 256))
+VECTOR_HOT_TIER_TTL_SECONDS = int(os.getenv('VECTOR_HOT_TIER_TTL_SECONDS', 300))
+VECTOR_HOT_TIER_MAX_USER_VECTORS = int(os.getenv('VECTOR_HOT_TIER_MAX_USER_VECTORS', 1000))
+
+# Every user's vector IDs (with platform, source and type) are tracked in a local
+# manifest, so cleanup and deletion never list vectors through Pinecone queries
+VECTOR_MANIFEST = os.getenv('VECTOR_MANIFEST', 'true').lower() == 'true'
+VECTOR_MANIFEST_PATH = os.getenv('VECTOR_MANIFEST_PATH', 'vector_manifest.db')
+
+# Upserts to Pinecone are buffered for up to VECTOR_WRITE_BEHIND_MAX_DELAY_MS and sent
+# in bulk, so concurrent single-document writes share round trips
+VECTOR_WRITE_BEHIND = os.getenv('VECTOR_WRITE_BEHIND', 'true').lower() == 'true'
+VECTOR_WRITE_BEHIND_MAX_BATCH = int(os.getenv('VECTOR_WRITE_BEHIND_MAX_BATCH', 100))
+VECTOR_WRITE_BEHIND_MAX_DELAY_MS = int(os.getenv('VECTOR_WRITE_BEHIND_MAX_DELAY_MS', 50))
+VECTOR_WRITE_BEHIND_MAX_PENDING = int(os.getenv('VECTOR_WRITE_BEHIND_MAX_PENDING', 2000))
+VECTOR_WRITE_BEHIND_MAX_RETRIES = int(os.getenv('VECTOR_WRITE_BEHIND_MAX_RETRIES', 5))
+
+# Heavy resources (the embedding model, the vector store connection and the text
+# splitter) are created on first use or by the warmup thread, never at import time
+_resource_lock = threading.Lock()
+_index = None
+_vector_store = None
+_vector_hot_tier = None
+_vector_manifest_store = None
+_vector_write_behind = None
+_embedding_model = None
+_text_splitter = None
+_readiness = {"ready": False, "error": None, "warmup_ms": None}
+
+def get_index():
+    """Connect to the Pinecone index, creating it if it doesn't exist."""
+    global _index
+    if _index is None:
+        with _resource_lock:
+            if _index is None:
+                from pinecone import Pinecone, ServerlessSpec
+
+                pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY'))
+
+                # Create index if it doesn't exist
+                if index_name not in pc.list_indexes().names():
+                    pc.create_index(index_name, dimension=EMBEDDING_DIMENSION, metric="cosine", spec=ServerlessSpec(
+                        cloud='aws',
+                        region='us-east-1'
+                    ))
+
+                _index = pc.Index(index_name)
+    return _index
+
+def user_id_prefixes(user_id):
+    """The ID prefixes of a user's vectors: plain and smart documents, and memories."""
+    prefixes = [f"doc_{user_id}_", re.sub(r'[^a-zA-Z0-9_-]', '_', f"doc_{user_id}_"), f"memory_{user_id}_"]
+    return list(dict.fromkeys(prefixes))
+
+def get_vector_store():
+    """The VectorStore every read and write goes through, chosen by VECTOR_STORE."""
+    global _vector_store, _vector_hot_tier, _vector_manifest_store, _vector_write_behind
+    if _vector_store is None:
+        if VECTOR_STORE == 'local':
+            with _resource_lock:
+                if _vector_store is None:
+                    _vector_store = LocalVectorStore(LOCAL_VECTOR_STORE_PATH or None, dimension=EMBEDDING_DIMENSION)
+        else:
+            index = get_index()
+            with _resource_lock:
+                if _vector_store is None:
+                    store = PineconeVectorStore(index, dimension=EMBEDDING_DIMENSION)
+                    if VECTOR_WRITE_BEHIND:
+                        store = _vector_write_behind = WriteBehindVectorStore(
+                            store,
+                            max_batch=VECTOR_WRITE_BEHIND_MAX_BATCH,
+                            max_batch_bytes=UPSERT_MAX_BYTES,
+                            max_delay=VECTOR_WRITE_BEHIND_MAX_DELAY_MS / 1000,
+                            max_pending=VECTOR_WRITE_BEHIND_MAX_PENDING,
+                            max_retries=VECTOR_WRITE_BEHIND_MAX_RETRIES
+                        )
+                        # Buffered writes are flushed when the process exits
+                        atexit.register(_vector_write_behind.close)
+                    if VECTOR_HOT_TIER:
+                        store = _vector_hot_tier = HotTierVectorStore(
+                            store,
+                            dimension=EMBEDDING_DIMENSION,
+                            max_bytes=VECTOR_HOT_TIER_MAX_MB * 1024 * 1024,
+                            ttl_seconds=VECTOR_HOT_TIER_TTL_SECONDS,
+                            max_user_vectors=VECTOR_HOT_TIER_MAX_USER_VECTORS,
+                            # Writes handled by other workers bump the shared version
+                            corpus_version=embed_response_cache.version
+                        )
+                    if VECTOR_MANIFEST:
+                        store = _vector_manifest_store = ManifestVectorStore(
+                            store,
+                            SqliteVectorManifest(VECTOR_MANIFEST_PATH or ":memory:"),
+                            user_id_prefixes
+                        )
+                    _vector_store = store
+    return _vector_store
+
+def flush_vector_writes(document_ids):
+    """
+    Wait until the buffered upserts of these documents (and their chunks) are stored,
+    raising if any of them was not written. Write paths call this before reporting
+    success, so a client is never told a document is stored while it is only buffered.
+    """
+    if _vector_write_behind is None or not document_ids:
+        return
+    wanted = set(document_ids)
+    _vector_write_behind.flush(
+        matches=lambda vector_id: vector_id in wanted or vector_id.rpartition("_chunk_")[0] in wanted
+    )
+
+def get_embedding_model():
+    """Load the single shared SentenceTransformer instance."""
+    global _embedding_model
+    if _embedding_model is None:
+        with _resource_lock:
+            if _embedding_model is None:
+                # Importing sentence_transformers pulls in torch, so it is deferred too
+                from sentence_transformers import SentenceTransformer
+                _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    return _embedding_model
+
+def warmup():
+    """Load the model, open the vector store and run a dummy encode, then mark the service ready."""
+    start_time = time.time()
+    try:
+        get_embedding_model().encode(["warmup"])
+        get_text_splitter()
+        get_vector_store().describe()
+        get_key_manager()
+        _readiness["warmup_ms"] = int((time.time() - start_time) * 1000)
+        _readiness["ready"] = True
+        _readiness["error"] = None
+        print(f"Warmup completed in {_readiness['warmup_ms']} ms")
+    except Exception as e:
+        _readiness["error"] = str(e)
+        print(f"Warmup failed: {e}")
+
+def start_warmup():
+    """Run warmup in the background so the server can bind its port immediately."""
+    thread = threading.Thread(target=warmup, name="warmup", daemon=True)
+    thread.start()
+    return thread
+
+# Readiness probe: only reports ready once the model and vector store are hot
+@app.route('/ready', methods=['GET'])
+def ready():
+    if _readiness["ready"]:
+        return jsonify({"status": "ready", "warmup_ms": _readiness["warmup_ms"]}), 200
+    return jsonify({"status": "warming_up", "error": _readiness["error"]}), 503
 
 # Structured prompt template
 prompt_template = ChatPromptTemplate.from_template(
@@ -126,7 +289,7 @@ def analyze_query(query_text, conversation_history=""):
             query=query_text,
             history=conversation_history
         )
-        model = genai.GenerativeModel("gemini-2.0-flash")
+        model = gemini_model()
         response = model.generate_content([prompt])
         
         response_text = response.text.strip()
@@ -142,22 +305,384 @@ def analyze_query(query_text, conversation_history=""):
         
         return expanded_query, doc_count
     except Exception as e:
+        # Rate limits go to with_key_rotation, which cools the key down and retries
+        if is_rate_limit_error(e):
+            raise
         print(f"Error in query analysis: {e}")
         return query_text, 3  # Default values on error
 
+# Local tier in front of analyze_query: short, self-contained queries are analyzed
+# without a Gemini call, falling back to the LLM only when the analyzer is unsure
+LOCAL_QUERY_ANALYZER = os.getenv('LOCAL_QUERY_ANALYZER', 'true').lower() == 'true'
+local_query_analyzer = LocalQueryAnalyzer(embed=lambda texts: embed_texts(texts))
+
+def analyze_query_tiered(query_text, conversation_history=""):
+    """Analyze the query locally when possible, otherwise with analyze_query."""
+    if LOCAL_QUERY_ANALYZER:
+        try:
+            local_result = local_query_analyzer.analyze(query_text, conversation_history)
+            if local_result:
+                print("Query analyzed locally, skipping the Gemini analysis call")
+                return local_result
+        except Exception as e:
+            print(f"Error in local query analysis: {e}")
+    try:
+        return analyze_query(query_text, conversation_history)
+    except Exception as e:
+        # Every key stayed rate limited; answer with the unexpanded query
+        print(f"Query analysis gave up after key rotation: {e}")
+        return query_text, 3
+
 # Function to calculate cosine similarity between two vectors
 def cosine_similarity(vec1, vec2):
     """Calculate cosine similarity between two vectors"""
-    dot_product = sum(a * b for a, b in zip(vec1, vec2))
-    norm1 = sum(a * a for a in vec1) ** 0.5
-    norm2 = sum(b * b for b in vec2) ** 0.5
+    vec1 = np.asarray(vec1, dtype=np.float32)
+    vec2 = np.asarray(vec2, dtype=np.float32)
+    norm_product = np.linalg.norm(vec1) * np.linalg.norm(vec2)
     
-    if norm1 == 0 or norm2 == 0:
+    if norm_product == 0:
         return 0
     
-    return dot_product / (norm1 * norm2)
+    return float(np.dot(vec1, vec2) / norm_product)
+
+def embed_query(expanded_query, original_query):
+    """
+    Embed the expanded and original query in one batched call and fuse them into a
+    normalized hybrid vector (70% expanded, 30% original). Returns a float32 array.
+    """
+    expanded_vector, original_vector = embed_texts([expanded_query, original_query])
+    hybrid_vector = 0.7 * expanded_vector + 0.3 * original_vector
+    
+    # Normalize the hybrid vector
+    norm = np.linalg.norm(hybrid_vector)
+    if norm > 0:
+        hybrid_vector = hybrid_vector / norm
+    return hybrid_vector
+
+# Retrieval queries are independent, so they are dispatched on a bounded shared
+# executor and awaited together; latency becomes that of the slowest query
+RETRIEVAL_WORKERS = int(os.getenv('RETRIEVAL_WORKERS', 16))
+RETRIEVAL_QUERY_TIMEOUT = float(os.getenv('RETRIEVAL_QUERY_TIMEOUT', 5))
+retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+
+def dispatch_queries(specs):
+    """
+    Submit (label, query kwargs) vector store queries to the shared executor without
+    waiting. Returns the futures and the deadline to collect them by.
+    """
+    store = get_vector_store()
+    futures = [retrieval_executor.submit(store.query, **kwargs) for _, kwargs in specs]
+    return futures, time.monotonic() + RETRIEVAL_QUERY_TIMEOUT
+
+def collect_query_results(specs, futures, deadline):
+    """
+    Wait for dispatched queries and return their results in order; queries that
+    fail or miss the deadline yield None instead of failing the whole retrieval.
+    """
+    results = []
+    for (label, _), future in zip(specs, futures):
+        try:
+            results.append(future.result(timeout=max(0, deadline - time.monotonic())))
+        except FuturesTimeoutError:
+            future.cancel()
+            print(f"[RETRIEVAL] Query {label} timed out after {RETRIEVAL_QUERY_TIMEOUT}s")
+            results.append(None)
+        except Exception as e:
+            print(f"[RETRIEVAL] Error running query {label}: {e}")
+            results.append(None)
+    return results
+
+def run_queries_concurrently(specs):
+    """Run (label, query kwargs) vector store queries concurrently on the shared executor."""
+    futures, deadline = dispatch_queries(specs)
+    return collect_query_results(specs, futures, deadline)
+
+# Batch sizes for bulk ingestion. Pinecone caps a single upsert request at roughly
+# 2MB, and every vector carries its full text as metadata, so batches are bounded
+# by both vector count and payload size.
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 32))
+UPSERT_BATCH_SIZE = int(os.getenv('UPSERT_BATCH_SIZE', 100))
+UPSERT_MAX_BYTES = int(os.getenv('UPSERT_MAX_BYTES', 1_500_000))
+
+# all-mpnet-base-v2 silently truncates input past 384 word pieces, so long documents
+# are split into token-bounded chunks before embedding
+CHUNK_TOKENS = int(os.getenv('CHUNK_TOKENS', 256))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS', 32))
+
+def get_text_splitter():
+    """Build the tokenizer-bounded text splitter on first use."""
+    global _text_splitter
+    if _text_splitter is None:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+        _text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            get_embedding_model().tokenizer,
+            chunk_size=CHUNK_TOKENS,
+            chunk_overlap=CHUNK_OVERLAP_TOKENS
+        )
+    return _text_splitter
+
+def chunk_document(document_id, document_text, metadata):
+    """
+    Split a document into token-bounded chunks.
+
+    The first chunk keeps the document's own ID so existing IDs stay valid; the rest
+    are stored as "<document_id>_chunk_<n>". Every chunk of a split document records
+    its parent_id, chunk_index and chunk_count so it can be deleted with its parent.
+    Returns a list of (chunk_id, chunk_text, chunk_metadata) tuples.
+    """
+    # A word piece is never shorter than one character, so short texts always fit
+    if len(document_text) <= CHUNK_TOKENS:
+        return [(document_id, document_text, metadata)]
+
+    chunks = get_text_splitter().split_text(document_text)
+    if len(chunks) <= 1:
+        return [(document_id, document_text, metadata)]
+
+    chunked = []
+    for chunk_index, chunk_text in enumerate(chunks):
+        chunk_id = document_id if chunk_index == 0 else f"{document_id}_chunk_{chunk_index}"
+        chunk_metadata = dict(metadata)
+        chunk_metadata.update({
+            "text": chunk_text,
+            "parent_id": document_id,
+            "chunk_index": chunk_index,
+            "chunk_count": len(chunks)
+        })
+        chunked.append((chunk_id, chunk_text, chunk_metadata))
+    return chunked
+
+def embed_texts(texts):
+    """Embed texts through the shared embedding cache; misses are encoded in one batch."""
+    return get_embedding_cache().encode(
+        texts, get_embedding_model(), EMBEDDING_MODEL_NAME, batch_size=EMBEDDING_BATCH_SIZE
+    )
+
+def embed_text(text):
+    """Embed a single text through the shared embedding cache."""
+    return embed_texts([text])[0]
+
+def encode_documents(texts):
+    """Encode a list of texts in a single batched forward pass, returning lists of floats."""
+    if not texts:
+        return []
+    return [vector.tolist() for vector in embed_texts(texts)]
+
+# Deletes are sent in batches of DELETE_BATCH_SIZE IDs, several at a time
+DELETE_BATCH_SIZE = int(os.getenv('DELETE_BATCH_SIZE', 100))
+DELETE_WORKERS = int(os.getenv('DELETE_WORKERS', 8))
+delete_executor = ThreadPoolExecutor(max_workers=DELETE_WORKERS, thread_name_prefix="delete")
+
+def delete_vectors(vector_ids):
+    """Delete vector IDs in parallel batches and wait for all of them. Returns the count."""
+    store = get_vector_store()
+    futures = [
+        delete_executor.submit(store.delete, vector_ids[i:i+DELETE_BATCH_SIZE])
+        for i in range(0, len(vector_ids), DELETE_BATCH_SIZE)
+    ]
+    for future in futures:
+        future.result()
+    return len(vector_ids)
+
+def upsert_in_batches(vectors):
+    """Upsert (id, vector, metadata) tuples in chunks bounded by count and payload size."""
+    batch = []
+    batch_bytes = 0
+    upserted = 0
+
+    for record in vectors:
+        record_bytes = len(record[2].get("text", "").encode("utf-8")) + len(record[1]) * 4
+        if batch and (len(batch) >= UPSERT_BATCH_SIZE or batch_bytes + record_bytes > UPSERT_MAX_BYTES):
+            get_vector_store().upsert(batch)
+            upserted += len(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(record)
+        batch_bytes += record_bytes
+
+    if batch:
+        get_vector_store().upsert(batch)
+        upserted += len(batch)
+
+    return upserted
+
+def ingest_documents(documents):
+    """
+    Ingestion stage shared by the /process* endpoints.
+
+    Takes (document_id, document_text, metadata) tuples, splits long documents into
+    chunks, embeds every chunk in one batch and upserts them in sized batches.
+    Returns the number of vectors written.
+    """
+    chunks = []
+    for document_id, document_text, metadata in documents:
+        chunks.extend(chunk_document(document_id, document_text, metadata))
+    return store_chunks(chunks)
+
+def store_chunks(chunks):
+    """Embed (chunk_id, chunk_text, metadata) tuples in one batch and upsert them."""
+    vectors = encode_documents([chunk_text for _, chunk_text, _ in chunks])
+    return upsert_in_batches([
+        (chunk_id, vector, chunk_metadata)
+        for (chunk_id, _, chunk_metadata), vector in zip(chunks, vectors)
+    ])
+
+def content_fingerprint(document_text):
+    """Stable fingerprint of a document's text, stored with its vectors as content_hash."""
+    return hashlib.sha256(document_text.encode("utf-8")).hexdigest()
+
+def fetch_stored_fingerprints(document_ids):
+    """
+    Fetch the stored content_hash and chunk_count for the given IDs in bulk.
+    Returns a dict of document_id -> (content_hash, chunk_count) for IDs that exist.
+    """
+    stored = {}
+    batch_size = 100
+    for i in range(0, len(document_ids), batch_size):
+        batch = document_ids[i:i+batch_size]
+        for vector_id, vector in get_vector_store().fetch(batch).items():
+            metadata = vector["metadata"]
+            stored[vector_id] = (metadata.get("content_hash"), int(metadata.get("chunk_count", 1)))
+    return stored
+
+def ingest_smart_documents(documents, force=False):
+    """
+    Ingest documents with deterministic IDs, skipping the ones whose text is unchanged.
+
+    The stored fingerprints of all documents are fetched in bulk before encoding, so
+    unchanged items cost neither a model forward pass nor a vector store write unless
+    force is set. Chunks left over from a longer previous version of a changed
+    document are deleted. Returns (written_ids, unchanged_ids).
+    """
+    for _, document_text, metadata in documents:
+        metadata["content_hash"] = content_fingerprint(document_text)
+
+    stored = fetch_stored_fingerprints([doc[0] for doc in documents])
+
+    changed = []
+    unchanged_ids = []
+    for document in documents:
+        document_id, _, metadata = document
+        if not force and stored.get(document_id, (None, 0))[0] == metadata["content_hash"]:
+            unchanged_ids.append(document_id)
+        else:
+            changed.append(document)
+
+    chunks = []
+    stale_chunk_ids = []
+    for document_id, document_text, metadata in changed:
+        document_chunks = chunk_document(document_id, document_text, metadata)
+        chunks.extend(document_chunks)
+        # Drop chunks that only a longer previous version of the document produced
+        stored_chunk_count = stored.get(document_id, (None, 0))[1]
+        stale_chunk_ids.extend(
+            f"{document_id}_chunk_{chunk_index}"
+            for chunk_index in range(len(document_chunks), stored_chunk_count)
+        )
+
+    store_chunks(chunks)
+
+    delete_vectors(stale_chunk_ids)
+
+    return [doc[0] for doc in changed], unchanged_ids
+
+def build_smart_document_id(user_id, platform, content_type, unique_id=""):
+    """Build the deterministic, sanitized document ID used by smart processing."""
+    if unique_id:
+        document_id = f"doc_{user_id}_{platform}_{content_type}_{unique_id}"
+    else:
+        document_id = f"doc_{user_id}_{platform}_{content_type}"
+
+    # Sanitize document ID (remove special characters)
+    return re.sub(r'[^a-zA-Z0-9_-]', '_', document_id)
+
+# Public widget answers, served again until the profile's corpus changes
+# Worker processes on one host share corpus versions through CORPUS_VERSION_PATH, so
+# a write handled by any of them invalidates the answers cached by all of them
+CORPUS_VERSION_PATH = os.getenv('CORPUS_VERSION_PATH')
+embed_response_cache = ResponseCache(
+    max_entries=int(os.getenv('EMBED_RESPONSE_CACHE_MAX_ENTRIES', 2048)),
+    ttl_seconds=float(os.getenv('EMBED_RESPONSE_CACHE_TTL_SECONDS', 3600)),
+    versions=SqliteCorpusVersions(CORPUS_VERSION_PATH) if CORPUS_VERSION_PATH else None
+)
+
+def invalidates_corpus(route):
+    """
+    For endpoints that write a user's documents or memories: once the handler has
+    run, successfully or not, bump the user's corpus version so no cached answer
+    built on the old corpus is served again.
+    """
+    @wraps(route)
+    def wrapper(*args, **kwargs):
+        try:
+            return route(*args, **kwargs)
+        finally:
+            user_id = (request.get_json(silent=True) or {}).get("username")
+            if user_id:
+                embed_response_cache.bump(user_id)
+    return wrapper
+
+# With "async": true the /process* endpoints validate the request, queue the
+# ingestion and answer 202 with a job ID to poll at /jobs/<id>. Jobs run on their
+# own small pool, so bulk embedding never holds the request threads /ask needs.
+ingestion_jobs = IngestionJobs(
+    workers=int(os.getenv('INGESTION_WORKERS', 2)),
+    max_queued=int(os.getenv('INGESTION_MAX_QUEUED', 100)),
+    max_retries=int(os.getenv('INGESTION_MAX_RETRIES', 2)),
+    ttl_seconds=float(os.getenv('INGESTION_JOB_TTL_SECONDS', 3600))
+)
+INGESTION_SLICE_SIZE = int(os.getenv('INGESTION_SLICE_SIZE', 32))
+
+def new_document_id(user_id, job_key=None, position=0):
+    """
+    ID of a document stored under a random ID. With the client's job_key it is derived
+    from the key and the document's position instead, so resubmitting the same job
+    overwrites the documents rather than duplicating them.
+    """
+    if job_key:
+        return "doc_" + user_id + "_" + str(uuid.uuid5(uuid.NAMESPACE_URL, f"{user_id}/{job_key}/{position}"))
+    return "doc_" + user_id + "_" + str(uuid.uuid4())
+
+def ingest_job_slice(user_id, documents):
+    """Job slice for /process and /process_batch."""
+    try:
+        vectors = ingest_documents(documents)
+        # Flushed here so a failed write fails the slice and is retried
+        flush_vector_writes([document[0] for document in documents])
+        return {"vectors": vectors}
+    finally:
+        embed_response_cache.bump(user_id)
+
+def ingest_smart_job_slice(user_id, documents, force):
+    """Job slice for /process_smart."""
+    try:
+        written_ids, unchanged_ids = ingest_smart_documents(documents, force=force)
+        flush_vector_writes(written_ids)
+        return {"updated": len(written_ids), "unchanged": len(unchanged_ids)}
+    finally:
+        embed_response_cache.bump(user_id)
+
+def enqueue_ingestion(data, user_id, items, process_slice, errors=(), result=None):
+    """Queue (index, document) items as an ingestion job and return the 202 response."""
+    try:
+        job_id = ingestion_jobs.submit(
+            user_id, items, process_slice,
+            slice_size=INGESTION_SLICE_SIZE,
+            key=data.get("job_key") or None,
+            errors=errors,
+            result=result
+        )
+    except IngestionQueueFull as e:
+        return jsonify({"error": str(e)}), 503
+
+    return jsonify({
+        "success": True,
+        "message": "Ingestion queued",
+        "job_id": job_id,
+        "status_url": f"/jobs/{job_id}"
+    }), 202
 
 @app.route('/process', methods=['POST'])
+@invalidates_corpus
 def process_document():
     """Receives GitHub & Twitter data and stores embeddings in Pinecone."""
     try:
@@ -168,18 +693,24 @@ def process_document():
         if not document_text:
             return jsonify({"error": "No document provided"}), 400
 
-        # Generate embedding for the document
-        vector = embedding_model.encode(document_text).tolist()
-
         # Generate a unique document ID using UUID
-        document_id = "doc_" + user_id + "_" + str(uuid.uuid4())
+        document_id = new_document_id(user_id, data.get("job_key"))
 
-        # Store in Pinecone with a unique document ID
-        index.upsert(vectors=[(
-            document_id, vector, {"text": document_text, "user_id": user_id}
-        )])
+        metadata = {"text": document_text, "user_id": user_id}
+        metadata.update(source_metadata(data.get("source", ""), data.get("pdf_filename", ""), document_text))
+
+        if data.get("async"):
+            return enqueue_ingestion(
+                data, user_id, [(0, (document_id, document_text, metadata))],
+                lambda documents: ingest_job_slice(user_id, documents),
+                result={"document_ids": [document_id]}
+            )
 
-        print(f"Document stored with ID: {document_id}")
+        # Chunk, embed and store in Pinecone under the document ID
+        vector_count = ingest_documents([(document_id, document_text, metadata)])
+        flush_vector_writes([document_id])
+
+        print(f"Document stored with ID: {document_id} ({vector_count} chunks)")
 
         return jsonify({"success": True, "message": "Document processed successfully"})
 
@@ -187,10 +718,16 @@ def process_document():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/process_smart', methods=['POST'])
+@invalidates_corpus
 def process_document_smart():
     """Processes documents with smart deduplication using deterministic IDs."""
     try:
         data = request.json
+
+        # Batch mode: a list of documents sharing the same user (and optionally platform)
+        if isinstance(data.get("documents"), list):
+            return process_smart_batch(data)
+
         document_text = data.get("document", "")
         user_id = data.get("username", "")
         platform = data.get("platform", "")
@@ -203,85 +740,217 @@ def process_document_smart():
         if not platform or not content_type:
             return jsonify({"error": "Platform and content_type are required for smart processing"}), 400
 
-        # Generate embedding for the document
-        vector = embedding_model.encode(document_text).tolist()
-
         # Generate deterministic document ID based on content
-        if unique_id:
-            document_id = f"doc_{user_id}_{platform}_{content_type}_{unique_id}"
-        else:
-            document_id = f"doc_{user_id}_{platform}_{content_type}"
+        document_id = build_smart_document_id(user_id, platform, content_type, unique_id)
+
+        document = (document_id, document_text, {
+            "text": document_text, 
+            "user_id": user_id,
+            "platform": platform,
+            "content_type": content_type,
+            "unique_id": unique_id,
+            "source": (data.get("source") or platform).lower(),
+            "last_updated": str(datetime.datetime.now())
+        })
+        force = bool(data.get("force", False))
 
-        # Sanitize document ID (remove special characters)
-        document_id = re.sub(r'[^a-zA-Z0-9_-]', '_', document_id)
+        if data.get("async"):
+            return enqueue_ingestion(
+                data, user_id, [(0, document)],
+                lambda documents: ingest_smart_job_slice(user_id, documents, force),
+                result={"document_ids": [document_id]}
+            )
 
-        # Store in Pinecone with deterministic ID (upsert will update if exists)
-        index.upsert(vectors=[(
-            document_id, 
-            vector, 
-            {
-                "text": document_text, 
-                "user_id": user_id,
-                "platform": platform,
-                "content_type": content_type,
-                "unique_id": unique_id,
-                "last_updated": str(datetime.datetime.now())
-            }
-        )])
+        # Store in Pinecone with deterministic ID (upsert will update if exists),
+        # unless the stored content fingerprint shows the text is unchanged
+        written_ids, unchanged_ids = ingest_smart_documents([document], force=force)
+        flush_vector_writes(written_ids)
 
-        print(f"Smart document stored/updated with ID: {document_id}")
+        if unchanged_ids:
+            print(f"Smart document unchanged, skipped: {document_id}")
+        else:
+            print(f"Smart document stored/updated with ID: {document_id}")
 
         return jsonify({
             "success": True, 
             "message": "Document processed successfully with smart deduplication",
-            "document_id": document_id
+            "document_id": document_id,
+            "unchanged": bool(unchanged_ids)
+        })
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def process_smart_batch(data):
+    """Batch mode for /process_smart: one batched encode and chunked upserts."""
+    user_id = data.get("username", "")
+    default_platform = data.get("platform", "")
+    default_content_type = data.get("content_type", "")
+
+    records = {}
+    positions = {}
+    errors = []
+    for position, item in enumerate(data["documents"]):
+        if not isinstance(item, dict):
+            errors.append({"index": position, "error": "Each document must be an object"})
+            continue
+
+        document_text = item.get("document", "")
+        platform = item.get("platform", default_platform)
+        content_type = item.get("content_type", default_content_type)
+        unique_id = item.get("unique_id", "")
+
+        if not document_text:
+            errors.append({"index": position, "error": "No document provided"})
+            continue
+        if not platform or not content_type:
+            errors.append({"index": position, "error": "Platform and content_type are required for smart processing"})
+            continue
+
+        document_id = build_smart_document_id(user_id, platform, content_type, unique_id)
+        # Later items with the same deterministic ID win, just like sequential upserts would
+        records[document_id] = (document_id, document_text, {
+            "text": document_text,
+            "user_id": user_id,
+            "platform": platform,
+            "content_type": content_type,
+            "unique_id": unique_id,
+            "source": (item.get("source") or data.get("source") or platform).lower(),
+            "last_updated": str(datetime.datetime.now())
+        })
+        positions[document_id] = position
+
+    force = bool(data.get("force", False))
+    if data.get("async"):
+        return enqueue_ingestion(
+            data, user_id, [(positions[document_id], record) for document_id, record in records.items()],
+            lambda documents: ingest_smart_job_slice(user_id, documents, force),
+            errors=errors,
+            result={"document_ids": list(records.keys())}
+        )
+
+    written_ids, unchanged_ids = ingest_smart_documents(list(records.values()), force=force)
+    flush_vector_writes(written_ids)
+
+    print(f"Smart batch for {user_id}: {len(written_ids)} stored/updated, "
+          f"{len(unchanged_ids)} unchanged, {len(errors)} rejected")
+
+    return jsonify({
+        "success": True,
+        "message": f"Processed {len(records)} documents with smart deduplication",
+        "processed": len(records),
+        "updated": len(written_ids),
+        "unchanged": len(unchanged_ids),
+        "document_ids": list(records.keys()),
+        "errors": errors
+    })
+
+@app.route('/process_batch', methods=['POST'])
+@invalidates_corpus
+def process_batch():
+    """Receives many documents for a user and stores them with one batched encode."""
+    try:
+        data = request.json
+        user_id = data.get("username", "")
+        documents = data.get("documents", [])
+
+        if not isinstance(documents, list) or not documents:
+            return jsonify({"error": "No documents provided"}), 400
+
+        # Accept plain strings or {"document": "...", "source": "...", "pdf_filename": "..."}
+        # objects; a batch-level source applies to items that don't name their own
+        texts = []
+        metadatas = []
+        positions = []
+        for position, item in enumerate(documents):
+            fields = item if isinstance(item, dict) else {}
+            text = fields.get("document", "") if isinstance(item, dict) else item
+            if isinstance(text, str) and text:
+                metadata = {"text": text, "user_id": user_id}
+                metadata.update(source_metadata(
+                    fields.get("source") or data.get("source", ""), fields.get("pdf_filename", ""), text
+                ))
+                texts.append(text)
+                metadatas.append(metadata)
+                positions.append(position)
+
+        if not texts:
+            return jsonify({"error": "No documents provided"}), 400
+
+        document_ids = [new_document_id(user_id, data.get("job_key"), position) for position in positions]
+
+        if data.get("async"):
+            accepted = set(positions)
+            return enqueue_ingestion(
+                data, user_id,
+                [
+                    (position, (document_id, text, metadata))
+                    for position, document_id, text, metadata in zip(positions, document_ids, texts, metadatas)
+                ],
+                lambda batch: ingest_job_slice(user_id, batch),
+                errors=[
+                    {"index": position, "error": "No document provided"}
+                    for position in range(len(documents)) if position not in accepted
+                ],
+                result={"document_ids": document_ids}
+            )
+
+        vector_count = ingest_documents([
+            (document_id, text, metadata)
+            for document_id, text, metadata in zip(document_ids, texts, metadatas)
+        ])
+        flush_vector_writes(document_ids)
+
+        print(f"Batch stored {len(texts)} documents ({vector_count} chunks) for {user_id}")
+
+        return jsonify({
+            "success": True,
+            "message": f"Processed {len(texts)} documents successfully",
+            "processed": len(texts),
+            "skipped": len(documents) - len(texts),
+            "document_ids": document_ids
         })
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Status of a queued ingestion job: queued, running, succeeded, partially_failed or
+    failed, with processed/failed item counts and per-item errors. The optional
+    username query parameter restricts the lookup to that user's jobs.
+    """
+    job = ingestion_jobs.status(job_id, user_id=request.args.get("username"))
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+
+    return jsonify(job), 200
+
 @app.route('/cleanup_platform_data', methods=['POST'])
+@invalidates_corpus
 def cleanup_platform_data():
     """Cleans up outdated platform data by removing documents that no longer exist."""
     try:
         data = request.json
         user_id = data.get("username", "")
         platform = data.get("platform", "")
-        current_ids = data.get("current_ids", [])  # List of unique_ids that currently exist
+        current_ids = set(data.get("current_ids", []))  # unique_ids that currently exist
 
         if not user_id or not platform:
             return jsonify({"error": "Username and platform are required"}), 400
 
-        # Query all documents for this user and platform
-        query_response = index.query(
-            vector=[0] * 768,  # Dummy vector for metadata-only filtering
-            top_k=10000,  # High number to get all matches
-            include_metadata=True,
-            filter={"user_id": user_id, "platform": platform}
-        )
-
-        # Find documents to delete (those not in current_ids)
-        vectors_to_delete = []
-        
-        for match in query_response["matches"]:
-            vector_id = match["id"]
-            metadata = match.get("metadata", {})
-            unique_id = metadata.get("unique_id", "")
-            
-            # If this document's unique_id is not in the current list, mark for deletion
-            if unique_id and unique_id not in current_ids:
-                vectors_to_delete.append(vector_id)
-                print(f"Marking for deletion: {vector_id} (unique_id: {unique_id})")
-
-        # Delete the vectors if any found
+        # Page through this user's platform documents in the manifest and delete
+        # those whose unique_id is no longer current
         deleted_count = 0
-        if vectors_to_delete:
-            # Delete vectors in batches of 100 to avoid exceeding API limits
-            batch_size = 100
-            for i in range(0, len(vectors_to_delete), batch_size):
-                batch = vectors_to_delete[i:i+batch_size]
-                delete_response = index.delete(ids=batch)
-                deleted_count += len(batch)
+        for page in get_vector_store().user_pages(user_id, filter={"platform": platform}):
+            vectors_to_delete = []
+            for record in page:
+                unique_id = record["metadata"].get("unique_id", "")
+                if unique_id and unique_id not in current_ids:
+                    vectors_to_delete.append(record["id"])
+                    print(f"Marking for deletion: {record['id']} (unique_id: {unique_id})")
+            deleted_count += delete_vectors(vectors_to_delete)
 
         print(f"Cleaned up {deleted_count} outdated documents for {platform}")
 
@@ -296,8 +965,9 @@ def cleanup_platform_data():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/delete_user_data', methods=['POST'])
+@invalidates_corpus
 def delete_user_data():
-    """Deletes all user data from Pinecone matching the specified criteria."""
+    """Deletes all user data from the vector store matching the specified criteria."""
     try:
         data = request.json
         user_id = data.get("username", "")
@@ -307,46 +977,24 @@ def delete_user_data():
         if not user_id:
             return jsonify({"error": "Username is required"}), 400
 
-        # Query vectors that belong to the user
-        query_response = index.query(
-            vector=[0] * 768,  # Dummy vector for metadata-only filtering
-            top_k=10000,  # High number to get all matches
-            include_metadata=True,
-            filter={"user_id": user_id}
-        )
+        # Every chunk carries its document's source fields, so the manifest (or the
+        # store's metadata filter) finds whole documents without reading any text;
+        # only vectors stored without them are matched by text
+        store = get_vector_store()
+        if not data_source and _vector_manifest_store is not None:
+            # Deleting an account must not depend on this host's manifest having
+            # seen every write, so it is rebuilt from the vector store's ID listing
+            _vector_manifest_store.rebuild(user_id)
 
-        # Extract vectors that match the source type
-        vectors_to_delete = []
-        
-        for match in query_response["matches"]:
-            vector_id = match["id"]
-            text = match["metadata"]["text"]
-            
-            # Handle different source types
-            if data_source == "pdf" and pdf_filename:
-                # Check if the text contains the specific PDF filename
-                if f"PDF Name: {pdf_filename}" in text:
-                    vectors_to_delete.append(vector_id)
-            elif data_source:
-                # For other sources, check if text contains the source type
-                if data_source.lower() in text.lower():
-                    vectors_to_delete.append(vector_id)
-            else:
-                # If no source specified, delete all user data
-                vectors_to_delete.append(vector_id)
-        
-        # Delete the vectors if any found
-        if vectors_to_delete:
-            # Delete vectors in batches of 100 to avoid exceeding API limits
-            batch_size = 100
-            for i in range(0, len(vectors_to_delete), batch_size):
-                batch = vectors_to_delete[i:i+batch_size]
-                delete_response = index.delete(ids=batch)
-            
+        deleted_count = 0
+        for vector_ids in source_deletion_pages(store, user_id, data_source, pdf_filename):
+            deleted_count += delete_vectors(vector_ids)
+
+        if deleted_count:
             return jsonify({
                 "success": True, 
-                "message": f"Deleted {len(vectors_to_delete)} documents for user {user_id}",
-                "deleted_count": len(vectors_to_delete)
+                "message": f"Deleted {deleted_count} documents for user {user_id}",
+                "deleted_count": deleted_count
             })
         else:
             return jsonify({
@@ -359,157 +1007,7 @@ def delete_user_data():
         print(f"Error in delete_user_data: {e}")  # Add logging for debugging
         return jsonify({"error": str(e)}), 500
 
-@app.route('/ask', methods=['POST'])
-def ask():
-    """Handles user queries, retrieves context, and generates responses."""
-    try:
-        data = request.json
-        query = data.get("query", "")
-        user_id = data.get("username", "")
-        name = data.get("name", "User")
-        self_assessment = data.get("selfAssessment", "")
-        memory_enabled = data.get("memory_enabled", True)
-        conversation_history = data.get("chatHistory", "")
-        
-        # Define is_own_model based on memory_enabled
-        is_own_model = memory_enabled
-        
-        
-        if not query:
-            return jsonify({"error": "No query provided"}), 400
-
-        # Format chat history for context
-        if conversation_history:
-            if isinstance(conversation_history, list):
-                formatted_history = ""
-                for message in conversation_history[-3:]:  # Include last 3 messages
-                    role = message.get("role", "unknown")
-                    content = message.get("content", "")
-                    if role == "user":
-                        formatted_history += f"User: {content}\n"
-                    elif role == "assistant":
-                        formatted_history += f"Assistant: {content}\n"
-                    elif role == "system":
-                        formatted_history += f"System: {content}\n"
-                conversation_history = formatted_history
-        
-        # PHASE 1: Combined query expansion and complexity assessment
-        expanded_query, optimal_doc_count = analyze_query(query, conversation_history)
-        print(f"Original query: {query}")
-        print(f"Expanded query: {expanded_query}")
-        print(f"Determined optimal document count: {optimal_doc_count}")
-        
-        # PHASE 2: Initial retrieval
-        # Generate query embedding
-        query_vector = embedding_model.encode(expanded_query).tolist()
-        original_query_vector = embedding_model.encode(query).tolist()
-        
-        # Create a weighted average of the two vectors (70% expanded, 30% original)
-        hybrid_vector = [0.7 * e + 0.3 * o for e, o in zip(query_vector, original_query_vector)]
-        
-        # Normalize the hybrid vector
-        norm = np.sqrt(sum([x*x for x in hybrid_vector]))
-        if norm > 0:
-            normalized_hybrid_vector = [x/norm for x in hybrid_vector]
-        else:
-            normalized_hybrid_vector = hybrid_vector
-        
-        # Retrieve documents - only if username is a valid Mimikree user
-        context = ""
-        if user_id and user_id != 'embedded-user':
-            try:
-                # Get regular user documents
-                pinecone_results = index.query(
-                    vector=normalized_hybrid_vector, 
-                    top_k=optimal_doc_count * 2,  # Get 2x optimal count for filtering
-                    include_metadata=True, 
-                    filter={"user_id": user_id}
-                )
-                
-                # Use enhanced memory retrieval only when memory is enabled (own model)
-                memory_matches = []
-                if memory_enabled:
-                    memory_matches = retrieve_relevant_memories(
-                        query_text=query,
-                        query_vector=normalized_hybrid_vector,
-                        user_id=user_id,
-                        optimal_doc_count=optimal_doc_count
-                    )
-                
-                # Combine regular documents with prioritized memories
-                # Create a unified format for both types
-                all_matches = []
-                
-                # Add regular document matches
-                for match in pinecone_results["matches"]:
-                    # Skip memory type documents - we'll get them from memory retrieval
-                    if match["metadata"].get("type") == "memory":
-                        continue
-                        
-                    all_matches.append({
-                        "id": match["id"],
-                        "score": match["score"],
-                        "values": match["values"],
-                        "metadata": match["metadata"],
-                        "source": "document",
-                        "final_score": match["score"]  # Set base score for documents
-                    })
-                
-                # Add memory matches
-                all_matches.extend(memory_matches)
-                
-                # PHASE 3: Re-rank all documents based on combined factors
-                # Sort by final_score (memories already have this calculated)
-                all_matches.sort(key=lambda x: x.get("final_score", 0), reverse=True)
-                
-                # Prepare for retrieval
-                retrieved_docs = []
-                
-                for match in all_matches:
-                    doc_text = match["metadata"]["text"]
-                    
-                    # For memory items, never surface explicit memory tags; skip private when not owner
-                    if match["metadata"].get("type") == "memory":
-                        privacy_level = match["metadata"].get("privacy_level", 0)
-                        if not is_own_model and privacy_level > 0:
-                            # Skip private memories for non-owners
-                            continue
-                        # Include only the content text without any memory labeling
-                        doc_text = match["metadata"].get("text", "")
-                    
-                    # Use final score as relevance
-                    relevance_score = match.get("final_score", match.get("score", 0)) * 10
-                    
-                    retrieved_docs.append((doc_text, relevance_score))
-                
-                # Only keep top k most relevant documents
-                final_docs = [doc[0] for doc in retrieved_docs[:optimal_doc_count]]
-                
-                # Join the documents into a single context
-                context = "\n".join(final_docs)
-                print(f"Retrieved {len(final_docs)} documents for {user_id}")
-            except Exception as retrieval_error:
-                print(f"Error retrieving documents: {retrieval_error}")
-                # Continue with empty context if retrieval fails
-        
-        if memory_enabled:
-            interaction_type = (f"You are talking with your creator/owner. Respond in a more personal, familiar way since this is {name} who created you."
-                              f"Note: When {name} says 'my' or 'mine', they are referring to their own things. "
-                              )
-        else:
-            interaction_type = f"You are talking with someone who is not your creator. This is some user who is interacting with you"
-
-        prompt = prompt_template.format(
-            context=context,
-            background=self_assessment,
-            name=name,
-            question=query,
-            interaction=interaction_type,
-            history=conversation_history
-        )
-
-        if "cloudinary" in context:
-            prompt += '''### Important note for Cloudinary Links ### 
+CLOUDINARY_NOTE = '''### Important note for Cloudinary Links ###
 When you encounter URLs that contain the word "cloudinary":
 1. Return the URLs exactly as they are, without any modification
 2. After each URL, add a brief one-line description of what the image shows
@@ -521,370 +1019,717 @@ This is a photo of a mountain landscape
 https://res.cloudinary.com/example2.jpg
 This image shows a portrait of a person'''
 
-        # Request completion from Gemini - wrapped with key rotation
-        @with_key_rotation
-        def generate_gemini_response(prompt, user_id, conversation_history=""):
-            try:
-                model = genai.GenerativeModel("gemini-2.0-flash")
-                
-                print(f"[MEMORY MODULE] Analyzing response for user {user_id} using single API call")
-                
-                # Create a prompt that requests both the response and memory analysis in JSON format
-                json_prompt = f"""
-                {prompt}
-                
-                IMPORTANT: Return your entire response in valid JSON format with the following structure:
-                {{
-                    "response": "your actual response to the user goes here in markdown format",
-                    "memory_analysis": {{
+# Shape of the memory analysis Gemini returns
+MEMORY_ANALYSIS_FORMAT = """{
                         "IS_VITAL": boolean (true if user shared important personal information),
                         "PRESENT_IN_CONTEXT": number between 0-100 (how much of this information is already in the context),
                         "MEMORY_SUMMARY": "brief description of what should be remembered" (empty if nothing vital),
                         "EXTRACTED_INFO": "exact information to store as a string" (empty if nothing vital),
                         "MEMORY_CATEGORY": "one of: contact, preference, personal, work, education, health, technical, general",
                         "IMPORTANCE_SCORE": number between 1-10 (how important this information is to remember)
-                    }}
-                }}
-                
+                    }"""
+
+def prepare_ask(data):
+    """
+    Shared first half of /ask and /ask_stream: history formatting, query analysis,
+    retrieval and prompt construction.
+
+    Returns a dict with the prompt and everything the response payload reports about it.
+    """
+    query = data.get("query", "")
+    user_id = data.get("username", "")
+    name = data.get("name", "User")
+    self_assessment = data.get("selfAssessment", "")
+    memory_enabled = data.get("memory_enabled", True)
+    conversation_history = data.get("chatHistory", "")
+
+    # Define is_own_model based on memory_enabled
+    is_own_model = memory_enabled
+
+    # Format chat history for context
+    if conversation_history:
+        if isinstance(conversation_history, list):
+            formatted_history = ""
+            for message in conversation_history[-3:]:  # Include last 3 messages
+                role = message.get("role", "unknown")
+                content = message.get("content", "")
+                if role == "user":
+                    formatted_history += f"User: {content}\n"
+                elif role == "assistant":
+                    formatted_history += f"Assistant: {content}\n"
+                elif role == "system":
+                    formatted_history += f"System: {content}\n"
+            conversation_history = formatted_history
+
+    # Start retrieval for the raw query now, so it overlaps the query analysis call
+    speculation = None
+    retrieval_info = {}
+    if SPECULATIVE_RETRIEVAL and user_id and user_id != 'embedded-user':
+        try:
+            speculation = start_speculative_retrieval(query, user_id, include_memories=memory_enabled)
+        except Exception as speculation_error:
+            print(f"Error starting speculative retrieval: {speculation_error}")
+
+    # PHASE 1: Combined query expansion and complexity assessment
+    expanded_query, optimal_doc_count = analyze_query_tiered(query, conversation_history)
+    print(f"Original query: {query}")
+    print(f"Expanded query: {expanded_query}")
+    print(f"Determined optimal document count: {optimal_doc_count}")
+
+    # PHASE 2: Initial retrieval
+    # Generate query embedding: both queries in one batch, fused 70/30 and normalized
+    normalized_hybrid_vector = embed_query(expanded_query, query)
+
+    # Retrieve documents - only if username is a valid Mimikree user
+    context = ""
+    final_docs = []
+    if user_id and user_id != 'embedded-user':
+        try:
+            # Documents and memories are retrieved concurrently and re-ranked together
+            final_docs, retrieval_info = retrieve_context(
+                query_text=query,
+                query_vector=normalized_hybrid_vector,
+                user_id=user_id,
+                optimal_doc_count=optimal_doc_count,
+                include_memories=memory_enabled,
+                is_own_model=is_own_model,
+                speculation=speculation
+            )
+
+            # Join the documents into a single context
+            context = "\n".join(final_docs)
+            print(f"Retrieved {len(final_docs)} documents for {user_id}")
+        except Exception as retrieval_error:
+            print(f"Error retrieving documents: {retrieval_error}")
+            # Continue with empty context if retrieval fails
+
+    if memory_enabled:
+        interaction_type = (f"You are talking with your creator/owner. Respond in a more personal, familiar way since this is {name} who created you."
+                          f"Note: When {name} says 'my' or 'mine', they are referring to their own things. "
+                          )
+    else:
+        interaction_type = f"You are talking with someone who is not your creator. This is some user who is interacting with you"
+
+    prompt = prompt_template.format(
+        context=context,
+        background=self_assessment,
+        name=name,
+        question=query,
+        interaction=interaction_type,
+        history=conversation_history
+    )
+
+    if "cloudinary" in context:
+        prompt += CLOUDINARY_NOTE
+
+    return {
+        "query": query,
+        "user_id": user_id,
+        "memory_enabled": memory_enabled,
+        "conversation_history": conversation_history,
+        "expanded_query": expanded_query,
+        "optimal_doc_count": optimal_doc_count,
+        "final_docs": final_docs,
+        "context": context,
+        "retrieval_info": retrieval_info,
+        "prompt": prompt
+    }
+
+def parse_json_reply(full_text):
+    """Return the JSON object embedded in a model reply, or None if there is none."""
+    json_match = re.search(r'({.*})', full_text, re.DOTALL)
+    if not json_match:
+        return None
+    return json.loads(json_match.group(1))
+
+def log_memory_analysis(memory_data):
+    if memory_data and memory_data.get("IS_VITAL", False):
+        print(f"[MEMORY MODULE] Detected vital information: {memory_data.get('MEMORY_SUMMARY', 'Unknown')}")
+        print(f"[MEMORY MODULE] Context match: {memory_data.get('PRESENT_IN_CONTEXT', 0)}%")
+    else:
+        print(f"[MEMORY MODULE] No vital information detected in response")
+
+# Request completion from Gemini - wrapped with key rotation
+@with_key_rotation
+def generate_answer(prompt):
+    """Request the answer as plain text; memory analysis runs separately, after it."""
+    model = gemini_model()
+    return model.generate_content([prompt]).text.strip()
+
+@with_key_rotation
+def open_gemini_stream(prompt):
+    """
+    Start a streaming Gemini completion for prompt.
+
+    generate_content fetches the first chunk before returning, so quota errors are
+    raised here, inside the key rotation wrapper, rather than mid-stream.
+    """
+    model = gemini_model()
+    return model.generate_content([prompt], stream=True)
+
+def stream_text(response):
+    """Yield the text of each chunk of a streaming Gemini response."""
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without a simple text part (e.g. a safety stop) carry nothing to forward
+            continue
+        if text:
+            yield text
+
+@with_key_rotation
+def analyze_memory(query, context, response_text, user_id):
+    """
+    Memory analysis of one conversation turn, as its own call after the answer.
+
+    Keeping it out of the answer call lets the answer be plain (streamable) text, and a
+    malformed analysis can no longer cost the user their answer. Returns the memory data or None.
+    """
+    print(f"[MEMORY MODULE] Analyzing response for user {user_id}")
+    analysis_prompt = f"""
+                You are analyzing a conversation turn to decide whether the user shared information worth remembering.
+
+                ### Existing Context ###
+                {context}
+
+                ### User's Message ###
+                {query}
+
+                ### Assistant's Response ###
+                {response_text}
+
+                Return only valid JSON with the following structure:
+                {MEMORY_ANALYSIS_FORMAT}
+
                 IMPORTANT: Make sure EXTRACTED_INFO is always a string, not an object or nested JSON.
-                Only include memory_analysis if vital information was detected.
                 """
-                
-                # Make a single call to get both response and memory analysis
-                json_response = model.generate_content([json_prompt])
-                full_text = json_response.text.strip()
-                
-                # Parse the JSON response
-                try:
-                    import json
-                    import re
-                    
-                    # Find JSON in the response
-                    json_match = re.search(r'({.*})', full_text, re.DOTALL)
-                    if json_match:
-                        json_str = json_match.group(1)
-                        parsed_data = json.loads(json_str)
-                        
-                        # Extract regular response
-                        regular_response = parsed_data.get("response", "")
-                        
-                        # Extract memory data if available
-                        memory_data = parsed_data.get("memory_analysis")
-                        
-                        if memory_data and memory_data.get("IS_VITAL", False):
-                            print(f"[MEMORY MODULE] Detected vital information: {memory_data.get('MEMORY_SUMMARY', 'Unknown')}")
-                            print(f"[MEMORY MODULE] Context match: {memory_data.get('PRESENT_IN_CONTEXT', 0)}%")
-                        else:
-                            print(f"[MEMORY MODULE] No vital information detected in response")
-                    else:
-                        # If no JSON found, use the whole response as regular response
-                        print(f"[MEMORY MODULE ERROR] No JSON format detected in response")
-                        regular_response = full_text
-                        memory_data = None
-                        
-                except Exception as e:
-                    print(f"[MEMORY MODULE ERROR] Error parsing JSON response: {e}")
-                    regular_response = "I apologize, but there was an error processing your request."
-                    memory_data = None
-                    
-                # Return both the regular response and memory data
-                return {
-                    "response": regular_response,
-                    "memory_data": memory_data
-                }
-            except Exception as e:
-                print(f"[MEMORY MODULE ERROR] Error generating content: {e}")
-                return {
-                    "response": "I apologize, but I'm having trouble processing your request. Please try again.",
-                    "memory_data": None
-                }
-        
-        # Call the wrapped function
+    try:
+        model = gemini_model()
+        memory_data = parse_json_reply(model.generate_content([analysis_prompt]).text.strip())
+        log_memory_analysis(memory_data)
+        return memory_data
+    except Exception as e:
+        if is_rate_limit_error(e):
+            raise
+        print(f"[MEMORY MODULE ERROR] Error analyzing memory: {e}")
+        return None
+
+def check_memory_confirmation(memory_data, memory_enabled, user_id):
+    """Return True if the memory data holds vital information that is not in the context yet."""
+    memory_confirmation_needed = False
+    if memory_enabled and memory_data and memory_data.get("IS_VITAL", False):
+        present_in_context = memory_data.get("PRESENT_IN_CONTEXT", 100)
+        if present_in_context < 50:  # Threshold for new information
+            memory_confirmation_needed = True
+            print(f"[MEMORY MODULE] Memory confirmation needed for user {user_id}")
+            print(f"[MEMORY MODULE] Information: {memory_data.get('MEMORY_SUMMARY', 'Unknown')}")
+        else:
+            print(f"[MEMORY MODULE] Information already in context ({present_in_context}%), no confirmation needed")
+    elif memory_enabled:
+        if not memory_data:
+            print(f"[MEMORY MODULE] No vital information detected for user {user_id}")
+        elif not memory_data.get("IS_VITAL", False):
+            print(f"[MEMORY MODULE] Information not vital enough to store for user {user_id}")
+    else:
+        print(f"[MEMORY MODULE] Memory module disabled for this request")
+    return memory_confirmation_needed
+
+def run_memory_analysis(query, context, response_text, user_id):
+    """Background stage of /ask: analyze the turn and decide if the user should confirm a memory."""
+    memory_data = analyze_memory(query, context, response_text, user_id)
+    memory_confirmation_needed = check_memory_confirmation(memory_data, True, user_id)
+    return {
+        "memory_confirmation_needed": memory_confirmation_needed,
+        "memory_data": memory_data if memory_confirmation_needed else None
+    }
+
+# Memory analyses run after the answer has been returned; clients poll /memory_analysis/<id>
+memory_analysis_jobs = MemoryAnalysisJobs(
+    workers=int(os.getenv('MEMORY_ANALYSIS_WORKERS', 4)),
+    ttl_seconds=float(os.getenv('MEMORY_ANALYSIS_TTL_SECONDS', 600))
+)
+
+# How long /ask_stream keeps the connection open for the "memory" event
+MEMORY_ANALYSIS_STREAM_WAIT = float(os.getenv('MEMORY_ANALYSIS_STREAM_WAIT', 30))
+
+def memory_analysis_body(analysis):
+    """Flatten a finished analysis into the status, memory_confirmation_needed and memory_data fields."""
+    if analysis["status"] == "done":
+        return dict(analysis["result"], status="done")
+    return analysis
+
+def start_memory_analysis(state, response_text):
+    """Queue the memory analysis of an answered query; returns its ID, or None if memory is disabled."""
+    if not state["memory_enabled"]:
+        print(f"[MEMORY MODULE] Memory module disabled for this request")
+        return None
+    return memory_analysis_jobs.submit(
+        state["user_id"], run_memory_analysis,
+        state["query"], state["context"], response_text, state["user_id"]
+    )
+
+def build_ask_payload(state, response_text, start_time, memory_analysis_id=None):
+    """The /ask response body; also the "done" event of /ask_stream."""
+    # Collect detailed backend processing information
+    backend_process = {
+        "query_expansion": {
+            "original_query": state["query"],
+            "expanded_query": state["expanded_query"],
+            "optimal_document_count": state["optimal_doc_count"]
+        },
+        "document_retrieval": {
+            "documents_retrieved": len(state["final_docs"]),
+            "context_length": len(state["context"]),
+            "embedding_used": "all-mpnet-base-v2",
+            "speculative_retrieval": state["retrieval_info"]
+        },
+        "memory_processing": {
+            "memory_enabled": state["memory_enabled"],
+            "memory_analysis_id": memory_analysis_id,
+            "memory_analysis": "pending" if memory_analysis_id else "disabled"
+        },
+        "completion": {
+            "model_used": "gemini-2.0-flash",
+            "response_length": len(response_text) if response_text else 0
+        },
+        "timings": {
+            "total_processing_time_ms": int((time.time() - start_time) * 1000)
+        }
+    }
+
+    # The memory confirmation is not known yet; it arrives via /memory_analysis/<id>
+    return {
+        "success": True,
+        "query": state["query"],
+        "response": response_text,
+        "expandedQuery": state["expanded_query"],
+        "queryComplexity": state["optimal_doc_count"],
+        "documentsRetrieved": len(state["final_docs"]),
+        "memory_confirmation_needed": False,
+        "memory_data": None,
+        "memory_analysis_id": memory_analysis_id,
+        "backend_process": backend_process  # Add detailed backend process information
+    }
+
+def sse_event(event, payload):
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def sse_response(events):
+    """Stream an iterator of server-sent events, unbuffered by proxies."""
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/ask', methods=['POST'])
+def ask():
+    """Handles user queries, retrieves context, and generates responses."""
+    try:
+        data = request.json
+        if not data.get("query", ""):
+            return jsonify({"error": "No query provided"}), 400
+
         start_time = time.time()
-        response_data = generate_gemini_response(prompt, user_id, conversation_history)
-        
+        state = prepare_ask(data)
+        try:
+            response_text = generate_answer(state["prompt"])
+        except Exception as e:
+            print(f"Error generating content: {e}")
+            response_text = "I apologize, but I'm having trouble processing your request. Please try again."
+
         # Log the response for debugging
-        doc_count_for_log = len(final_docs) if 'final_docs' in locals() else 0
-        print(f"Retrieved {doc_count_for_log} documents with dynamic retrieval")
-        print("Model Response:", response_data["response"])
+        print(f"Retrieved {len(state['final_docs'])} documents with dynamic retrieval")
+        print("Model Response:", response_text)
 
-        response_text = response_data["response"]
-        memory_data = response_data["memory_data"]
-        
-        # Check if memory data needs to be stored
-        memory_confirmation_needed = False
-        if memory_enabled and memory_data and memory_data.get("IS_VITAL", False):
-            present_in_context = memory_data.get("PRESENT_IN_CONTEXT", 100)
-            if present_in_context < 50:  # Threshold for new information
-                memory_confirmation_needed = True
-                print(f"[MEMORY MODULE] Memory confirmation needed for user {user_id}")
-                print(f"[MEMORY MODULE] Information: {memory_data.get('MEMORY_SUMMARY', 'Unknown')}")
-            else:
-                print(f"[MEMORY MODULE] Information already in context ({present_in_context}%), no confirmation needed")
-        elif memory_enabled:
-            if not memory_data:
-                print(f"[MEMORY MODULE] No vital information detected for user {user_id}")
-            elif not memory_data.get("IS_VITAL", False):
-                print(f"[MEMORY MODULE] Information not vital enough to store for user {user_id}")
-        else:
-            print(f"[MEMORY MODULE] Memory module disabled for this request")
-        
-        # Collect detailed backend processing information
-        backend_process = {
-            "query_expansion": {
-                "original_query": query,
-                "expanded_query": expanded_query,
-                "optimal_document_count": optimal_doc_count
-            },
-            "document_retrieval": {
-                "documents_retrieved": len(final_docs) if 'final_docs' in locals() else 0,
-                "context_length": len(context) if context else 0,
-                "embedding_used": "all-mpnet-base-v2"
-            },
-            "memory_processing": {
-                "memory_enabled": memory_enabled,
-                "memory_confirmation_needed": memory_confirmation_needed,
-                "vital_information_detected": bool(memory_data and memory_data.get("IS_VITAL", False)) if memory_data else False
-            },
-            "completion": {
-                "model_used": "gemini-2.0-flash",
-                "response_length": len(response_text) if response_text else 0
-            },
-            "timings": {
-                "total_processing_time_ms": int((time.time() - start_time) * 1000) if 'start_time' in locals() else None
-            }
-        }
-        
-        # Return response with memory data if confirmation needed
-        return jsonify({
-            "success": True,
-            "query": query,
-            "response": response_text,
-            "expandedQuery": expanded_query,
-            "queryComplexity": optimal_doc_count,
-            "documentsRetrieved": len(final_docs) if 'final_docs' in locals() else 0,
-            "memory_confirmation_needed": memory_confirmation_needed,
-            "memory_data": memory_data if memory_confirmation_needed else None,
-            "backend_process": backend_process  # Add detailed backend process information
-        })
+        # The answer goes back now; memory analysis continues in the background
+        memory_analysis_id = start_memory_analysis(state, response_text)
+        return jsonify(build_ask_payload(state, response_text, start_time, memory_analysis_id))
 
     except Exception as e:
         print(f"Error processing query: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/ask_stream', methods=['POST'])
+def ask_stream():
+    """
+    Streaming variant of /ask, as server-sent events.
+
+    Emits a "token" event ({"text": ...}) per chunk as Gemini produces it, then one
+    "done" event with the same body /ask returns (backend_process included), or an
+    "error" event if the request fails. While the connection is open, the memory
+    analysis result follows as a "memory" event, so streaming clients need not poll.
+    """
+    data = request.json
+    if not data or not data.get("query", ""):
+        return jsonify({"error": "No query provided"}), 400
+
+    def events():
+        try:
+            start_time = time.time()
+            state = prepare_ask(data)
+
+            chunks = []
+            for text in stream_text(open_gemini_stream(state["prompt"])):
+                chunks.append(text)
+                yield sse_event("token", {"text": text})
+            response_text = "".join(chunks)
+            print(f"Streamed response of {len(response_text)} characters for {state['user_id']}")
+
+            memory_analysis_id = start_memory_analysis(state, response_text)
+            yield sse_event("done", build_ask_payload(state, response_text, start_time, memory_analysis_id))
+
+            if memory_analysis_id:
+                analysis = memory_analysis_jobs.status(memory_analysis_id, timeout=MEMORY_ANALYSIS_STREAM_WAIT)
+                yield sse_event("memory", dict(memory_analysis_body(analysis), memory_analysis_id=memory_analysis_id))
+        except Exception as e:
+            print(f"Error streaming query: {e}")
+            yield sse_event("error", {"error": str(e)})
+
+    return sse_response(events())
+
+@app.route('/memory_analysis/<analysis_id>', methods=['GET'])
+def memory_analysis(analysis_id):
+    """
+    Poll the background memory analysis of an /ask answer.
+
+    Returns {"status": "pending"} until it finishes, then {"status": "done",
+    "memory_confirmation_needed": ..., "memory_data": ...}. The optional username
+    query parameter restricts the lookup to that user's analyses.
+    """
+    analysis = memory_analysis_jobs.status(analysis_id, user_id=request.args.get("username"))
+    if analysis is None:
+        return jsonify({"error": "Unknown or expired memory analysis"}), 404
+
+    return jsonify(memory_analysis_body(analysis)), 200
+
+def prepare_ask_embed(data):
+    """
+    Shared first half of /ask_embed and /ask_embed_stream: query analysis, retrieval
+    and prompt construction for the embedded widget.
+
+    Returns a dict with the prompt, the context it was built from and the query.
+    """
+    query_text = data['query']
+    self_assessment = data['selfAssessment']
+    username = data['username']
+    name = data['name']
+    chat_history = data.get('chatHistory', [])
+
+    # Define is_own_model as false for embedded model access
+    is_own_model = False
+
+    # Format chat history for context
+    conversation_history = ""
+    if chat_history:
+        for msg in chat_history[-5:]:  # Include last 5 messages for context
+            role = "User" if msg["role"] == "user" else "Assistant"
+            conversation_history += f"{role}: {msg['content']}\n"
+
+    # Start retrieval for the raw query now, so it overlaps the query analysis call
+    speculation = None
+    if SPECULATIVE_RETRIEVAL and username and username != 'embedded-user':
+        try:
+            speculation = start_speculative_retrieval(query_text, username, include_memories=True)
+        except Exception as speculation_error:
+            print(f"Error starting speculative retrieval: {speculation_error}")
+
+    # PHASE 1: Combined query expansion and complexity assessment
+    # We'll still use our key rotation for this phase
+    expanded_query, optimal_doc_count = analyze_query_tiered(query_text, conversation_history)
+    print(f"Original query: {query_text}")
+    print(f"Expanded query: {expanded_query}")
+    print(f"Determined optimal document count: {optimal_doc_count}")
+
+    # PHASE 2: Initial retrieval
+    # Generate query embedding: both queries in one batch, fused 70/30 and normalized
+    normalized_hybrid_vector = embed_query(expanded_query, query_text)
+
+    # Retrieve documents - only if username is a valid Mimikree user
+    context = ""
+    if username and username != 'embedded-user':
+        try:
+            # Documents and memories are retrieved concurrently and re-ranked together
+            final_docs, _ = retrieve_context(
+                query_text=query_text,
+                query_vector=normalized_hybrid_vector,
+                user_id=username,
+                optimal_doc_count=optimal_doc_count,
+                include_memories=True,
+                is_own_model=is_own_model,
+                speculation=speculation
+            )
+
+            # Join the documents into a single context
+            context = "\n".join(final_docs)
+            print(f"Retrieved {len(final_docs)} documents for {username}")
+        except Exception as retrieval_error:
+            print(f"Error retrieving documents: {retrieval_error}")
+            # Continue with empty context if retrieval fails
+
+    interaction_type = f"You are talking with someone who is interacting with {name}'s AI through an embedded chat widget."
+
+    # Use the comprehensive prompt with context if we have user data
+    if context:
+        prompt = prompt_template.format(
+            context=context,
+            background=self_assessment,
+            name=name,
+            question=query_text,
+            interaction=interaction_type,
+            history=conversation_history
+        )
+    else:
+        # Fall back to simplified prompt if no context
+        prompt = ChatPromptTemplate.from_template(
+            f"You are {name} made using Mimikree(Don't mention Mimikree in your response unless asked).\n\n"
+            "### Instructions ###\n"
+            f"- Respond as if you are {name}.\n"
+            "- Use Markdown formatting where appropriate to structure your response.\n"
+            "- Be concise but informative in your responses.\n\n"
+
+            "### Previous Conversation ###\n"
+            "{history}\n\n"
+
+            "### User's Current Question ###\n"
+            "{question}\n\n"
+
+            "### Your Response ###"
+        ).format(
+            name=name,
+            history=conversation_history,
+            question=query_text
+        )
+
+    # Check for cloudinary links in the context and add special handling instructions
+    if "cloudinary" in context:
+        prompt += CLOUDINARY_NOTE
+
+    return {
+        "query": query_text,
+        "username": username,
+        "context": context,
+        "prompt": prompt
+    }
+
+def answer_embed(data):
+    """Run one /ask_embed request end to end; returns (response body, status code, context)."""
+    external_api_key = data.get('apiKey')  # Get the external API key
+    state = prepare_ask_embed(data)
+
+    try:
+        # Request completion from Gemini using the external API key; the model
+        # carries its own client, so no other request ever sees this key
+        model = gemini_model(api_key=external_api_key)
+        response = model.generate_content([state["prompt"]])
+
+        return {
+            "success": True,
+            "query": state["query"],
+            "response": response.text,
+            "hasPersonalData": bool(state["context"]),  # Let the client know if personal data was used
+            "username": state["username"]
+        }, 200, state["context"]
+
+    except Exception as e:
+        print(f"Error with external API key: {e}")
+        return {
+            "success": False,
+            "error": "Invalid API key or error processing request with provided API key"
+        }, 400, state["context"]
+
+# Bursts of the same widget question share one analysis, retrieval and completion
+ask_embed_flight = SingleFlight(timeout=float(os.getenv('ASK_EMBED_COALESCE_TIMEOUT', 30)))
+
+def ask_embed_flight_key(data):
+    """
+    Requests with the same key get the same answer: same profile and persona, same
+    query up to case and whitespace, same recent history and same API key. The API
+    key is part of it so that a request never gets an answer paid for (or refused)
+    by another key.
+    """
+    query = re.sub(r'\s+', ' ', data['query']).strip().lower()
+    history = json.dumps(data.get('chatHistory', [])[-5:], sort_keys=True)
+    return (
+        data.get('username'),
+        ResponseCache.make_key(data.get('name'), data.get('selfAssessment')),
+        query,
+        hashlib.sha256(history.encode("utf-8")).hexdigest(),
+        hashlib.sha256(data['apiKey'].encode("utf-8")).hexdigest()
+    )
+
+def embed_response_key(data):
+    """Digest of everything a widget answer depends on."""
+    return ResponseCache.make_key(ask_embed_flight_key(data))
+
+# Paraphrases of recent widget questions ("what's your job" / "where do you work")
+# are answered from the semantic cache; only questions without chat history qualify
+SEMANTIC_CACHE = os.getenv('SEMANTIC_CACHE', 'true').lower() == 'true'
+semantic_answer_cache = SemanticAnswerCache(
+    threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.92)),
+    max_entries_per_scope=int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES_PER_USER', 64)),
+    ttl_seconds=float(os.getenv('SEMANTIC_CACHE_TTL_SECONDS', 3600)),
+    audit_rate=float(os.getenv('SEMANTIC_CACHE_AUDIT_RATE', 0.05))
+)
+semantic_audit_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="semantic-audit")
+
+def semantic_cache_scope(data):
+    """Everything besides the question that a widget answer depends on."""
+    return ResponseCache.make_key(
+        data.get('username'), data.get('name'), data.get('selfAssessment'),
+        hashlib.sha256(data['apiKey'].encode("utf-8")).hexdigest()
+    )
+
+def lookup_semantic_answer(data, version):
+    """
+    Look up a cached answer to a paraphrase of this question.
+
+    Returns (body, query_vector); body is None on a miss, and query_vector is None
+    when the request does not qualify for the semantic cache.
+    """
+    if not SEMANTIC_CACHE or data.get('chatHistory'):
+        return None, None
+
+    try:
+        query_vector = embed_text(data['query'])
+        hit = semantic_answer_cache.lookup(semantic_cache_scope(data), version, query_vector)
+    except Exception as e:
+        print(f"Error looking up semantic cache: {e}")
+        return None, None
+    if hit is None:
+        return None, query_vector
+
+    answer, similarity, context_hash, audit = hit
+    print(f"Semantic cache hit for {data.get('username')} (similarity {similarity:.3f})")
+    if audit:
+        semantic_audit_executor.submit(audit_semantic_hit, data, context_hash)
+    return dict(answer, query=data['query']), query_vector
+
+def audit_semantic_hit(data, context_hash):
+    """
+    Check a semantic cache hit: retrieve the context for the new question and compare
+    it with the context the cached answer was generated from. A different context
+    means the answer may not fit the question, and counts as a false hit.
+    """
+    try:
+        state = prepare_ask_embed(data)
+        false_hit = content_fingerprint(state["context"]) != context_hash
+        semantic_answer_cache.record_audit(false_hit)
+        if false_hit:
+            print(f"Semantic cache audit: context differs for {data.get('username')}: {data['query']}")
+    except Exception as e:
+        print(f"Error auditing semantic cache hit: {e}")
+
+def store_semantic_answer(data, version, query_vector, body, context):
+    if query_vector is not None:
+        semantic_answer_cache.store(
+            semantic_cache_scope(data), version, query_vector, body, content_fingerprint(context)
+        )
+
 @app.route('/ask_embed', methods=['POST'])
 def ask_embed():
     try:
         data = request.json
-        query_text = data['query']
-        self_assessment = data['selfAssessment']
-        username = data['username']
-        name = data['name']
-        chat_history = data.get('chatHistory', [])
-        external_api_key = data.get('apiKey')  # Get the external API key
-
-        # Define is_own_model as false for embedded model access
-        is_own_model = False
 
-        if not query_text:
+        if not data['query']:
             return jsonify({"error": "No query provided"}), 400
-            
-        if not external_api_key:
+
+        if not data.get('apiKey'):
             return jsonify({"error": "API key is required"}), 400
 
-        # Format chat history for context
-        conversation_history = ""
-        if chat_history:
-            for msg in chat_history[-5:]:  # Include last 5 messages for context
-                role = "User" if msg["role"] == "user" else "Assistant"
-                conversation_history += f"{role}: {msg['content']}\n"
-        
-        # PHASE 1: Combined query expansion and complexity assessment
-        # We'll still use our key rotation for this phase
-        expanded_query, optimal_doc_count = analyze_query(query_text, conversation_history)
-        print(f"Original query: {query_text}")
-        print(f"Expanded query: {expanded_query}")
-        print(f"Determined optimal document count: {optimal_doc_count}")
-        
-        # PHASE 2: Initial retrieval
-        # Generate query embedding
-        query_vector = embedding_model.encode(expanded_query).tolist()
-        original_query_vector = embedding_model.encode(query_text).tolist()
-        
-        # Create a weighted average of the two vectors (70% expanded, 30% original)
-        hybrid_vector = [0.7 * e + 0.3 * o for e, o in zip(query_vector, original_query_vector)]
-        
-        # Normalize the hybrid vector
-        norm = np.sqrt(sum([x*x for x in hybrid_vector]))
-        if norm > 0:
-            normalized_hybrid_vector = [x/norm for x in hybrid_vector]
-        else:
-            normalized_hybrid_vector = hybrid_vector
-        
-        # Retrieve documents - only if username is a valid Mimikree user
-        context = ""
-        if username and username != 'embedded-user':
-            try:
-                # Get regular user documents
-                pinecone_results = index.query(
-                    vector=normalized_hybrid_vector, 
-                    top_k=optimal_doc_count * 2,  # Get 2x optimal count for filtering
-                    include_metadata=True, 
-                    filter={"user_id": username}
-                )
-                
-                # Use enhanced memory retrieval
-                memory_matches = retrieve_relevant_memories(
-                    query_text=query_text,
-                    query_vector=normalized_hybrid_vector,
-                    user_id=username,
-                    optimal_doc_count=optimal_doc_count
-                )
-                
-                # Combine regular documents with prioritized memories
-                # Create a unified format for both types
-                all_matches = []
-                
-                # Add regular document matches
-                for match in pinecone_results["matches"]:
-                    # Skip memory type documents - we'll get them from memory retrieval
-                    if match["metadata"].get("type") == "memory":
-                        continue
-                        
-                    all_matches.append({
-                        "id": match["id"],
-                        "score": match["score"],
-                        "values": match["values"],
-                        "metadata": match["metadata"],
-                        "source": "document",
-                        "final_score": match["score"]  # Set base score for documents
-                    })
-                
-                # Add memory matches
-                all_matches.extend(memory_matches)
-                
-                # PHASE 3: Re-rank all documents based on combined factors
-                # Sort by final_score (memories already have this calculated)
-                all_matches.sort(key=lambda x: x.get("final_score", 0), reverse=True)
-                
-                # Prepare for retrieval
-                retrieved_docs = []
-                
-                for match in all_matches:
-                    doc_text = match["metadata"]["text"]
-                    
-                    # For memory items, never surface explicit memory tags; skip private when not owner
-                    if match["metadata"].get("type") == "memory":
-                        privacy_level = match["metadata"].get("privacy_level", 0)
-                        if not is_own_model and privacy_level > 0:
-                            # Skip private memories for non-owners
-                            continue
-                        # Include only the content text without any memory labeling
-                        doc_text = match["metadata"].get("text", "")
-                    
-                    # Use final score as relevance
-                    relevance_score = match.get("final_score", match.get("score", 0)) * 10
-                    
-                    retrieved_docs.append((doc_text, relevance_score))
-                
-                # Only keep top k most relevant documents
-                final_docs = [doc[0] for doc in retrieved_docs[:optimal_doc_count]]
-                
-                # Join the documents into a single context
-                context = "\n".join(final_docs)
-                print(f"Retrieved {len(final_docs)} documents for {username}")
-            except Exception as retrieval_error:
-                print(f"Error retrieving documents: {retrieval_error}")
-                # Continue with empty context if retrieval fails
-        
-        interaction_type = f"You are talking with someone who is interacting with {name}'s AI through an embedded chat widget."
-        
-        # Use the comprehensive prompt with context if we have user data
-        if context:
-            prompt = prompt_template.format(
-                context=context,
-                background=self_assessment,
-                name=name,
-                question=query_text,
-                interaction=interaction_type,
-                history=conversation_history
-            )
-        else:
-            # Fall back to simplified prompt if no context
-            prompt = ChatPromptTemplate.from_template(
-                f"You are {name} made using Mimikree(Don't mention Mimikree in your response unless asked).\n\n"
-                "### Instructions ###\n"
-                f"- Respond as if you are {name}.\n"
-                "- Use Markdown formatting where appropriate to structure your response.\n"
-                "- Be concise but informative in your responses.\n\n"
-                
-                "### Previous Conversation ###\n"
-                "{history}\n\n"
-    
-                "### User's Current Question ###\n"
-                "{question}\n\n"
-    
-                "### Your Response ###"
-            ).format(
-                name=name,
-                history=conversation_history,
-                question=query_text
-            )
+        # Read the corpus version before answering, so a write that lands meanwhile wins
+        username = data.get('username')
+        version = embed_response_cache.version(username)
+        cache_key = embed_response_key(data)
+        cached = embed_response_cache.get(username, version, cache_key)
+        if cached is not None:
+            return jsonify(cached), 200
 
-        # Check for cloudinary links in the context and add special handling instructions
-        if "cloudinary" in context:
-            prompt += '''### Important note for Cloudinary Links ### 
-When you encounter URLs that contain the word "cloudinary":
-1. Return the URLs exactly as they are, without any modification
-2. After each URL, add a brief one-line description of what the image shows
-3. Place each URL on its own line, followed by its description
-4. Do not add any formatting, markdown, or HTML tags to the URLs
-5. Example format:
-https://res.cloudinary.com/example1.jpg
-This is a photo of a mountain landscape
-https://res.cloudinary.com/example2.jpg
-This image shows a portrait of a person'''
+        cached, query_vector = lookup_semantic_answer(data, version)
+        if cached is not None:
+            return jsonify(cached), 200
+
+        body, status, context = ask_embed_flight.do(ask_embed_flight_key(data), lambda: answer_embed(data))
+        if status == 200:
+            embed_response_cache.put(username, version, cache_key, body)
+            store_semantic_answer(data, version, query_vector, body, context)
+        return jsonify(body), status
+
+    except Exception as e:
+        print(f"Error in ask_embed: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/ask_embed_stream', methods=['POST'])
+def ask_embed_stream():
+    """
+    Streaming variant of /ask_embed, as server-sent events.
+
+    Emits "token" events as Gemini produces the answer, then a "done" event with the
+    /ask_embed body, or an "error" event if the request fails.
+    """
+    data = request.json
+    if not data or not data.get('query'):
+        return jsonify({"error": "No query provided"}), 400
+    external_api_key = data.get('apiKey')
+    if not external_api_key:
+        return jsonify({"error": "API key is required"}), 400
+
+    username = data.get('username')
+    version = embed_response_cache.version(username)
+    cache_key = embed_response_key(data)
+
+    def events():
+        cached = embed_response_cache.get(username, version, cache_key)
+        query_vector = None
+        if cached is None:
+            cached, query_vector = lookup_semantic_answer(data, version)
+        if cached is not None:
+            yield sse_event("token", {"text": cached["response"]})
+            yield sse_event("done", cached)
+            return
 
-        # Configure Gemini with the external API key
-        genai.configure(api_key=external_api_key)
-        
         try:
-            # Request completion from Gemini using the external API key
-            model = genai.GenerativeModel("gemini-2.0-flash")
-            response = model.generate_content([prompt])
-            
-            # Reset back to our key manager's current key
-            from utils.gemini_key_manager import get_key_manager
-            genai.configure(api_key=get_key_manager().current_key)
-            
-            return jsonify({
-                "success": True,
-                "query": query_text,
-                "response": response.text,
-                "hasPersonalData": bool(context),  # Let the client know if personal data was used
-                "username": username
-            })
-            
+            state = prepare_ask_embed(data)
+        except Exception as e:
+            print(f"Error in ask_embed_stream: {e}")
+            yield sse_event("error", {"error": str(e)})
+            return
+
+        try:
+            # The model carries a client for the external API key
+            model = gemini_model(api_key=external_api_key)
+            response = model.generate_content([state["prompt"]], stream=True)
         except Exception as e:
-            # Reset back to our key manager's current key
-            from utils.gemini_key_manager import get_key_manager
-            genai.configure(api_key=get_key_manager().current_key)
-            
             print(f"Error with external API key: {e}")
-            return jsonify({
-                "success": False,
-                "error": "Invalid API key or error processing request with provided API key"
-            }), 400
+            yield sse_event("error", {"error": "Invalid API key or error processing request with provided API key"})
+            return
 
-    except Exception as e:
-        # Reset API key to our key manager's current key
-        from utils.gemini_key_manager import get_key_manager
-        genai.configure(api_key=get_key_manager().current_key)
+        try:
+            chunks = []
+            for text in stream_text(response):
+                chunks.append(text)
+                yield sse_event("token", {"text": text})
 
-        print(f"Error in ask_embed: {e}")
-        return jsonify({"error": str(e)}), 500
+            body = {
+                "success": True,
+                "query": state["query"],
+                "response": "".join(chunks),
+                "hasPersonalData": bool(state["context"]),  # Let the client know if personal data was used
+                "username": state["username"]
+            }
+            embed_response_cache.put(username, version, cache_key, body)
+            store_semantic_answer(data, version, query_vector, body, state["context"])
+            yield sse_event("done", body)
+        except Exception as e:
+            print(f"Error streaming ask_embed response: {e}")
+            yield sse_event("error", {"error": str(e)})
+
+    return sse_response(events())
 
 @app.route('/store_memory', methods=['POST'])
+@invalidates_corpus
 def store_memory():
     """Stores confirmed memory in Pinecone."""
     try:
@@ -919,7 +1764,7 @@ def store_memory():
         print(f"[MEMORY STORAGE] Category: {memory_category}, Tags: {memory_tags}, Privacy: {privacy_level}")
         
         # Generate embedding for the memory
-        vector = embedding_model.encode(memory_text).tolist()
+        vector = embed_text(memory_text).tolist()
 
         # Generate a unique memory ID
         memory_id = f"memory_{user_id}_{str(uuid.uuid4())}"
@@ -927,8 +1772,8 @@ def store_memory():
         # Add importance score (default to 5 out of 10)
         importance_score = data.get("importance_score", 5)
 
-        # Store in Pinecone with metadata
-        index.upsert(vectors=[(
+        # Store in the vector store with metadata
+        get_vector_store().upsert([(
             memory_id, 
             vector, 
             {
@@ -943,6 +1788,7 @@ def store_memory():
                 "privacy_level": privacy_level
             }
         )])
+        flush_vector_writes([memory_id])
 
         print(f"[MEMORY STORAGE] Memory stored successfully with ID: {memory_id}")
 
@@ -1028,150 +1874,11 @@ def auto_categorize_memory(memory_text, memory_summary):
             
     return detected_category, detected_tags, privacy_level
 
-def retrieve_relevant_memories(query_text, query_vector, user_id, optimal_doc_count=3):
-    """Enhanced memory retrieval using a multi-stage approach."""
-    print(f"[MEMORY RETRIEVAL] Starting enhanced memory retrieval for user {user_id}")
-    
-    # Step 1: Extract key entities and concepts from the query
-    query_lower = query_text.lower()
-    query_categories = []
-    
-    # Check which categories might be relevant to this query
-    categories = {
-        "contact": ["email", "phone", "address", "contact", "number", "uid"],
-        "preference": ["prefer", "like", "dislike", "favorite", "hate"],
-        "personal": ["birthday", "age", "name", "family", "spouse", "child"],
-        "work": ["job", "work", "career", "company", "position", "role", "business"],
-        "education": ["university", "college", "school", "degree", "major", "study", "class"],
-        "health": ["allergy", "medication", "condition", "doctor", "health"],
-        "technical": ["software", "hardware", "version", "upgrade", "api", "code", "app", "application"],
-    }
-    
-    for category, keywords in categories.items():
-        for keyword in keywords:
-            if keyword in query_lower:
-                if category not in query_categories:
-                    query_categories.append(category)
-                    print(f"[MEMORY RETRIEVAL] Query matches category: {category}")
-    
-    # If no specific categories matched, we'll search everything
-    if not query_categories:
-        query_categories = ["general"]
-        print(f"[MEMORY RETRIEVAL] No specific category matched, using general search")
-    
-    # Step 2: Get memories by vector similarity
-    semantic_memories = []
-    
-    # First try to get category-specific memories
-    for category in query_categories:
-        if category != "general":
-            try:
-                category_filter = {
-                    "user_id": user_id, 
-                    "type": "memory",
-                    "category": category
-                }
-                
-                category_results = index.query(
-                    vector=query_vector,
-                    top_k=optimal_doc_count,
-                    include_metadata=True,
-                    filter=category_filter
-                )
-                
-                # Add category-specific results to our collection
-                for match in category_results.get("matches", []):
-                    # Add source to track where this came from
-                    match["source"] = f"category:{category}"
-                    semantic_memories.append(match)
-                    
-                print(f"[MEMORY RETRIEVAL] Found {len(category_results.get('matches', []))} memories in category {category}")
-            except Exception as e:
-                print(f"[MEMORY RETRIEVAL] Error querying category {category}: {e}")
-    
-    # Then get general memories (not category-specific)
-    try:
-        # Basic filter for user's memories
-        base_filter = {
-            "user_id": user_id, 
-            "type": "memory"
-        }
-        
-        # Get memories by semantic similarity
-        general_results = index.query(
-            vector=query_vector,
-            top_k=optimal_doc_count * 2,  # Get more, then we'll filter
-            include_metadata=True,
-            filter=base_filter
-        )
-        
-        for match in general_results.get("matches", []):
-            # Check if we already have this memory from a category search
-            if not any(m["id"] == match["id"] for m in semantic_memories):
-                match["source"] = "general"
-                semantic_memories.append(match)
-                
-        print(f"[MEMORY RETRIEVAL] Found {len(general_results.get('matches', []))} general memories")
-    except Exception as e:
-        print(f"[MEMORY RETRIEVAL] Error retrieving general memories: {e}")
-    
-    # Step 3: Add any critical high-importance memories regardless of query relevance
-    try:
-        important_filter = {
-            "user_id": user_id, 
-            "type": "memory",
-            "importance": {"$gte": 8}  # Only very important memories
-        }
-        
-        important_results = index.query(
-            vector=[0] * 768,  # Dummy vector, we'll filter by metadata
-            top_k=5,
-            include_metadata=True,
-            filter=important_filter
-        )
-        
-        for match in important_results.get("matches", []):
-            # Check if we already have this memory
-            if not any(m["id"] == match["id"] for m in semantic_memories):
-                match["source"] = "important"
-                semantic_memories.append(match)
-                
-        print(f"[MEMORY RETRIEVAL] Found {len(important_results.get('matches', []))} important memories")
-    except Exception as e:
-        print(f"[MEMORY RETRIEVAL] Error retrieving important memories: {e}")
-    
-    # Step 4: Rank and filter results
-    # Calculate a comprehensive score based on semantic similarity, importance, and recency
-    for memory in semantic_memories:
-        # Base score is the semantic similarity
-        base_score = memory.get("score", 0) 
-        
-        # Importance modifier (0.1 to 0.5 boost)
-        importance = memory["metadata"].get("importance", 5)
-        importance_modifier = importance / 20  # Scale from 0-10 to 0-0.5
-        
-        # Recency modifier - boost newer memories
-        timestamp_str = memory["metadata"].get("timestamp")
-        recency_modifier = 0
-        if timestamp_str:
-            try:
-                # Parse timestamp
-                timestamp = datetime.datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                # Calculate days since creation
-                days_old = (datetime.datetime.now() - timestamp).days
-                # Newer memories get a boost (max 0.3)
-                recency_modifier = max(0, 0.3 - (days_old / 100 * 0.3))
-            except Exception as e:
-                print(f"[MEMORY RETRIEVAL] Error calculating recency: {e}")
-        
-        # Calculate final score
-        memory["final_score"] = base_score + importance_modifier + recency_modifier
-        
-    # Sort by final score
-    semantic_memories.sort(key=lambda x: x.get("final_score", 0), reverse=True)
-    
-    # Limit to optimal number of documents
-    final_memories = semantic_memories[:optimal_doc_count]
+def rank_memories(query_text, candidates, user_id, optimal_doc_count=3):
+    """Select and rank memories locally from the candidates of the single memory query."""
+    final_memories = select_memories(
+        candidates, detect_query_categories(query_text), optimal_doc_count
+    )
     
     # Log retrieved memories
     if final_memories:
@@ -1187,8 +1894,145 @@ def retrieve_relevant_memories(query_text, query_vector, user_id, optimal_doc_co
     
     return final_memories
 
+def retrieve_relevant_memories(query_text, query_vector, user_id, optimal_doc_count=3):
+    """Memory retrieval with a single vector store round trip and local selection and ranking."""
+    print(f"[MEMORY RETRIEVAL] Starting enhanced memory retrieval for user {user_id}")
+    query_kwargs = memory_candidate_query(query_vector, user_id, optimal_doc_count)
+    candidate_results = run_queries_concurrently([("memories", query_kwargs)])[0]
+    return rank_memories(query_text, plain_matches(candidate_results), user_id, optimal_doc_count)
+
+def retrieval_specs(query_vector, user_id, doc_count, include_memories=True):
+    """The document query and, optionally, the memory candidate query for one retrieval."""
+    # Get regular user documents
+    specs = [("documents", {
+        "vector": query_vector,
+        "top_k": doc_count * 2,  # Get 2x optimal count for filtering
+        "include_metadata": True,
+        "filter": {"user_id": user_id}
+    })]
+    
+    # Memory retrieval needs a single candidate query, run alongside the document query
+    if include_memories:
+        specs.append(("memories", memory_candidate_query(query_vector, user_id, doc_count)))
+    return specs
+
+def plain_matches(query_results):
+    """Convert query results to a list of plain match dicts, in score order."""
+    if not query_results:
+        return []
+    
+    return [{
+        "id": match["id"],
+        "score": match["score"],
+        "values": match.get("values") or [],
+        "metadata": match.get("metadata") or {}
+    } for match in query_results["matches"]]
+
+# Speculative retrieval: documents and memories are fetched with the raw query's
+# embedding while analyze_query is still waiting on Gemini. Once the expanded query
+# is known, the two query embeddings are compared: if they are close, the
+# speculative results are used as they are; otherwise the exact queries are issued.
+# Only metadata is fetched, so the check costs no vector downloads.
+SPECULATIVE_RETRIEVAL = os.getenv('SPECULATIVE_RETRIEVAL', 'true').lower() == 'true'
+SPECULATIVE_SIMILARITY_THRESHOLD = float(os.getenv('SPECULATIVE_SIMILARITY_THRESHOLD', 0.9))
+MAX_DOCUMENT_COUNT = 15  # Upper bound of the DOCUMENT_COUNT chosen by analyze_query
+
+def start_speculative_retrieval(query_text, user_id, include_memories=True):
+    """Dispatch retrieval for the raw query with a generous top_k, without waiting for it."""
+    raw_vector = embed_text(query_text)
+    specs = retrieval_specs(raw_vector.tolist(), user_id, MAX_DOCUMENT_COUNT, include_memories)
+    futures, deadline = dispatch_queries(specs)
+    return {"vector": raw_vector, "specs": specs, "futures": futures, "deadline": deadline}
+
+def retrieve_context(query_text, query_vector, user_id, optimal_doc_count, include_memories=True, is_own_model=False, speculation=None):
+    """
+    Retrieve the user's documents and memories concurrently, re-rank them together
+    and return (texts of the top optimal_doc_count results, retrieval info).
+    speculation is the handle returned by start_speculative_retrieval, if any.
+    """
+    query_vector = np.asarray(query_vector, dtype=np.float32)
+    retrieval_info = {"speculative": speculation is not None}
+    
+    if speculation is None:
+        specs = retrieval_specs(query_vector.tolist(), user_id, optimal_doc_count, include_memories)
+        results = run_queries_concurrently(specs)
+        doc_matches = plain_matches(results[0])
+        memory_candidates = plain_matches(results[1]) if include_memories else []
+    else:
+        results = collect_query_results(speculation["specs"], speculation["futures"], speculation["deadline"])
+        
+        similarity = cosine_similarity(query_vector, speculation["vector"])
+        retrieval_info["similarity"] = round(similarity, 4)
+        retrieval_info["top_up"] = False
+        
+        # The small exact queries are issued only where needed: all of them if the
+        # expansion moved the query too far, otherwise the ones whose speculative
+        # counterpart failed
+        moved = similarity < SPECULATIVE_SIMILARITY_THRESHOLD
+        if moved:
+            results = [None] * len(results)
+        doc_matches = plain_matches(results[0])
+        memory_candidates = plain_matches(results[1]) if include_memories else []
+        
+        exact_specs = retrieval_specs(query_vector.tolist(), user_id, optimal_doc_count, include_memories)
+        top_up_specs = [spec for spec, result in zip(exact_specs, results) if result is None]
+        if top_up_specs:
+            top_up_results = dict(zip(
+                [label for label, _ in top_up_specs], run_queries_concurrently(top_up_specs)
+            ))
+            if "documents" in top_up_results:
+                doc_matches = plain_matches(top_up_results["documents"])
+            if "memories" in top_up_results:
+                memory_candidates = plain_matches(top_up_results["memories"])
+            retrieval_info["top_up"] = True
+            retrieval_info["top_up_queries"] = [label for label, _ in top_up_specs]
+        
+        # Keep the same document window a direct query would have returned
+        doc_matches = doc_matches[:optimal_doc_count * 2]
+    
+    memory_matches = []
+    if include_memories:
+        memory_matches = rank_memories(query_text, memory_candidates, user_id, optimal_doc_count)
+    
+    # Combine regular documents with prioritized memories. Memory type documents
+    # are skipped here - we get them from memory retrieval
+    all_matches = [
+        match for match in doc_matches
+        if match["metadata"].get("type") != "memory"
+    ]
+    final_scores = [match["score"] for match in all_matches]  # Base score for documents
+    
+    # Add memory matches, which already have their final_score calculated
+    all_matches.extend(memory_matches)
+    final_scores.extend(memory["final_score"] for memory in memory_matches)
+    
+    # PHASE 3: Re-rank all documents based on combined factors (stable, highest first)
+    order = np.argsort(-np.asarray(final_scores, dtype=np.float64), kind="stable")
+    
+    final_docs = []
+    for position in order:
+        match = all_matches[position]
+        
+        # For memory items, never surface explicit memory tags; skip private when not owner
+        if match["metadata"].get("type") == "memory":
+            privacy_level = match["metadata"].get("privacy_level", 0)
+            if not is_own_model and privacy_level > 0:
+                # Skip private memories for non-owners
+                continue
+        
+        final_docs.append(match["metadata"].get("text", ""))
+        
+        # Only keep top k most relevant documents
+        if len(final_docs) >= optimal_doc_count:
+            break
+    
+    return final_docs, retrieval_info
+
 if __name__ == '__main__':
     # Get port from environment variable (Railway sets this) or default to 8080
     port = int(os.getenv('PORT', 8080))
+    # Exit normally on SIGTERM so atexit handlers (the vector write buffer) run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_warmup()
     print(f"Starting server on 0.0.0.0:{port}")
     serve(app, host="0.0.0.0", port=port)
\ No newline at end of file
@@ -0,0 +1,17 @@
+import os
+
+def test_requests_with_different_personas_are_not_coalesced(monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", os.getenv("GOOGLE_API_KEY", "test-key"))
+    import llama_service
+
+    request = {"username": "alice", "query": "Where do you work?", "apiKey": "key-1",
+               "name": "Alice", "selfAssessment": "Formal and brief", "chatHistory": []}
+    same = dict(request, query="  where do you WORK? ")
+    renamed = dict(request, name="Ally")
+    reassessed = dict(request, selfAssessment="Casual and chatty")
+
+    key = llama_service.ask_embed_flight_key(request)
+    assert llama_service.ask_embed_flight_key(same) == key
+    assert llama_service.ask_embed_flight_key(renamed) != key
+    assert llama_service.ask_embed_flight_key(reassessed) != key
+    assert llama_service.embed_response_key(reassessed) != llama_service.embed_response_key(request)
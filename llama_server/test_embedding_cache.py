@@ -0,0 +1,81 @@
+import numpy as np
+
+from utils.embedding_cache import EmbeddingCache
+
+MODEL = "all-MiniLM-L6-v2"
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class CountingModel:
+    """Encodes text as [length, 0, 0, 0] and records what it was asked to embed."""
+
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, texts, **kwargs):
+        self.calls.append(list(texts))
+        return np.array([[len(text), 0, 0, 0] for text in texts], dtype=np.float32)
+
+def vector(value):
+    return np.array([value, 0, 0, 0], dtype=np.float32)
+
+def test_keys_normalize_whitespace_and_include_the_model():
+    cache = EmbeddingCache()
+    cache.put("  where do\tyou\n work? ", MODEL, vector(1))
+
+    assert cache.get("where do you work?", MODEL)[0] == 1
+    assert cache.get("Where do you work?", MODEL) is None
+    assert cache.get("where do you work?", "other-model") is None
+
+def test_hit_and_miss_counters():
+    cache = EmbeddingCache()
+    assert cache.get("hello", MODEL) is None
+    cache.put("hello", MODEL, vector(1))
+    cache.get("hello", MODEL)
+    cache.get("hello ", MODEL)
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (2, 1, 0.6667)
+    assert (stats["entries"], stats["bytes"]) == (1, 16)
+
+def test_least_recently_used_entries_are_evicted_first():
+    cache = EmbeddingCache(max_bytes=32)  # room for two 4-float vectors
+    cache.put("a", MODEL, vector(1))
+    cache.put("b", MODEL, vector(2))
+    cache.get("a", MODEL)
+    cache.put("c", MODEL, vector(3))
+
+    assert cache.get("b", MODEL) is None
+    assert cache.get("a", MODEL)[0] == 1
+    assert cache.get("c", MODEL)[0] == 3
+    stats = cache.stats()
+    assert (stats["evictions"], stats["entries"], stats["bytes"]) == (1, 2, 32)
+
+def test_entries_expire_after_the_ttl():
+    clock = FakeClock()
+    cache = EmbeddingCache(ttl_seconds=10, clock=clock)
+    cache.put("hello", MODEL, vector(1))
+    clock.now = 10
+    assert cache.get("hello", MODEL) is not None
+    clock.now = 10.5
+    assert cache.get("hello", MODEL) is None
+    assert cache.stats()["entries"] == 0
+
+def test_encode_embeds_each_missing_text_once():
+    cache = EmbeddingCache()
+    model = CountingModel()
+    cache.put("cached", MODEL, vector(99))
+
+    vectors = cache.encode(["abc", "cached", "abc ", "de"], model, MODEL)
+    assert model.calls == [["abc", "de"]]
+    assert vectors[:, 0].tolist() == [3, 99, 3, 2]
+
+    cache.encode(["de", "abc"], model, MODEL)
+    assert len(model.calls) == 1
+    # Cached vectors are handed out shared, so they must be read-only
+    assert not cache.get("abc", MODEL).flags.writeable
@@ -0,0 +1,246 @@
+import multiprocessing
+import random
+import threading
+import time
+from collections import Counter
+
+from google.api_core.exceptions import ResourceExhausted
+
+from utils.gemini_client import ACTIVE_API_KEY
+from utils.gemini_key_manager import GeminiKeyManager, load_api_keys_from_env, retry_delay_from_error
+from utils.key_state_store import SqliteKeyState
+
+RATE_LIMIT = 5
+RATE_WINDOW = 60
+KEYS = ["key-a", "key-b", "key-c"]
+
+class FakeClock:
+    """Thread-safe fake monotonic clock; sleeping advances it instead of blocking."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += seconds
+        time.sleep(0)  # Let other threads run
+
+class RecordingKeyManager(GeminiKeyManager):
+    """Key manager that logs every slot it hands out, to check the window afterwards."""
+
+    def __init__(self, *args, **kwargs):
+        self.grants = []
+        super().__init__(*args, **kwargs)
+
+    def _record_locked(self, key, now):
+        self.grants.append((key, now))
+        super()._record_locked(key, now)
+
+class FakeGeminiClient:
+    """Stands in for a Gemini call; every fail_every-th call hits a quota error."""
+
+    def __init__(self, fail_every=None):
+        self.fail_every = fail_every
+        self.calls = 0
+        self.quota_errors = 0
+        self.keys_used = Counter()
+        self._lock = threading.Lock()
+
+    def generate(self, prompt):
+        # The key a model built inside this call would send requests with
+        api_key = ACTIVE_API_KEY.get()
+        with self._lock:
+            self.calls += 1
+            self.keys_used[api_key] += 1
+            if self.fail_every and self.calls % self.fail_every == 0:
+                self.quota_errors += 1
+                raise Exception("429 Resource has been exhausted (e.g. check quota).")
+        return f"response to {prompt}"
+
+def make_manager(clock, keys=KEYS, **kwargs):
+    return RecordingKeyManager(keys, rate_limit=RATE_LIMIT, rate_window=RATE_WINDOW,
+                               clock=clock, sleep=clock.sleep, rng=random.Random(3), **kwargs)
+
+def assert_window_respected(grants):
+    """No key may hand out more than RATE_LIMIT slots within any RATE_WINDOW."""
+    by_key = {}
+    for key, granted_at in grants:
+        by_key.setdefault(key, []).append(granted_at)
+    for times in by_key.values():
+        times.sort()
+        for i in range(len(times) - RATE_LIMIT):
+            assert times[i + RATE_LIMIT] - times[i] >= RATE_WINDOW
+
+def test_concurrent_calls_never_exceed_the_window():
+    clock = FakeClock()
+    manager = make_manager(clock, acquire_timeout=None)
+    client = FakeGeminiClient(fail_every=7)
+    generate = manager.with_key_rotation(client.generate)
+
+    threads_count, calls_per_thread = 12, 10
+    results = []
+    errors = []
+    results_lock = threading.Lock()
+    start_time = clock()
+
+    def worker(worker_id):
+        for i in range(calls_per_thread):
+            try:
+                response = generate(f"{worker_id}-{i}")
+                with results_lock:
+                    results.append(response)
+            except Exception as e:
+                with results_lock:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    total = threads_count * calls_per_thread
+    assert not errors
+    assert len(results) == total
+    # Every call, including the retries after quota errors, took its own slot
+    assert len(manager.grants) == client.calls == total + client.quota_errors
+    # Each call ran with the key it was granted, not whichever key another thread set
+    assert client.keys_used == Counter(key for key, _ in manager.grants)
+    assert ACTIVE_API_KEY.get() is None
+    assert_window_respected(manager.grants)
+
+    # Callers blocked for free slots rather than getting a limited key
+    full_windows = (len(manager.grants) - 1) // (RATE_LIMIT * len(KEYS))
+    assert clock() - start_time >= full_windows * RATE_WINDOW
+    assert manager.waits > 0
+
+def test_acquire_waits_for_the_earliest_slot():
+    clock = FakeClock()
+    manager = make_manager(clock)
+
+    for i in range(RATE_LIMIT * len(KEYS)):
+        assert manager.acquire(timeout=0) is not None
+        clock.sleep(1)
+    assert manager.acquire(timeout=0) is None
+
+    # The first key's oldest request leaves the window at start + RATE_WINDOW
+    start = manager.grants[0][1]
+    assert manager.acquire(timeout=RATE_WINDOW / 2) is None
+    assert manager.acquire(timeout=RATE_WINDOW) == KEYS[0]
+    assert clock() == start + RATE_WINDOW
+    assert manager.timeouts == 2
+
+def test_acquire_picks_the_key_with_most_headroom():
+    clock = FakeClock()
+    manager = make_manager(clock)
+    for key in ["key-a", "key-a", "key-a", "key-b"]:
+        manager.record_request(key)
+
+    assert manager.acquire(timeout=0) == "key-c"
+    assert manager.acquire(timeout=0) == "key-b"
+    assert manager.stats()["headroom"] == [2, 3, 4]
+
+def test_rate_limited_key_cools_down_for_the_retry_delay():
+    clock = FakeClock()
+    manager = make_manager(clock, keys=["key-a"])
+    calls = []
+
+    @manager.with_key_rotation
+    def generate(prompt):
+        calls.append(clock())
+        if len(calls) == 1:
+            raise ResourceExhausted("Quota exceeded. Please retry in 20s.")
+        return "ok"
+
+    assert generate("hello") == "ok"
+    # The retry waited out the cooldown instead of failing or hammering the key
+    assert 20 <= calls[1] - calls[0] <= 22
+    assert manager.stats()["cooldowns"] == 1
+    assert manager.strikes["key-a"] == 0
+
+def test_cooldown_backs_off_exponentially_with_jitter():
+    clock = FakeClock()
+    manager = make_manager(clock, base_cooldown=5, max_cooldown=60)
+
+    cooldowns = [manager.report_rate_limit("key-a") for _ in range(6)]
+    for strike, cooldown in enumerate(cooldowns):
+        backoff = min(60, 5 * 2 ** strike)
+        assert backoff / 2 <= cooldown <= backoff
+    assert manager.acquire(timeout=0) in ("key-b", "key-c")
+
+    manager.report_success("key-a")
+    assert 2.5 <= manager.report_rate_limit("key-a") <= 5
+
+def test_other_errors_are_not_retried():
+    manager = make_manager(FakeClock())
+    calls = []
+
+    @manager.with_key_rotation
+    def generate(prompt):
+        calls.append(prompt)
+        raise ValueError("invalid prompt")
+
+    try:
+        generate("hello")
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+    assert len(calls) == 1
+    assert manager.stats()["cooldowns"] == 0
+
+def test_retry_delay_parsing():
+    assert retry_delay_from_error(Exception("429 retry_delay { seconds: 17 }")) == 17
+    assert retry_delay_from_error(Exception("Please retry in 2.5s.")) == 2.5
+    assert retry_delay_from_error(Exception("quota exceeded")) is None
+
+def test_keys_load_from_list_and_numbered_variables():
+    environ = {
+        "GOOGLE_API_KEYS": "k1, k2,,",
+        "GOOGLE_API_KEY": "k0",
+        "GOOGLE_API_KEY_12": "k12",
+        "GOOGLE_API_KEY_2": "k2",
+        "GOOGLE_API_KEY_3": "k3",
+    }
+    assert load_api_keys_from_env(environ) == ["k1", "k2", "k0", "k3", "k12"]
+
+def test_shared_state_is_seen_by_every_manager(tmp_path):
+    clock = FakeClock()
+    path = str(tmp_path / "keys.db")
+    worker_a = make_manager(clock, keys=["key-a"], shared_state=SqliteKeyState(path, rate_window=RATE_WINDOW))
+    worker_b = make_manager(clock, keys=["key-a"], shared_state=SqliteKeyState(path, rate_window=RATE_WINDOW))
+
+    for _ in range(RATE_LIMIT - 1):
+        assert worker_a.acquire(timeout=0) == "key-a"
+    assert worker_b.acquire(timeout=0) == "key-a"
+    # Together the two workers used up the key
+    assert worker_a.acquire(timeout=0) is None
+    assert worker_b.acquire(timeout=0) is None
+
+    clock.sleep(RATE_WINDOW)
+    worker_a.report_rate_limit("key-a", retry_delay=30)
+    assert worker_b.stats()["cooling_down_for"][0] >= 30
+    assert worker_b.acquire(timeout=0) is None
+    assert worker_b.acquire(timeout=35) == "key-a"
+
+def _acquire_in_process(path, results):
+    manager = GeminiKeyManager(["key-a", "key-b"], rate_limit=3, rate_window=30,
+                               shared_state=SqliteKeyState(path, rate_window=30), clock=time.time)
+    results.put(sum(1 for _ in range(5) if manager.acquire(timeout=0)))
+
+def test_worker_processes_share_the_quota(tmp_path):
+    path = str(tmp_path / "keys.db")
+    SqliteKeyState(path)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_acquire_in_process, args=(path, results)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    # 4 processes asked for 20 slots; 2 keys at 3 per window allow exactly 6
+    assert sum(results.get() for _ in processes) == 6
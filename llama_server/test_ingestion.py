@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils.vector_store import LocalVectorStore
+
+class WordSplitter:
+    """Stands in for the tokenizer-bounded splitter: a chunk per three words."""
+
+    def split_text(self, text):
+        words = text.split()
+        return [" ".join(words[i:i+3]) for i in range(0, len(words), 3)]
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", os.getenv("GOOGLE_API_KEY", "test-key"))
+    import llama_service
+
+    embedded = []
+    def fake_embed_texts(texts):
+        embedded.extend(texts)
+        return np.array([[len(text), 1] + [0] * (llama_service.EMBEDDING_DIMENSION - 2) for text in texts],
+                        dtype=np.float32)
+
+    monkeypatch.setattr(llama_service, "_vector_store", LocalVectorStore(dimension=llama_service.EMBEDDING_DIMENSION))
+    monkeypatch.setattr(llama_service, "_text_splitter", WordSplitter())
+    monkeypatch.setattr(llama_service, "CHUNK_TOKENS", 20)
+    monkeypatch.setattr(llama_service, "embed_texts", fake_embed_texts)
+    monkeypatch.setattr(llama_service, "embedded", embedded, raising=False)  # texts sent to the model
+    return llama_service
+
+def words(count):
+    return " ".join(f"word{i}" for i in range(count))
+
+def test_chunk_ids_are_stable_and_short_documents_keep_their_id(service):
+    metadata = {"text": words(7), "user_id": "alice"}
+    chunks = service.chunk_document("doc_alice_notes", words(7), metadata)
+
+    assert [chunk_id for chunk_id, _, _ in chunks] == [
+        "doc_alice_notes", "doc_alice_notes_chunk_1", "doc_alice_notes_chunk_2"
+    ]
+    assert chunks == service.chunk_document("doc_alice_notes", words(7), metadata)
+    assert [(meta["parent_id"], meta["chunk_index"], meta["chunk_count"]) for _, _, meta in chunks] == [
+        ("doc_alice_notes", 0, 3), ("doc_alice_notes", 1, 3), ("doc_alice_notes", 2, 3)
+    ]
+    assert chunks[1][2]["text"] == "word3 word4 word5"
+    # The caller's metadata is not modified
+    assert metadata == {"text": words(7), "user_id": "alice"}
+
+    assert service.chunk_document("doc_alice_bio", "short bio", {"text": "short bio"}) == [
+        ("doc_alice_bio", "short bio", {"text": "short bio"})
+    ]
+
+def test_ingested_chunks_are_stored_under_their_ids(service):
+    written = service.ingest_documents([("doc_alice_notes", words(7), {"text": words(7), "user_id": "alice"})])
+
+    assert written == 3
+    stored = service.get_vector_store().fetch(["doc_alice_notes", "doc_alice_notes_chunk_1", "doc_alice_notes_chunk_2"])
+    assert stored["doc_alice_notes_chunk_2"]["metadata"]["text"] == "word6"
+    assert service.embedded == ["word0 word1 word2", "word3 word4 word5", "word6"]
+
+def smart_document(document_id, text):
+    return (document_id, text, {"text": text, "user_id": "alice"})
+
+def test_unchanged_documents_are_not_embedded_again(service):
+    documents = [smart_document("doc_alice_bio", "short bio"), smart_document("doc_alice_notes", words(7))]
+    assert service.ingest_smart_documents(documents) == (["doc_alice_bio", "doc_alice_notes"], [])
+    service.embedded.clear()
+
+    documents = [smart_document("doc_alice_bio", "short bio"), smart_document("doc_alice_notes", words(7))]
+    assert service.ingest_smart_documents(documents) == ([], ["doc_alice_bio", "doc_alice_notes"])
+    assert service.embedded == []
+
+    documents = [smart_document("doc_alice_bio", "longer bio"), smart_document("doc_alice_notes", words(7))]
+    assert service.ingest_smart_documents(documents) == (["doc_alice_bio"], ["doc_alice_notes"])
+    assert service.embedded == ["longer bio"]
+
+    documents = [smart_document("doc_alice_notes", words(7))]
+    assert service.ingest_smart_documents(documents, force=True) == (["doc_alice_notes"], [])
+
+def test_chunks_of_a_longer_previous_version_are_deleted(service):
+    service.ingest_smart_documents([smart_document("doc_alice_notes", words(10))])
+    store = service.get_vector_store()
+    assert len(store.list_by_user("alice")) == 4
+
+    service.ingest_smart_documents([smart_document("doc_alice_notes", words(5))])
+    assert sorted(item["id"] for item in store.list_by_user("alice")) == [
+        "doc_alice_notes", "doc_alice_notes_chunk_1"
+    ]
+    assert store.fetch(["doc_alice_notes"])["doc_alice_notes"]["metadata"]["chunk_count"] == 2
+
+    # Shrinking to a single unsplit document removes every chunk
+    service.ingest_smart_documents([smart_document("doc_alice_notes", "short notes")])
+    assert [item["id"] for item in store.list_by_user("alice")] == ["doc_alice_notes"]
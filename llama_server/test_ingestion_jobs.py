@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+
+from utils.ingestion_jobs import IngestionJobs, IngestionQueueFull
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def wait_until_finished(jobs, job_id):
+    for _ in range(500):
+        status = jobs.status(job_id)
+        if status["status"] not in ("queued", "running"):
+            return status
+        time.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+def make_jobs(**kwargs):
+    kwargs.setdefault("sleep", lambda seconds: None)
+    return IngestionJobs(**kwargs)
+
+def test_failing_slices_are_retried_with_the_same_items():
+    jobs = make_jobs(max_retries=2)
+    attempts = []
+    stored = {}
+
+    def process(batch):
+        attempts.append(list(batch))
+        stored.update(batch)  # Writes by ID, so a retry overwrites
+        if len(attempts) < 3:
+            raise RuntimeError("upsert timed out")
+        return {"vectors": len(batch)}
+
+    items = [(0, ("doc_a", 1)), (1, ("doc_b", 2))]
+    status = wait_until_finished(jobs, jobs.submit("alice", items, process, result={"document_ids": ["doc_a", "doc_b"]}))
+
+    assert attempts == [[("doc_a", 1), ("doc_b", 2)]] * 3
+    assert stored == {"doc_a": 1, "doc_b": 2}
+    assert status["status"] == "succeeded"
+    assert (status["processed"], status["failed"], status["retries"]) == (2, 0, 2)
+    assert status["counts"] == {"vectors": 2}
+    assert status["document_ids"] == ["doc_a", "doc_b"]
+
+def test_slices_that_keep_failing_become_item_errors():
+    jobs = make_jobs(max_retries=1)
+
+    def process(batch):
+        if "bad" in batch:
+            raise ValueError("payload too large")
+
+    items = [(0, "ok"), (2, "ok"), (3, "bad"), (5, "ok")]
+    job_id = jobs.submit("alice", items, process, slice_size=2, errors=[{"index": 1, "error": "No document provided"}])
+    status = wait_until_finished(jobs, job_id)
+
+    assert status["status"] == "partially_failed"
+    assert (status["total"], status["processed"], status["failed"]) == (5, 2, 3)
+    assert status["errors"] == [
+        {"index": 1, "error": "No document provided"},
+        {"index": 3, "error": "payload too large"},
+        {"index": 5, "error": "payload too large"},
+    ]
+    assert jobs.status(job_id, user_id="bob") is None
+
+def test_resubmitting_a_key_reuses_only_a_job_in_progress():
+    jobs = make_jobs(workers=1)
+    release = threading.Event()
+    runs = []
+
+    def process(batch):
+        release.wait(5)
+        runs.append(list(batch))
+
+    first = jobs.submit("alice", [(0, "doc")], process, key="onboarding")
+    assert jobs.submit("alice", [(0, "doc")], process, key="onboarding") == first
+    assert jobs.submit("bob", [(0, "doc")], process, key="onboarding") != first
+    release.set()
+    wait_until_finished(jobs, first)
+
+    # A finished job does not block ingesting the same content again
+    again = jobs.submit("alice", [(0, "doc")], process, key="onboarding")
+    assert again != first
+    wait_until_finished(jobs, again)
+    assert runs.count(["doc"]) == 3
+
+def test_resubmitting_a_partially_failed_job_retries_only_its_failed_items():
+    jobs = make_jobs(max_retries=0)
+    stored = []
+    failing = {"b"}
+
+    def process(batch):
+        if failing & set(batch):
+            raise ConnectionError("upsert timed out")
+        stored.extend(batch)
+
+    items = [(0, "a"), (1, "b"), (2, "c")]
+    first = wait_until_finished(jobs, jobs.submit("alice", items, process, slice_size=1, key="k"))
+    assert first["status"] == "partially_failed"
+
+    failing.clear()
+    retry = wait_until_finished(jobs, jobs.submit("alice", items, process, slice_size=1, key="k"))
+    assert retry["status"] == "succeeded"
+    assert (retry["total"], retry["processed"], retry["retry_of"]) == (1, 1, first["job_id"])
+    assert stored == ["a", "c", "b"]
+
+def test_full_queue_rejects_and_finished_jobs_expire():
+    clock = FakeClock()
+    jobs = make_jobs(workers=1, max_queued=1, ttl_seconds=60, clock=clock)
+    release = threading.Event()
+
+    running = jobs.submit("alice", [(0, "doc")], lambda batch: {"waited": int(release.wait(5))})
+    while jobs.status(running)["status"] == "queued":
+        time.sleep(0.001)
+    queued = jobs.submit("alice", [(0, "doc")], lambda batch: None)
+    with pytest.raises(IngestionQueueFull):
+        jobs.submit("alice", [(0, "doc")], lambda batch: None)
+    assert jobs.stats()["rejected"] == 1
+
+    release.set()
+    wait_until_finished(jobs, queued)
+    clock.now = 61
+    assert jobs.status(running) is None
+    assert jobs.status(queued) is None
@@ -1,11 +1,11 @@
 import time
-import google.generativeai as genai
+from utils.gemini_client import gemini_model
 from utils.gemini_key_manager import key_manager, with_key_rotation
 
 # Function to make a Gemini API call with key rotation
 @with_key_rotation
 def generate_response(prompt):
-    model = genai.GenerativeModel("gemini-1.5-flash")
+    model = gemini_model("gemini-1.5-flash")
     response = model.generate_content([prompt])
     return response.text
 
@@ -0,0 +1,129 @@
+import datetime
+import random
+
+from utils.memory_retrieval import detect_query_categories, memory_candidate_query, select_memories
+
+NOW = datetime.datetime(2025, 6, 1, 12, 0, 0)
+DIMENSION = 16
+CATEGORIES = ["contact", "preference", "personal", "work", "education", "health", "technical", "general"]
+
+def _cosine(vec1, vec2):
+    dot_product = sum(a * b for a, b in zip(vec1, vec2))
+    norm1 = sum(a * a for a in vec1) ** 0.5
+    norm2 = sum(b * b for b in vec2) ** 0.5
+    if norm1 == 0 or norm2 == 0:
+        return 0
+    return dot_product / (norm1 * norm2)
+
+class FakeIndex:
+    """Minimal stand-in for a Pinecone index: cosine scores and equality/$gte filters."""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+        self.query_count = 0
+
+    def query(self, vector, top_k, include_metadata=True, filter=None):
+        self.query_count += 1
+        matches = []
+        for vector_id, (values, metadata) in self.vectors.items():
+            if not all(
+                metadata.get(key, 0) >= value["$gte"] if isinstance(value, dict) else metadata.get(key) == value
+                for key, value in (filter or {}).items()
+            ):
+                continue
+            matches.append({"id": vector_id, "score": _cosine(vector, values), "metadata": dict(metadata)})
+        matches.sort(key=lambda m: m["score"], reverse=True)
+        return {"matches": matches[:top_k]}
+
+def legacy_retrieve_relevant_memories(index, query_text, query_vector, user_id, optimal_doc_count):
+    """The multi-query implementation that select_memories replaces, kept as the reference ranking."""
+    query_categories = detect_query_categories(query_text) or ["general"]
+    semantic_memories = []
+
+    for category in query_categories:
+        if category != "general":
+            results = index.query(vector=query_vector, top_k=optimal_doc_count, include_metadata=True,
+                                  filter={"user_id": user_id, "type": "memory", "category": category})
+            for match in results["matches"]:
+                semantic_memories.append(match)
+
+    results = index.query(vector=query_vector, top_k=optimal_doc_count * 2, include_metadata=True,
+                          filter={"user_id": user_id, "type": "memory"})
+    for match in results["matches"]:
+        if not any(m["id"] == match["id"] for m in semantic_memories):
+            semantic_memories.append(match)
+
+    results = index.query(vector=[0] * len(query_vector), top_k=5, include_metadata=True,
+                          filter={"user_id": user_id, "type": "memory", "importance": {"$gte": 8}})
+    for match in results["matches"]:
+        if not any(m["id"] == match["id"] for m in semantic_memories):
+            semantic_memories.append(match)
+
+    for memory in semantic_memories:
+        importance_modifier = memory["metadata"].get("importance", 5) / 20
+        timestamp = datetime.datetime.fromisoformat(memory["metadata"]["timestamp"])
+        recency_modifier = max(0, 0.3 - ((NOW - timestamp).days / 100 * 0.3))
+        memory["final_score"] = memory.get("score", 0) + importance_modifier + recency_modifier
+
+    semantic_memories.sort(key=lambda x: x.get("final_score", 0), reverse=True)
+    return semantic_memories[:optimal_doc_count]
+
+def build_fixture_corpus(seed=7, memories=40):
+    """Random memories for two users; at most five of alice's are critical (importance >= 8)."""
+    rng = random.Random(seed)
+    vectors = {}
+    for user_id in ("alice", "bob"):
+        critical_left = 5
+        for i in range(memories):
+            importance = rng.randint(1, 10)
+            if importance >= 8:
+                if critical_left > 0:
+                    critical_left -= 1
+                else:
+                    importance = 7
+            vectors[f"memory_{user_id}_{i}"] = (
+                [rng.uniform(-1, 1) for _ in range(DIMENSION)],
+                {
+                    "text": f"memory {i} of {user_id}",
+                    "user_id": user_id,
+                    "type": "memory",
+                    "category": CATEGORIES[i % len(CATEGORIES)],
+                    "importance": importance,
+                    "timestamp": (NOW - datetime.timedelta(days=rng.randint(0, 150))).isoformat()
+                }
+            )
+        # A regular document must never be picked up by memory retrieval
+        vectors[f"doc_{user_id}_0"] = ([1.0] * DIMENSION, {"text": "doc", "user_id": user_id})
+    return vectors
+
+def test_single_query_matches_legacy_ranking():
+    index = FakeIndex(build_fixture_corpus())
+    rng = random.Random(11)
+    queries = [
+        "what is your job and email",
+        "which school did you study at",
+        "tell me about yourself",
+        "do you like python code",
+        "any health or family news",
+    ]
+
+    for query_text in queries:
+        for optimal_doc_count in (1, 3, 5, 10):
+            query_vector = [rng.uniform(-1, 1) for _ in range(DIMENSION)]
+            expected = legacy_retrieve_relevant_memories(index, query_text, query_vector, "alice", optimal_doc_count)
+
+            index.query_count = 0
+            candidates = index.query(**memory_candidate_query(query_vector, "alice", optimal_doc_count))["matches"]
+            actual = select_memories(candidates, detect_query_categories(query_text), optimal_doc_count, now=NOW)
+
+            assert index.query_count == 1
+            assert [m["id"] for m in actual] == [m["id"] for m in expected]
+            for got, want in zip(actual, expected):
+                assert abs(got["final_score"] - want["final_score"]) < 1e-9
+
+def test_selection_only_returns_own_memories():
+    index = FakeIndex(build_fixture_corpus())
+    candidates = index.query(**memory_candidate_query([0.5] * DIMENSION, "bob", 5))["matches"]
+    selected = select_memories(candidates, [], 5, now=NOW)
+    assert selected
+    assert all(m["id"].startswith("memory_bob_") for m in selected)
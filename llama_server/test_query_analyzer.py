@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils.query_analyzer import LocalQueryAnalyzer
+
+# Keywords that place a text on one axis of the fake embedding space, one axis per
+# prototype class (greetings, facts, overviews)
+AXES = [
+    {"hi", "hello", "thanks", "morning", "how"},
+    {"who", "name", "work", "email", "study", "job"},
+    {"tell", "projects", "summarize", "skills", "describe", "written", "career"},
+]
+
+def fake_embed(texts):
+    """Embed by keyword counts per class, plus a small shared component."""
+    vectors = []
+    for text in texts:
+        words = set(text.lower().replace("?", "").replace("!", "").split())
+        vectors.append([0.1 + len(words & axis) for axis in AXES])
+    return np.array(vectors, dtype=np.float32)
+
+def test_short_self_contained_queries_are_classified_locally():
+    analyzer = LocalQueryAnalyzer(fake_embed)
+
+    assert analyzer.analyze("hello!") == ("hello!", 2)
+    assert analyzer.analyze("where do you work?") == ("where do you work?", 3)
+    assert analyzer.analyze("describe your projects and skills") == ("describe your projects and skills", 8)
+    # Words that could refer back only matter when there is a history
+    assert analyzer.analyze("what is your job too?") == ("what is your job too?", 3)
+    assert analyzer.stats()["local_decisions"] == 4
+
+def test_unsure_or_complex_queries_fall_back_to_the_llm():
+    analyzer = LocalQueryAnalyzer(fake_embed, max_words=8)
+
+    assert analyzer.analyze("?!") is None
+    assert analyzer.analyze("tell me everything about each project you have ever built") is None
+    assert analyzer.analyze("why did you change your job?") is None
+    assert analyzer.analyze("who are you? where do you work?") is None
+    assert analyzer.analyze("what did they say?", conversation_history="User: who is your manager?") is None
+    # Equally close to two classes
+    assert analyzer.analyze("tell me your name") is None
+    # Close to nothing
+    assert analyzer.analyze("quantum pizza") is None
+
+    stats = analyzer.stats()
+    assert stats["local_decisions"] == 0
+    assert stats["fallback_reasons"] == {
+        "empty": 1, "long": 1, "complex": 2, "refers_to_history": 1, "low_confidence": 2
+    }
+
+def test_tiered_analysis_calls_gemini_when_the_local_tier_declines(monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", os.getenv("GOOGLE_API_KEY", "test-key"))
+    import llama_service
+
+    calls = []
+    monkeypatch.setattr(llama_service, "local_query_analyzer", LocalQueryAnalyzer(fake_embed))
+    monkeypatch.setattr(llama_service, "analyze_query",
+                        lambda query, history="": calls.append(query) or ("expanded " + query, 5))
+
+    assert llama_service.analyze_query_tiered("where do you work?") == ("where do you work?", 3)
+    assert llama_service.analyze_query_tiered("why did you change your job?") == ("expanded why did you change your job?", 5)
+
+    def broken_embed(texts):
+        raise RuntimeError("model not loaded")
+    monkeypatch.setattr(llama_service, "local_query_analyzer", LocalQueryAnalyzer(broken_embed))
+    assert llama_service.analyze_query_tiered("where do you work?") == ("expanded where do you work?", 5)
+    assert calls == ["why did you change your job?", "where do you work?"]
+
+def test_rate_limits_reach_key_rotation_and_other_errors_use_the_defaults(monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", os.getenv("GOOGLE_API_KEY", "test-key"))
+    import llama_service
+
+    class FailingModel:
+        def __init__(self, error):
+            self.error = error
+
+        def generate_content(self, parts):
+            raise self.error
+
+    # The undecorated function, so the key manager does not wait out the cooldown
+    analyze = llama_service.analyze_query.__wrapped__
+    monkeypatch.setattr(llama_service, "gemini_model", lambda: FailingModel(Exception("429 Resource has been exhausted")))
+    with pytest.raises(Exception):
+        analyze("where do you work?")
+
+    monkeypatch.setattr(llama_service, "gemini_model", lambda: FailingModel(ValueError("bad response")))
+    assert analyze("where do you work?") == ("where do you work?", 3)
+
+    # Once rotation gives up, the tiered analysis still answers with the raw query
+    def rate_limited(query, history=""):
+        raise Exception("All API keys are rate limited")
+    monkeypatch.setattr(llama_service, "LOCAL_QUERY_ANALYZER", False)
+    monkeypatch.setattr(llama_service, "analyze_query", rate_limited)
+    assert llama_service.analyze_query_tiered("where do you work?") == ("where do you work?", 3)
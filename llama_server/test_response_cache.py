@@ -0,0 +1,59 @@
+from utils.corpus_versions import SqliteCorpusVersions
+from utils.response_cache import ResponseCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_bump_invalidates_only_that_user():
+    cache = ResponseCache()
+    key = ResponseCache.make_key("alice", "who are you?")
+    cache.put("alice", cache.version("alice"), key, {"response": "I am Alice"})
+    cache.put("bob", cache.version("bob"), key, {"response": "I am Bob"})
+
+    cache.bump("alice")
+    assert cache.get("alice", cache.version("alice"), key) is None
+    assert cache.get("bob", cache.version("bob"), key) == {"response": "I am Bob"}
+    assert cache.stats()["invalidations"] == 1
+
+def test_answer_computed_across_a_bump_is_not_stored():
+    cache = ResponseCache()
+    key = ResponseCache.make_key("alice", "who are you?")
+
+    version = cache.version("alice")  # Answer starts
+    cache.bump("alice")  # A document is stored meanwhile
+    cache.put("alice", version, key, {"response": "stale"})
+
+    assert cache.get("alice", version, key) is None
+    assert cache.get("alice", cache.version("alice"), key) is None
+
+def test_entries_expire_and_are_evicted_lru():
+    clock = FakeClock()
+    cache = ResponseCache(max_entries=2, ttl_seconds=10, clock=clock)
+    for query in ("a", "b"):
+        cache.put("alice", 0, query, query)
+    assert cache.get("alice", 0, "a") == "a"  # "b" is now least recently used
+
+    cache.put("alice", 0, "c", "c")
+    assert cache.get("alice", 0, "b") is None
+    assert cache.stats()["evictions"] == 1
+
+    clock.now = 11
+    assert cache.get("alice", 0, "a") is None
+    assert cache.get("alice", 0, "c") is None
+
+def test_shared_versions_invalidate_other_workers(tmp_path):
+    path = str(tmp_path / "corpus_versions.db")
+    worker_a = ResponseCache(versions=SqliteCorpusVersions(path))
+    worker_b = ResponseCache(versions=SqliteCorpusVersions(path))
+    key = ResponseCache.make_key("alice", "who are you?")
+    worker_b.put("alice", worker_b.version("alice"), key, {"response": "I am Alice"})
+    assert worker_b.get("alice", worker_b.version("alice"), key) == {"response": "I am Alice"}
+
+    worker_a.bump("alice")  # A document is stored through the other worker
+    assert worker_b.version("alice") == 1
+    assert worker_b.get("alice", 0, key) is None
+    assert worker_b.get("alice", worker_b.version("alice"), key) is None
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils.vector_store import LocalVectorStore
+
+DIMENSION = 4
+
+class FlakyStore(LocalVectorStore):
+    """LocalVectorStore that records queries and can fail the next memory queries."""
+
+    def __init__(self):
+        super().__init__(dimension=DIMENSION)
+        self.queries = []
+        self.memory_failures = 0
+        self.values_requested = False
+
+    def query(self, vector, top_k, filter=None, include_metadata=True, include_values=False):
+        label = "memories" if (filter or {}).get("type") == "memory" else "documents"
+        self.queries.append(label)
+        self.values_requested |= include_values
+        if label == "memories" and self.memory_failures:
+            self.memory_failures -= 1
+            raise ConnectionError("pinecone unavailable")
+        return super().query(vector, top_k, filter=filter, include_metadata=include_metadata,
+                             include_values=include_values)
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", os.getenv("GOOGLE_API_KEY", "test-key"))
+    import llama_service
+
+    store = FlakyStore()
+    store.upsert([
+        ("doc_alice_1", [1, 0, 0, 0], {"text": "Alice works at Acme", "user_id": "alice"}),
+        ("doc_alice_2", [0, 1, 0, 0], {"text": "Alice writes about compilers", "user_id": "alice"}),
+        ("memory_alice_1", [1, 0.2, 0, 0], {"text": "Memory: allergic to peanuts", "user_id": "alice",
+                                            "type": "memory", "importance": 5}),
+    ])
+    monkeypatch.setattr(llama_service, "_vector_store", store)
+    # The raw query always embeds along the first axis
+    monkeypatch.setattr(llama_service, "embed_text", lambda text: np.array([1, 0, 0, 0], dtype=np.float32))
+    return llama_service
+
+def retrieve(service, query_vector):
+    speculation = service.start_speculative_retrieval("where does alice work", "alice")
+    return service.retrieve_context("where does alice work", query_vector, "alice", 3, speculation=speculation)
+
+def test_close_expansion_uses_the_speculative_results(service):
+    docs, info = retrieve(service, [1, 0.05, 0, 0])
+
+    assert "Memory: allergic to peanuts" in docs and "Alice works at Acme" in docs
+    assert (info["speculative"], info["top_up"]) == (True, False)
+    assert service.get_vector_store().queries == ["documents", "memories"]
+    assert not service.get_vector_store().values_requested
+
+def test_failed_speculative_memory_query_is_repeated(service):
+    service.get_vector_store().memory_failures = 1
+    docs, info = retrieve(service, [1, 0.05, 0, 0])
+
+    assert "Memory: allergic to peanuts" in docs
+    assert info["top_up_queries"] == ["memories"]
+    assert service.get_vector_store().queries == ["documents", "memories", "memories"]
+
+def test_distant_expansion_repeats_the_exact_queries(service):
+    docs, info = retrieve(service, [0, 1, 0, 0])
+
+    assert info["similarity"] == 0
+    assert info["top_up_queries"] == ["documents", "memories"]
+    assert docs[0] == "Alice writes about compilers"
+    assert "Memory: allergic to peanuts" in docs
@@ -0,0 +1,77 @@
+import random
+
+import numpy as np
+
+from utils.semantic_cache import SemanticAnswerCache
+
+DIMENSION = 8
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def unit(*components):
+    vector = np.zeros(DIMENSION, dtype=np.float32)
+    vector[:len(components)] = components
+    return vector / np.linalg.norm(vector)
+
+def make_cache(clock=None, **kwargs):
+    return SemanticAnswerCache(dimension=DIMENSION, clock=clock or FakeClock(), rng=random.Random(1), **kwargs)
+
+def test_paraphrase_above_threshold_is_served():
+    cache = make_cache(threshold=0.9, audit_rate=0)
+    cache.store("alice", 0, unit(1, 0.1), {"response": "I work at Acme"}, context_hash="ctx")
+
+    answer, similarity, context_hash, audit = cache.lookup("alice", 0, unit(1, 0.2))
+    assert answer == {"response": "I work at Acme"}
+    assert similarity > 0.9
+    assert context_hash == "ctx"
+    assert not audit
+
+    # A different question, the right question for another user, or an older corpus: no hit
+    assert cache.lookup("alice", 0, unit(0.2, 1)) is None
+    assert cache.lookup("bob", 0, unit(1, 0.1)) is None
+    assert cache.lookup("alice", 1, unit(1, 0.1)) is None
+    assert cache.stats()["hit_rate"] == 0.25
+
+def test_new_corpus_version_drops_old_answers():
+    cache = make_cache()
+    cache.store("alice", 0, unit(1), "old")
+    cache.store("alice", 1, unit(0, 1), "new")
+
+    assert cache.lookup("alice", 1, unit(1)) is None
+    assert cache.lookup("alice", 1, unit(0, 1))[0] == "new"
+    assert cache.stats()["entries"] == 1
+
+def test_entries_expire_and_full_scopes_replace_the_oldest():
+    clock = FakeClock()
+    cache = make_cache(clock, max_entries_per_scope=2, ttl_seconds=100)
+    cache.store("alice", 0, unit(1), "first")
+    clock.now = 10
+    cache.store("alice", 0, unit(0, 1), "second")
+    clock.now = 20
+    cache.store("alice", 0, unit(0, 0, 1), "third")
+
+    assert cache.lookup("alice", 0, unit(1)) is None
+    assert cache.lookup("alice", 0, unit(0, 1))[0] == "second"
+    assert cache.stats()["evictions"] == 1
+
+    clock.now = 115
+    assert cache.lookup("alice", 0, unit(0, 1)) is None
+    assert cache.lookup("alice", 0, unit(0, 0, 1))[0] == "third"
+
+def test_audits_sample_hits_and_count_false_hits():
+    cache = make_cache(audit_rate=0.5)
+    cache.store("alice", 0, unit(1), "answer")
+
+    audited = sum(cache.lookup("alice", 0, unit(1))[3] for _ in range(200))
+    assert 60 < audited < 140
+
+    cache.record_audit(false_hit=False)
+    cache.record_audit(false_hit=True)
+    stats = cache.stats()
+    assert stats["audits"] == 2
+    assert stats["false_hit_rate"] == 0.5
@@ -0,0 +1,98 @@
+import threading
+import time
+
+from utils.single_flight import SingleFlight
+
+def run_concurrently(flight, key, func, callers):
+    """Start callers threads on flight.do(key, func) and return their results (or errors)."""
+    results = []
+    lock = threading.Lock()
+
+    def caller():
+        try:
+            result = flight.do(key, func)
+        except Exception as e:
+            result = e
+        with lock:
+            results.append(result)
+
+    threads = [threading.Thread(target=caller) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+def wait_for_followers(flight, key, count):
+    """Block until count callers are waiting on the in-flight call for key."""
+    while True:
+        with flight._lock:
+            call = flight._calls.get(key)
+            if call is not None and call.followers >= count:
+                return
+        time.sleep(0.001)
+
+def test_identical_calls_share_one_execution():
+    flight = SingleFlight(timeout=5)
+    release = threading.Event()
+    executions = []
+
+    def answer():
+        executions.append(1)
+        release.wait(5)
+        return {"response": "hello"}
+
+    threads, results = run_concurrently(flight, ("alice", "hi"), answer, callers=8)
+    wait_for_followers(flight, ("alice", "hi"), 7)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(executions) == 1
+    assert results == [{"response": "hello"}] * 8
+    assert flight.stats() == {"leaders": 1, "coalesced": 7, "timeouts": 0, "errors": 0, "in_flight": 0}
+
+def test_followers_get_the_leaders_error():
+    flight = SingleFlight(timeout=5)
+    release = threading.Event()
+
+    def failing():
+        release.wait(5)
+        raise RuntimeError("backend down")
+
+    threads, results = run_concurrently(flight, "key", failing, callers=3)
+    wait_for_followers(flight, "key", 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 3
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flight.stats()["errors"] == 1
+
+def test_stuck_leader_does_not_hang_followers():
+    flight = SingleFlight(timeout=0.05)
+    release = threading.Event()
+    calls = []
+
+    def answer():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(5)  # The leader is stuck
+            return "late"
+        return "fresh"
+
+    leader = threading.Thread(target=flight.do, args=("key", answer))
+    leader.start()
+    while not calls:
+        time.sleep(0.001)
+
+    assert flight.do("key", answer) == "fresh"
+    assert flight.stats()["timeouts"] == 1
+    release.set()
+    leader.join()
+
+def test_different_keys_do_not_coalesce():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: 1) == 1
+    assert flight.do("b", lambda: 2) == 2
+    assert flight.stats()["leaders"] == 2
+    assert flight.stats()["coalesced"] == 0
@@ -0,0 +1,53 @@
+from backfill_source_metadata import backfill
+from utils.source_metadata import infer_source_metadata, source_deletion_pages, source_metadata
+from utils.vector_store import LocalVectorStore
+
+def test_source_is_inferred_from_document_headers():
+    assert infer_source_metadata('"PDF Name: resume v2.pdf \\n PDF Content: ..."') == {
+        "source": "pdf", "pdf_filename": "resume v2.pdf"
+    }
+    assert infer_source_metadata("Repository Name: mimikree - Readme.md: uses linkedin") == {"source": "github"}
+    assert infer_source_metadata('"Reddit Post \\n Title: github tips"') == {"source": "reddit"}
+    assert infer_source_metadata('{"login": "octocat"}') == {}
+
+def test_explicit_source_wins_over_the_header():
+    assert source_metadata("LinkedIn", text="Repository Name: x") == {"source": "linkedin"}
+    assert source_metadata(pdf_filename="cv.pdf") == {"source": "pdf", "pdf_filename": "cv.pdf"}
+    assert source_metadata(text="Image Analysis:\nURL: ...") == {"source": "image"}
+
+def test_backfill_sets_missing_sources_including_chunks():
+    store = LocalVectorStore(dimension=2)
+    store.upsert([
+        ("doc_alice_2", [1, 0], {"text": '"PDF Name: cv.pdf \\n PDF Content: hi"', "user_id": "alice"}),
+        ("doc_alice_1_chunk_1", [1, 0], {"text": "rest", "user_id": "alice", "parent_id": "doc_alice_1"}),
+        ("doc_alice_1", [1, 0], {"text": "Repository Name: x", "user_id": "alice", "parent_id": "doc_alice_1"}),
+        ("doc_alice_3", [1, 0], {"text": "mentions github", "user_id": "alice", "source": "linkedin"}),
+        ("doc_alice_4", [1, 0], {"text": '{"login": "alice"}', "user_id": "alice"}),
+    ])
+
+    dry_run = backfill(store, ["doc_alice_"], dry_run=True, page_size=2)
+    assert dry_run["updated"] == 3
+    assert "source" not in store.fetch(["doc_alice_1"])["doc_alice_1"]["metadata"]
+
+    counts = backfill(store, ["doc_alice_"], page_size=2)
+    assert (counts["updated"], counts["already_set"], counts["unknown"]) == (3, 1, 1)
+    sources = {
+        vector_id: vector["metadata"].get("source")
+        for vector_id, vector in store.fetch(["doc_alice_1", "doc_alice_1_chunk_1", "doc_alice_2", "doc_alice_3"]).items()
+    }
+    assert sources == {"doc_alice_1": "github", "doc_alice_1_chunk_1": "github", "doc_alice_2": "pdf", "doc_alice_3": "linkedin"}
+    assert store.fetch(["doc_alice_2"])["doc_alice_2"]["metadata"]["pdf_filename"] == "cv.pdf"
+
+def test_deletion_falls_back_to_text_for_legacy_json_profiles():
+    store = LocalVectorStore(dimension=2)
+    store.upsert([
+        ("doc_alice_1", [1, 0], {"text": '{"profileUrl": "https://www.linkedin.com/in/alice"}', "user_id": "alice"}),
+        ("doc_alice_1_chunk_1", [1, 0], {"text": '"experience": []}', "user_id": "alice", "parent_id": "doc_alice_1"}),
+        ("doc_alice_2", [1, 0], {"text": "Alice on LinkedIn", "user_id": "alice", "source": "linkedin"}),
+        ("doc_alice_3", [1, 0], {"text": "mentions linkedin", "user_id": "alice", "source": "github"}),
+        ("doc_alice_4", [1, 0], {"text": '{"login": "alice"}', "user_id": "alice"}),
+        ("doc_bob_1", [1, 0], {"text": '{"profileUrl": "https://www.linkedin.com/in/bob"}', "user_id": "bob"}),
+    ])
+
+    deleted = [vector_id for page in source_deletion_pages(store, "alice", "LinkedIn") for vector_id in page]
+    assert sorted(deleted) == ["doc_alice_1", "doc_alice_1_chunk_1", "doc_alice_2"]
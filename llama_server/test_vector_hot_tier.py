@@ -0,0 +1,164 @@
+import numpy as np
+
+from utils.corpus_versions import SqliteCorpusVersions
+from utils.vector_hot_tier import HotTierVectorStore
+from utils.vector_store import LocalVectorStore
+
+DIMENSION = 8
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class CountingStore(LocalVectorStore):
+    """LocalVectorStore that counts the calls the hot tier makes to it."""
+
+    def __init__(self):
+        super().__init__(dimension=DIMENSION)
+        self.queries = 0
+        self.listings = 0
+        self.after_listing = None
+
+    def query(self, *args, **kwargs):
+        self.queries += 1
+        return super().query(*args, **kwargs)
+
+    def list_by_user(self, *args, **kwargs):
+        self.listings += 1
+        records = super().list_by_user(*args, **kwargs)
+        if self.after_listing:
+            # A write that lands after the snapshot was taken
+            self.after_listing()
+        return records
+
+def random_records(user_id, count, rng):
+    return [
+        (f"{user_id}_{i}", rng.normal(size=DIMENSION).tolist(),
+         {"text": f"text {i}", "user_id": user_id, "type": "memory" if i % 2 else "document",
+          "importance": i % 10})
+        for i in range(count)
+    ]
+
+def make_tier(**kwargs):
+    backing = CountingStore()
+    rng = np.random.default_rng(0)
+    backing.upsert(random_records("alice", 40, rng) + random_records("bob", 40, rng))
+    return backing, HotTierVectorStore(backing, dimension=DIMENSION, **kwargs)
+
+def ids(result):
+    return [match["id"] for match in result["matches"]]
+
+def test_user_queries_are_served_locally_with_the_same_results():
+    backing, tier = make_tier()
+    query = np.random.default_rng(1).normal(size=DIMENSION).tolist()
+    filters = [
+        {"user_id": "alice"},
+        {"user_id": "alice", "type": "memory", "importance": {"$gte": 5}},
+        {"user_id": {"$eq": "bob"}, "type": "document"},
+    ]
+
+    for filter in filters:
+        expected = backing.query(query, top_k=6, filter=filter, include_values=True)
+        backing.queries = 0
+        result = tier.query(query, top_k=6, filter=filter, include_values=True)
+        assert backing.queries == 0
+        assert ids(result) == ids(expected)
+        assert np.allclose([m["score"] for m in result["matches"]], [m["score"] for m in expected["matches"]])
+
+    assert backing.listings == 2  # One load per user
+    assert tier.stats()["hits"] == 1
+
+    tier.query(query, top_k=3, filter={"type": "memory"})  # Not user-scoped
+    assert backing.queries == 1
+    assert tier.stats()["bypasses"] == 1
+
+def test_writes_keep_loaded_users_coherent():
+    _, tier = make_tier()
+    tier.query([1] * DIMENSION, top_k=1, filter={"user_id": "alice"})
+
+    target = [0, 0, 0, 0, 0, 0, 0, 1]
+    tier.upsert([("alice_new", target, {"text": "new", "user_id": "alice"})])
+    assert ids(tier.query(target, top_k=1, filter={"user_id": "alice"})) == ["alice_new"]
+
+    tier.upsert([("alice_new", target, {"text": "moved", "user_id": "bob"})])
+    assert "alice_new" not in ids(tier.query(target, top_k=50, filter={"user_id": "alice"}))
+
+    tier.delete(["alice_0", "alice_1"])
+    remaining = ids(tier.query(target, top_k=50, filter={"user_id": "alice"}))
+    assert len(remaining) == 38
+    assert "alice_0" not in remaining
+    assert tier.stats()["vectors"] == 38  # bob was never loaded
+
+def test_lru_eviction_under_memory_budget():
+    _, tier = make_tier()
+    tier.query([1] * DIMENSION, top_k=1, filter={"user_id": "alice"})
+    one_user_bytes = tier.stats()["bytes"]
+    tier.max_bytes = one_user_bytes + one_user_bytes // 2
+
+    tier.query([1] * DIMENSION, top_k=1, filter={"user_id": "bob"})
+    stats = tier.stats()
+    assert stats["users"] == 1
+    assert stats["evictions"] == 1
+    assert stats["bytes"] <= tier.max_bytes
+
+def test_large_users_and_expired_users_go_back_to_the_backing_store():
+    clock = FakeClock()
+    backing, tier = make_tier(max_user_vectors=40, ttl_seconds=60, clock=clock)
+
+    tier.query([1] * DIMENSION, top_k=1, filter={"user_id": "alice"})
+    tier.query([1] * DIMENSION, top_k=1, filter={"user_id": "alice"})
+    assert backing.listings == 1
+    assert backing.queries == 2
+    assert tier.stats()["users"] == 0
+
+    tier.max_user_vectors = 1000
+    clock.now = 61
+    tier.query([1] * DIMENSION, top_k=1, filter={"user_id": "alice"})
+    tier.query([1] * DIMENSION, top_k=1, filter={"user_id": "alice"})
+    assert backing.listings == 2
+    assert backing.queries == 2
+
+def test_load_overlapping_a_write_of_the_same_user_is_discarded():
+    backing, tier = make_tier()
+    backing.after_listing = lambda: tier.upsert([("alice_new", [1] * DIMENSION, {"text": "new", "user_id": "alice"})])
+
+    result = tier.query([1] * DIMENSION, top_k=50, filter={"user_id": "alice"})
+    assert "alice_new" in ids(result)
+    assert tier.stats()["discarded_loads"] == 1
+    assert tier.stats()["users"] == 0
+
+def test_writes_of_other_users_do_not_discard_a_load():
+    backing, tier = make_tier()
+    backing.after_listing = lambda: (
+        tier.upsert([("bob_new", [1] * DIMENSION, {"text": "new", "user_id": "bob"})]),
+        tier.delete(["alice_0"])
+    )
+
+    tier.query([1] * DIMENSION, top_k=50, filter={"user_id": "alice"})
+    backing.after_listing = None
+    result = tier.query([1] * DIMENSION, top_k=50, filter={"user_id": "alice"})
+
+    # Loaded despite the concurrent writes, without the record deleted meanwhile
+    assert tier.stats()["discarded_loads"] == 0
+    assert tier.stats()["users"] == 1
+    assert backing.listings == 1
+    assert "alice_0" not in ids(result) and len(ids(result)) == 39
+
+def test_users_are_reloaded_when_another_worker_bumps_their_version(tmp_path):
+    path = str(tmp_path / "versions.db")
+    versions = SqliteCorpusVersions(path)
+    backing, tier = make_tier(corpus_version=versions.get)
+    tier.query([1] * DIMENSION, top_k=1, filter={"user_id": "alice"})
+    tier.query([1] * DIMENSION, top_k=1, filter={"user_id": "bob"})
+
+    # Another worker writes to alice's vectors and bumps her version
+    backing.upsert([("alice_new", [1] * DIMENSION, {"text": "new", "user_id": "alice"})])
+    SqliteCorpusVersions(path).bump("alice")
+
+    assert "alice_new" in ids(tier.query([1] * DIMENSION, top_k=50, filter={"user_id": "alice"}))
+    tier.query([1] * DIMENSION, top_k=1, filter={"user_id": "bob"})
+    assert backing.listings == 3  # bob is still served from the tier
+    assert tier.stats()["stale_drops"] == 1
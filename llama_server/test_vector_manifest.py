@@ -0,0 +1,88 @@
+from utils.vector_manifest import ManifestVectorStore, SqliteVectorManifest
+from utils.vector_store import LocalVectorStore
+
+DIMENSION = 4
+
+def prefixes(user_id):
+    return [f"doc_{user_id}_", f"memory_{user_id}_"]
+
+def record(vector_id, user_id, **metadata):
+    return (vector_id, [1.0, 0, 0, 0], dict(metadata, text=f"text of {vector_id}", user_id=user_id))
+
+class NoListingStore(LocalVectorStore):
+    """A backing store without ID listing, like a pod-based Pinecone index."""
+
+    def iter_ids(self, prefix, page_size=100):
+        raise NotImplementedError
+
+def existing_data(backing):
+    backing.upsert([
+        record("doc_alice_1", "alice", platform="github", unique_id="repo1"),
+        record("doc_alice_2", "alice", platform="github", unique_id="repo2"),
+        record("memory_alice_1", "alice", type="memory"),
+        record("doc_alice_bob_1", "alice_bob"),  # Shares alice's ID prefix
+    ])
+
+def ids(records):
+    return [entry["id"] for entry in records]
+
+def test_existing_vectors_are_imported_once_by_prefix():
+    backing = LocalVectorStore(dimension=DIMENSION)
+    existing_data(backing)
+    store = ManifestVectorStore(backing, SqliteVectorManifest(), prefixes, page_size=1)
+
+    assert ids(store.list_by_user("alice")) == ["doc_alice_1", "doc_alice_2", "memory_alice_1"]
+    assert ids(store.list_by_user("alice", filter={"platform": "github"})) == ["doc_alice_1", "doc_alice_2"]
+    assert store.list_by_user("alice", filter={"type": "memory"})[0]["metadata"] == {"user_id": "alice", "type": "memory"}
+
+    backing.upsert([record("doc_alice_3", "alice")])  # Bypasses the manifest
+    assert "doc_alice_3" not in ids(store.list_by_user("alice"))
+    assert store.stats()["imported"] == 3
+
+def test_writes_and_deletes_keep_the_manifest_current():
+    backing = LocalVectorStore(dimension=DIMENSION)
+    store = ManifestVectorStore(backing, SqliteVectorManifest(), prefixes)
+    store.upsert([record(f"doc_alice_{i:02d}", "alice") for i in range(25)])
+    store.upsert([record("doc_alice_00", "bob")])
+
+    deleted = []
+    for page in store.user_pages("alice", page_size=10):
+        assert len(page) <= 10
+        store.delete(ids(page))  # Deleting while paging does not skip entries
+        deleted.extend(ids(page))
+
+    assert len(deleted) == 24
+    assert backing.describe()["vectors"] == 1
+    assert ids(store.list_by_user("bob")) == ["doc_alice_00"]
+
+def test_falls_back_to_a_metadata_listing_without_id_listing():
+    backing = NoListingStore(dimension=DIMENSION)
+    existing_data(backing)
+    store = ManifestVectorStore(backing, SqliteVectorManifest(), prefixes)
+
+    assert ids(store.list_by_user("alice")) == ["doc_alice_1", "doc_alice_2", "memory_alice_1"]
+
+def test_manifest_persists_between_processes(tmp_path):
+    path = str(tmp_path / "manifest.db")
+    backing = LocalVectorStore(dimension=DIMENSION)
+    existing_data(backing)
+    ManifestVectorStore(backing, SqliteVectorManifest(path), prefixes).list_by_user("alice")
+
+    reopened = SqliteVectorManifest(path)
+    assert reopened.is_built("alice")
+    assert not reopened.is_built("alice_bob")
+    assert reopened.stats()["entries"] == 3
+
+def test_rebuild_picks_up_writes_made_through_another_manifest():
+    backing = LocalVectorStore(dimension=DIMENSION)
+    existing_data(backing)
+    store = ManifestVectorStore(backing, SqliteVectorManifest(), prefixes)
+    other_host = ManifestVectorStore(backing, SqliteVectorManifest(), prefixes)
+    store.list_by_user("alice")
+
+    other_host.upsert([record("doc_alice_3", "alice")])
+    other_host.delete(["doc_alice_1"])
+    assert "doc_alice_3" not in ids(store.list_by_user("alice"))
+
+    store.rebuild("alice")
+    assert ids(store.list_by_user("alice")) == ["doc_alice_2", "doc_alice_3", "memory_alice_1"]
@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from utils.vector_store import LocalVectorStore, PineconeVectorStore, matches_filter
+
+DIMENSION = 8
+
+def vector(*components):
+    values = np.zeros(DIMENSION, dtype=np.float32)
+    values[:len(components)] = components
+    return values.tolist()
+
+def memory(user_id, category, importance):
+    return {"text": f"{category} memory", "user_id": user_id, "type": "memory",
+            "category": category, "importance": importance, "tags": [category, "test"]}
+
+def fill(store):
+    store.upsert([
+        ("doc_alice_1", vector(1, 0), {"text": "alice doc", "user_id": "alice"}),
+        ("memory_alice_1", vector(0.9, 0.1), memory("alice", "work", 8)),
+        ("memory_alice_2", vector(0.8, 0.2), memory("alice", "health", 3)),
+        ("memory_alice_3", vector(0, 1), memory("alice", "work", 5)),
+        ("memory_bob_1", vector(1, 0), memory("bob", "work", 9)),
+    ])
+
+def test_filtered_query_ranks_by_cosine():
+    store = LocalVectorStore(dimension=DIMENSION)
+    fill(store)
+
+    result = store.query(vector(1, 0), top_k=10, filter={"user_id": "alice", "type": "memory"})
+    assert [match["id"] for match in result["matches"]] == ["memory_alice_1", "memory_alice_2", "memory_alice_3"]
+    assert result["matches"][0]["score"] > result["matches"][1]["score"]
+    assert "values" not in result["matches"][0]
+
+    result = store.query(vector(1, 0), top_k=1, include_values=True, filter={
+        "user_id": "alice", "category": "work", "importance": {"$gte": 5}
+    })
+    assert [match["id"] for match in result["matches"]] == ["memory_alice_1"]
+    assert np.allclose(result["matches"][0]["values"], vector(0.9, 0.1))
+
+    # List values match $eq/$in on any element, as in Pinecone
+    assert len(store.query(vector(1), top_k=10, filter={"tags": "health"})["matches"]) == 1
+    assert len(store.query(vector(1), top_k=10, filter={"user_id": {"$in": ["bob"]}})["matches"]) == 1
+
+def test_upsert_replaces_and_delete_frees_rows():
+    store = LocalVectorStore(dimension=DIMENSION, initial_capacity=2)
+    fill(store)  # Grows the matrix past its initial capacity
+
+    store.upsert([("memory_alice_3", vector(1, 0), memory("bob", "work", 5))])
+    assert store.fetch(["memory_alice_3"])["memory_alice_3"]["metadata"]["user_id"] == "bob"
+    assert [record["id"] for record in store.list_by_user("bob")] == ["memory_alice_3", "memory_bob_1"]
+
+    store.delete(["memory_alice_3", "missing"])
+    store.upsert([("doc_carol_1", vector(0, 0, 1), {"text": "carol doc", "user_id": "carol"})])
+    assert store.fetch(["memory_alice_3"]) == {}
+    assert store.describe()["vectors"] == 5
+    assert store.query(vector(0, 0, 1), top_k=1)["matches"][0]["id"] == "doc_carol_1"
+
+def test_data_survives_reopening(tmp_path):
+    store = LocalVectorStore(str(tmp_path), dimension=DIMENSION, initial_capacity=2)
+    fill(store)
+    store.delete(["memory_alice_2"])
+    store.close()
+
+    reopened = LocalVectorStore(str(tmp_path), dimension=DIMENSION, initial_capacity=2)
+    assert reopened.describe()["vectors"] == 4
+    assert [record["id"] for record in reopened.list_by_user("alice", filter={"type": "memory"})] == [
+        "memory_alice_1", "memory_alice_3"
+    ]
+    match = reopened.query(vector(0, 1), top_k=1, filter={"user_id": "alice"})["matches"][0]
+    assert match["id"] == "memory_alice_3"
+    assert abs(match["score"] - 1.0) < 1e-6
+
+def test_matches_filter_operators():
+    metadata = {"user_id": "alice", "importance": 5, "tags": ["work"]}
+    assert matches_filter(metadata, {"importance": {"$gte": 5, "$lt": 6}})
+    assert not matches_filter(metadata, {"importance": {"$gt": 5}})
+    assert matches_filter(metadata, {"category": {"$ne": "health"}})
+    assert not matches_filter(metadata, {"category": {"$eq": "health"}})
+    assert matches_filter(metadata, {"$or": [{"user_id": "bob"}, {"tags": {"$in": ["work"]}}]})
+    assert not matches_filter(metadata, {"tags": {"$nin": ["work"]}})
+
+def test_pinecone_store_returns_plain_results():
+    class Index:
+        def query(self, **kwargs):
+            self.kwargs = kwargs
+            return SimpleNamespace(matches=[SimpleNamespace(id="a", score=0.5, metadata={"user_id": "alice"}, values=[])])
+
+        def fetch(self, ids):
+            return SimpleNamespace(vectors={"a": SimpleNamespace(values=[1.0], metadata={"user_id": "alice"})})
+
+    index = Index()
+    store = PineconeVectorStore(index, dimension=DIMENSION)
+    assert store.list_by_user("alice", filter={"platform": "github"}) == [{"id": "a", "metadata": {"user_id": "alice"}}]
+    assert index.kwargs["filter"] == {"platform": "github", "user_id": "alice"}
+    assert index.kwargs["vector"] == [0] * DIMENSION
+    assert store.fetch(["a"]) == {"a": {"id": "a", "values": [1.0], "metadata": {"user_id": "alice"}}}
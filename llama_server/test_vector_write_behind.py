@@ -0,0 +1,159 @@
+import threading
+import time
+
+import pytest
+
+from utils.vector_store import LocalVectorStore
+from utils.vector_write_behind import WriteBehindVectorStore
+
+DIMENSION = 4
+
+class RecordingStore(LocalVectorStore):
+    """LocalVectorStore that records upsert batch sizes and can be made to fail."""
+
+    def __init__(self):
+        super().__init__(dimension=DIMENSION)
+        self.batches = []
+        self.failures = 0
+        self.rejected_ids = set()
+
+    def upsert(self, vectors):
+        vectors = list(vectors)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("pinecone unavailable")
+        if any(vector_id in self.rejected_ids for vector_id, _, _ in vectors):
+            raise ValueError("Vector dimension 3 does not match the dimension of the index 4")
+        self.batches.append(len(vectors))
+        super().upsert(vectors)
+
+def record(vector_id, user_id, value=1.0):
+    return (vector_id, [value, 0, 0, 0], {"text": vector_id, "user_id": user_id})
+
+def wait_until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("condition not met")
+
+def test_concurrent_upserts_are_coalesced_into_bulk_writes():
+    backing = RecordingStore()
+    store = WriteBehindVectorStore(backing, max_batch=50, max_delay=0.05)
+
+    threads = [
+        threading.Thread(target=store.upsert, args=([record(f"doc_alice_{i}", "alice")],))
+        for i in range(40)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wait_until(lambda: sum(backing.batches) == 40)
+
+    stats = store.stats()
+    assert len(backing.batches) < 40
+    assert stats["batches"] == len(backing.batches)
+    assert stats["max_batch_size"] == max(backing.batches)
+    assert stats["pending"] == 0
+    store.close()
+
+def test_reads_see_the_same_users_buffered_writes():
+    backing = RecordingStore()
+    store = WriteBehindVectorStore(backing, max_delay=60)
+    store.upsert([record("doc_alice_1", "alice")])
+    store.upsert([record("doc_bob_1", "bob")])
+    store.upsert([record("doc_alice_1", "alice", value=2.0)])
+    assert backing.batches == []
+
+    matches = store.query([1, 0, 0, 0], top_k=5, filter={"user_id": "alice"})["matches"]
+    assert [match["id"] for match in matches] == ["doc_alice_1"]
+    assert backing.fetch(["doc_alice_1"])["doc_alice_1"]["values"][0] == 2.0
+    assert store.stats()["coalesced"] == 1
+
+    # bob's buffered record rode along in the same request
+    assert backing.batches == [2]
+    assert store.stats()["pending"] == 0
+    assert store.stats()["read_flushes"] == 1
+    store.close()
+
+def test_flush_reports_failures_of_the_callers_records():
+    backing = RecordingStore()
+    backing.rejected_ids = {"doc_alice_2"}
+    store = WriteBehindVectorStore(backing, max_delay=60)
+    store.upsert([record("doc_alice_1", "alice"), record("doc_bob_1", "bob")])
+    store.flush(matches=lambda vector_id: vector_id == "doc_alice_1")
+    assert backing.batches == [2]
+
+    store.upsert([record("doc_alice_2", "alice")])
+    with pytest.raises(ValueError):
+        store.flush()
+    # A later flush for the record still reports that it was never written
+    with pytest.raises(ValueError):
+        store.flush(matches=lambda vector_id: vector_id == "doc_alice_2")
+    store.flush(matches=lambda vector_id: vector_id == "doc_alice_1")
+    store.close()
+
+def test_deletes_drop_buffered_writes():
+    backing = RecordingStore()
+    store = WriteBehindVectorStore(backing, max_delay=60)
+    store.upsert([record("doc_alice_1", "alice"), record("doc_alice_2", "alice")])
+    store.delete(["doc_alice_1"])
+
+    assert [item["id"] for item in store.list_by_user("alice")] == ["doc_alice_2"]
+    store.close()
+
+def test_failed_flushes_are_retried_and_close_writes_the_rest():
+    backing = RecordingStore()
+    backing.failures = 1
+    store = WriteBehindVectorStore(backing, max_delay=0.01, retry_delay=0.05)
+    store.upsert([record("doc_alice_1", "alice")])
+    wait_until(lambda: backing.batches == [1])
+    assert store.stats()["flush_errors"] == 1
+
+    store.max_delay = 60
+    store.upsert([record("doc_alice_2", "alice")])
+    store.close()
+    assert backing.batches == [1, 1]
+
+    # After close, writes go straight to the backing store
+    store.upsert([record("doc_alice_3", "alice")])
+    assert backing.batches == [1, 1, 1]
+
+def test_rejected_records_are_dead_lettered_without_blocking_others():
+    backing = RecordingStore()
+    backing.rejected_ids = {"doc_bob_bad"}
+    store = WriteBehindVectorStore(backing, max_delay=60)
+    store.upsert([record("doc_alice_1", "alice"), record("doc_bob_bad", "bob"), record("doc_carol_1", "carol")])
+
+    with pytest.raises(ValueError):
+        store.flush()
+    assert set(backing.fetch(["doc_alice_1", "doc_carol_1", "doc_bob_bad"])) == {"doc_alice_1", "doc_carol_1"}
+
+    stats = store.stats()
+    assert (stats["pending"], stats["dead_lettered"]) == (0, 1)
+    assert [letter["id"] for letter in store.dead_letters()] == ["doc_bob_bad"]
+    store.close()
+
+def test_transient_failures_are_retried_behind_other_writes_then_dead_lettered():
+    backing = RecordingStore()
+    store = WriteBehindVectorStore(backing, max_delay=60, retry_delay=60, max_retries=2)
+    store.upsert([record("doc_alice_1", "alice")])
+    backing.failures = 1
+    with pytest.raises(ConnectionError):
+        store.flush()
+    assert store.stats()["retried_records"] == 1
+
+    # alice's record is backing off, so it does not hold up bob's
+    store.upsert([record("doc_bob_1", "bob")])
+    store.flush(user_id="bob")
+    assert backing.batches == [1]
+    assert list(store._pending) == ["doc_alice_1"]
+
+    backing.failures = 2
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            store.flush()
+    assert store.stats()["pending"] == 0
+    assert [letter["attempts"] for letter in store.dead_letters()] == [3]
+    store.close()
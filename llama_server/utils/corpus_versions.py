@@ -0,0 +1,52 @@
+import sqlite3
+import threading
+
+class SqliteCorpusVersions:
+    """
+    Per-user corpus versions in a SQLite file, so every worker process on a host
+    sees a write handled by any of them.
+
+    ResponseCache reads the version on every lookup, which is a single primary-key
+    read; bumps are one upsert statement, atomic across processes.
+    """
+
+    def __init__(self, path, timeout=10):
+        """
+        Initialize the store, creating the database file and table if needed.
+
+        Args:
+            path: Path of the SQLite database file.
+            timeout: Seconds to wait for another process's write to finish.
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()  # sqlite3 connections must stay on their thread
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS corpus_versions ("
+            "user_id TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id):
+        """Current version of user_id's corpus, 0 if it never changed."""
+        row = self._connection().execute(
+            "SELECT version FROM corpus_versions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, user_id):
+        """Increment user_id's version."""
+        self._connection().execute(
+            "INSERT INTO corpus_versions (user_id, version) VALUES (?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET version = version + 1",
+            (user_id,)
+        )
@@ -0,0 +1,163 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+class EmbeddingCache:
+    """
+    An in-process, memory-bounded LRU cache of text embeddings with TTL eviction.
+    Entries are keyed by model name and a hash of the normalized text, so the same
+    text is never embedded twice while it stays cached.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl_seconds=3600, clock=time.monotonic):
+        """
+        Initialize the cache.
+
+        Args:
+            max_bytes: Upper bound on the memory held by cached vectors.
+            ttl_seconds: How long an entry stays valid after it was stored.
+            clock: Monotonic time source, injectable for tests.
+        """
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+
+        self._entries = OrderedDict()  # key -> (vector, stored_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize(text):
+        """Collapse whitespace so trivially different spellings share an entry."""
+        return re.sub(r'\s+', ' ', text).strip()
+
+    @staticmethod
+    def _key(normalized_text, model_name):
+        digest = hashlib.sha1(normalized_text.encode("utf-8")).hexdigest()
+        return (model_name, digest)
+
+    def get(self, text, model_name):
+        """Return the cached vector for text, or None if it is missing or expired."""
+        key = self._key(self.normalize(text), model_name)
+        with self._lock:
+            return self._get_locked(key)
+
+    def put(self, text, model_name, vector):
+        """Store a vector for text, evicting least recently used entries if needed."""
+        key = self._key(self.normalize(text), model_name)
+        with self._lock:
+            self._put_locked(key, np.asarray(vector, dtype=np.float32))
+
+    def _get_locked(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        vector, stored_at = entry
+        if self._clock() - stored_at > self.ttl_seconds:
+            self._remove_locked(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return vector
+
+    def _put_locked(self, key, vector):
+        if key in self._entries:
+            self._remove_locked(key)
+
+        # Vectors are shared with callers, so they must not be modified in place
+        vector.setflags(write=False)
+        self._entries[key] = (vector, self._clock())
+        self._bytes += vector.nbytes
+
+        while self._bytes > self.max_bytes and self._entries:
+            oldest_key = next(iter(self._entries))
+            self._remove_locked(oldest_key)
+            self.evictions += 1
+
+    def _remove_locked(self, key):
+        vector, _ = self._entries.pop(key)
+        self._bytes -= vector.nbytes
+
+    def encode(self, texts, model, model_name, **encode_kwargs):
+        """
+        Embed texts through the cache.
+
+        Cache misses are de-duplicated and embedded with a single batched
+        model.encode call. Returns a float32 array with one row per input text.
+
+        Args:
+            texts: List of strings to embed.
+            model: A SentenceTransformer-like object with an encode(list) method.
+            model_name: Name of the model, part of the cache key.
+            encode_kwargs: Extra keyword arguments passed to model.encode.
+        """
+        normalized = [self.normalize(text) for text in texts]
+        keys = [self._key(text, model_name) for text in normalized]
+
+        results = [None] * len(texts)
+        missing = OrderedDict()  # key -> (normalized text, [positions])
+        with self._lock:
+            for position, key in enumerate(keys):
+                if key in missing:
+                    # Same text appears twice in one call; embed it once
+                    missing[key][1].append(position)
+                    continue
+                vector = self._get_locked(key)
+                if vector is None:
+                    missing[key] = (normalized[position], [position])
+                else:
+                    results[position] = vector
+
+        if missing:
+            encoded = model.encode([text for text, _ in missing.values()], **encode_kwargs)
+            with self._lock:
+                for (key, (_, positions)), vector in zip(missing.items(), encoded):
+                    vector = np.array(vector, dtype=np.float32)
+                    self._put_locked(key, vector)
+                    for position in positions:
+                        results[position] = vector
+
+        if not results:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.vstack(results)
+
+    def stats(self):
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds
+            }
+
+# Lazy initialization - don't create the cache until it's accessed
+_embedding_cache = None
+
+def get_embedding_cache():
+    """Get or create the singleton embedding cache, sized from the environment."""
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache(
+            max_bytes=int(os.getenv('EMBEDDING_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+            ttl_seconds=float(os.getenv('EMBEDDING_CACHE_TTL_SECONDS', 3600))
+        )
+    return _embedding_cache
@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+
+import google.ai.generativelanguage as glm
+import google.generativeai as genai
+from google.api_core import gapic_v1
+from google.generativeai.client import USER_AGENT
+from google.generativeai import __version__ as GENAI_VERSION
+
+DEFAULT_MODEL = "gemini-2.0-flash"
+
+# The key with_key_rotation claimed for the call running in this thread/context
+ACTIVE_API_KEY = ContextVar("gemini_active_api_key", default=None)
+
+class GeminiClientPool:
+    """
+    Gemini service clients, one per API key.
+
+    genai.configure sets a single process-wide key, so concurrent requests could run
+    with each other's key. Models built here carry their own client instead, which
+    lets calls with different keys (our rotated keys, a widget owner's key) run in
+    parallel. Clients are reused per key; the pool is bounded so external keys
+    cannot grow it without limit.
+    """
+
+    def __init__(self, max_clients=64):
+        """
+        Initialize the pool.
+
+        Args:
+            max_clients: Most clients kept; the least recently used one is dropped beyond that.
+        """
+        self.max_clients = max_clients
+        self._clients = OrderedDict()  # api_key -> GenerativeServiceClient
+        self._lock = threading.Lock()
+
+    def client_for(self, api_key):
+        """Return the client for api_key, creating it on first use."""
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is not None:
+                self._clients.move_to_end(api_key)
+                return client
+
+        # Creating a client is slow-ish (channel setup), so do it outside the lock
+        client = glm.GenerativeServiceClient(
+            client_options={"api_key": api_key},
+            client_info=gapic_v1.client_info.ClientInfo(user_agent=f"{USER_AGENT}/{GENAI_VERSION}")
+        )
+        with self._lock:
+            existing = self._clients.get(api_key)
+            if existing is not None:
+                return existing
+            self._clients[api_key] = client
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        return client
+
+    def model(self, api_key, model_name=DEFAULT_MODEL, **model_kwargs):
+        """A GenerativeModel that sends its requests with api_key, independent of genai.configure."""
+        model = genai.GenerativeModel(model_name, **model_kwargs)
+        # GenerativeModel otherwise picks up the process-wide default client on first use
+        model._client = self.client_for(api_key)
+        return model
+
+# Lazy initialization - don't create the pool until it's accessed
+_client_pool = None
+_client_pool_lock = threading.Lock()
+
+def get_client_pool():
+    """Get or create the singleton client pool."""
+    global _client_pool
+    if _client_pool is None:
+        with _client_pool_lock:
+            if _client_pool is None:
+                _client_pool = GeminiClientPool()
+    return _client_pool
+
+def gemini_model(model_name=DEFAULT_MODEL, api_key=None, **model_kwargs):
+    """
+    Build a GenerativeModel bound to one API key.
+
+    Args:
+        model_name: Gemini model to use.
+        api_key: Key to send requests with. Defaults to the key with_key_rotation
+            claimed for the current call.
+    """
+    api_key = api_key or ACTIVE_API_KEY.get()
+    if not api_key:
+        raise RuntimeError("No Gemini API key: pass api_key or call from a with_key_rotation function")
+    return get_client_pool().model(api_key, model_name, **model_kwargs)
@@ -1,21 +1,84 @@
-import google.generativeai as genai
+import random
+import re
+import threading
 import time
 from collections import deque
 import os
+from contextlib import contextmanager
 from functools import wraps
 
+from google.api_core.exceptions import ResourceExhausted, TooManyRequests
+
+from utils.gemini_client import ACTIVE_API_KEY
+from utils.key_state_store import SqliteKeyState
+
+# Phrases that identify a rate limit error when the exception type does not
+RATE_LIMIT_PHRASES = ("rate limit", "quota", "resource exhausted", "resource has been exhausted", "too many requests")
+
+def is_rate_limit_error(error):
+    """True for 429 / ResourceExhausted errors from the Gemini API."""
+    if isinstance(error, (ResourceExhausted, TooManyRequests)):
+        return True
+    if getattr(error, "code", None) == 429:
+        return True
+    message = str(error).lower()
+    return "429" in message or any(phrase in message for phrase in RATE_LIMIT_PHRASES)
+
+def retry_delay_from_error(error):
+    """
+    The retry delay the backend asked for, in seconds, or None.
+
+    Looks for a RetryInfo entry in the error details first, then for the delay in
+    the message ("retry_delay { seconds: 17 }" or "Please retry in 17.5s").
+    """
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None and hasattr(retry_delay, "seconds"):
+            return retry_delay.seconds + getattr(retry_delay, "nanos", 0) / 1e9
+
+    message = str(error)
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", message)
+    if not match:
+        match = re.search(r"retry in\s*([\d.]+)\s*s", message, re.IGNORECASE)
+    if match:
+        return float(match.group(1))
+    return None
+
 class GeminiKeyManager:
     """
     A class to manage multiple Gemini API keys with rotation when rate limits are reached.
     This helps handle the 15 requests per minute limitation of the free tier.
+
+    The manager is shared by all request threads, so key selection and request
+    recording happen atomically under one lock. Each key keeps a sliding window of
+    its recent request times in a deque that is pruned from the left.
+
+    Requests go to the key with the most headroom left in its window. A key that
+    gets a 429 from the backend cools down, for the retry delay the backend asked
+    for or else for a jittered, exponentially growing time, and callers queue for
+    the next free slot instead of failing.
     """
     
-    def __init__(self, api_keys=None):
+    def __init__(self, api_keys=None, rate_limit=15, rate_window=60, acquire_timeout=30,
+                 base_cooldown=5, max_cooldown=60, max_attempts=None,
+                 shared_state=None, clock=time.monotonic, sleep=time.sleep, rng=None):
         """
         Initialize the key manager with a list of API keys.
 
         Args:
             api_keys: List of API keys to use. If None, will try to get from environment.
+            rate_limit: Requests allowed per key within rate_window (Gemini free tier: 15 per minute).
+            rate_window: Length of the sliding window in seconds.
+            acquire_timeout: Longest time with_key_rotation waits for a free key, over all retries.
+            base_cooldown: First cooldown after a 429 without a retry delay; doubles per repeat.
+            max_cooldown: Upper bound on a key's cooldown.
+            max_attempts: Calls with_key_rotation makes before giving up on rate limits.
+                Defaults to one more than the number of keys.
+            shared_state: Optional SqliteKeyState that shares usage across processes. The
+                clock must then be one all processes agree on, like time.time.
+            clock: Monotonic time source, injectable for tests.
+            sleep: Sleep function used while waiting for a slot, injectable for tests.
+            rng: random.Random used for jitter, injectable for tests.
         """
         # If no keys provided, use the environment variable as the primary key
         if api_keys is None:
@@ -30,137 +93,338 @@ class GeminiKeyManager:
         if not self.api_keys:
             raise ValueError("No API keys provided")
 
-        # Create a deque for easy rotation of keys
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window  # seconds
+        self.acquire_timeout = acquire_timeout
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.max_attempts = max_attempts or len(self.api_keys) + 1
+        self._clock = clock
+        self._sleep = sleep
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+
+        # Create a deque for easy rotation of keys; ties on headroom go round-robin
         self.key_queue = deque(self.api_keys)
 
-        # Track request timestamps for each key to calculate rate limits
-        self.request_history = {key: [] for key in self.api_keys}
+        # Request times within the window per key, oldest on the left
+        self.request_history = {key: deque() for key in self.api_keys}
+
+        # Backoff state: when each key may be used again, and its consecutive 429s
+        self.cooldown_until = {key: 0.0 for key in self.api_keys}
+        self.strikes = {key: 0 for key in self.api_keys}
 
         # Set the current key
         self.current_key = self.key_queue[0]
-        genai.configure(api_key=self.current_key)
 
-        # Set rate limit (Gemini free tier: 15 per minute)
-        self.rate_limit = 15
-        self.rate_window = 60  # seconds
+        # Cross-process state: loaded at the start of each locked section, written back at its end
+        self.shared_state = shared_state
+        self._key_ids = {key: shared_state.key_id(key) for key in self.api_keys} if shared_state else {}
+        self._new_requests = []
+        self._loaded_cooldowns = {}
+
+        self.waits = 0
+        self.timeouts = 0
+        self.cooldowns = 0
+
+    @contextmanager
+    def _locked(self):
+        """Hold the manager lock; with shared state, also the cross-process one, synced in and out."""
+        with self._lock:
+            if self.shared_state is None:
+                yield
+                return
+            with self.shared_state.transaction(self._clock()) as transaction:
+                self._load_shared_locked(transaction)
+                yield
+                self._save_shared_locked(transaction)
+
+    def _load_shared_locked(self, transaction):
+        request_times = transaction.request_times()
+        cooldowns = transaction.cooldowns()
+        for key, key_id in self._key_ids.items():
+            self.request_history[key] = deque(request_times.get(key_id, []))
+            self.cooldown_until[key], self.strikes[key] = cooldowns.get(key_id, (0.0, 0))
+        self._loaded_cooldowns = {key: (self.cooldown_until[key], self.strikes[key]) for key in self.api_keys}
+        self._new_requests = []
+
+    def _save_shared_locked(self, transaction):
+        transaction.add_requests(self._new_requests)
+        self._new_requests = []
+        for key, key_id in self._key_ids.items():
+            if (self.cooldown_until[key], self.strikes[key]) != self._loaded_cooldowns[key]:
+                transaction.set_cooldown(key_id, self.cooldown_until[key], self.strikes[key])
     
     def rotate_key(self):
         """
         Rotate to the next available API key.
         Returns the new key.
         """
+        with self._locked():
+            key = self._rotate_locked()
+
+        print(f"Rotated to next API key due to rate limiting")
+        return key
+
+    def _rotate_locked(self):
         # Rotate the queue to get the next key
         self.key_queue.rotate(-1)
         self.current_key = self.key_queue[0]
+        return self.current_key
 
-        # Configure genai with the new key
-        genai.configure(api_key=self.current_key)
+    def _headroom_locked(self, key, now):
+        """Requests key can take right now: 0 while cooling down or at its limit."""
+        if self.cooldown_until[key] > now:
+            return 0
+        history = self.request_history[key]
+        while history and now - history[0] >= self.rate_window:
+            history.popleft()
+        return max(0, self.rate_limit - len(history))
 
-        print(f"Rotated to next API key due to rate limiting")
-        return self.current_key
+    def _next_slot_locked(self, key, now):
+        """Seconds until key can take another request (0 if it can right now)."""
+        if self._headroom_locked(key, now) > 0:
+            return 0
+        window_wait = 0
+        history = self.request_history[key]
+        if len(history) >= self.rate_limit:
+            window_wait = history[-self.rate_limit] + self.rate_window - now
+        return max(0, self.cooldown_until[key] - now, window_wait)
+
+    def _record_locked(self, key, now):
+        self.request_history[key].append(now)
+        if self.shared_state is not None:
+            self._new_requests.append((self._key_ids[key], now))
     
     def _is_rate_limited(self, key):
         """
         Check if the given key is currently rate limited.
         Returns True if rate limited, False otherwise.
         """
-        current_time = time.time()
-        
-        # Clean up old requests outside the rate window
-        self.request_history[key] = [
-            timestamp for timestamp in self.request_history[key]
-            if current_time - timestamp < self.rate_window
-        ]
-        
-        # Check if we've hit the rate limit
-        return len(self.request_history[key]) >= self.rate_limit
+        with self._locked():
+            return self._headroom_locked(key, self._clock()) == 0
+
+    def _least_loaded_locked(self, now):
+        """The key with the most headroom, or None if every key is limited or cooling down."""
+        best_key, best_headroom = None, 0
+        for key in self.key_queue:
+            headroom = self._headroom_locked(key, now)
+            if headroom > best_headroom:
+                best_key, best_headroom = key, headroom
+        return best_key
+
+    def _try_acquire_locked(self, now):
+        """Claim a slot on the least loaded key. Returns the key or None."""
+        key = self._least_loaded_locked(now)
+        if key is None:
+            return None
+        self._record_locked(key, now)
+
+        # Point the queue just past the chosen key, so equally loaded keys take turns
+        while self.key_queue[0] != key:
+            self.key_queue.rotate(-1)
+        self.current_key = key
+        self.key_queue.rotate(-1)
+        return key
+
+    def acquire(self, timeout=None):
+        """
+        Claim a request slot on the least loaded key, and return that key.
+
+        The slot is recorded in the same step, so concurrent callers never share the
+        last slot of a key. If every key is at its limit or cooling down, waits until
+        the earliest slot frees up instead of handing out a limited key.
+
+        Args:
+            timeout: Longest time to wait in seconds, or None to wait as long as needed.
+
+        Returns:
+            The API key, or None if no slot became free within timeout.
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        waited = False
+        while True:
+            with self._locked():
+                now = self._clock()
+                key = self._try_acquire_locked(now)
+                if key is not None:
+                    return key
+
+                wait = min(self._next_slot_locked(k, now) for k in self.api_keys)
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0 or wait > remaining:
+                        self.timeouts += 1
+                        return None
+                if not waited:
+                    waited = True
+                    self.waits += 1
+
+            # Sleep outside the lock; another thread may take the slot first, then we wait again
+            self._sleep(wait)
+
+    def report_rate_limit(self, key, retry_delay=None):
+        """
+        Put key into cooldown after the backend rejected it with a 429.
+
+        Honors the backend's retry delay when there is one; otherwise backs off
+        exponentially with the number of consecutive 429s on the key, with jitter so
+        that waiting callers do not all come back at the same moment.
+
+        Returns:
+            The cooldown in seconds.
+        """
+        with self._locked():
+            self.strikes[key] += 1
+            if retry_delay is not None:
+                cooldown = retry_delay * self._rng.uniform(1.0, 1.1)
+            else:
+                backoff = min(self.max_cooldown, self.base_cooldown * 2 ** (self.strikes[key] - 1))
+                cooldown = self._rng.uniform(backoff / 2, backoff)
+            self.cooldown_until[key] = max(self.cooldown_until[key], self._clock() + cooldown)
+            self.cooldowns += 1
+            return cooldown
+
+    def report_success(self, key):
+        """Reset the backoff of key after a successful call."""
+        with self._locked():
+            self.strikes[key] = 0
     
     def get_available_key(self):
         """
-        Get an available API key that's not rate limited.
-        If all keys are rate limited, returns the least recently used key.
+        Get the API key with the most headroom, without claiming a slot.
+        If all keys are rate limited, returns the key that frees up first.
         """
-        # Try each key in the queue
-        for _ in range(len(self.key_queue)):
-            if not self._is_rate_limited(self.current_key):
-                return self.current_key
-            self.rotate_key()
-
-        # If all keys are rate limited, use the current one (it will be the least recently used)
-        return self.current_key
+        with self._locked():
+            now = self._clock()
+            key = self._least_loaded_locked(now)
+            if key is not None:
+                return key
+            return min(self.api_keys, key=lambda k: self._next_slot_locked(k, now))
     
-    def record_request(self):
+    def record_request(self, key=None):
         """
-        Record that a request was made with the current key.
+        Record that a request was made with the given key (default: the current key).
         """
-        self.request_history[self.current_key].append(time.time())
+        with self._locked():
+            self._record_locked(key or self.current_key, self._clock())
+
+    def stats(self):
+        """Return per-key usage within the current window, cooldowns and wait counters."""
+        with self._locked():
+            now = self._clock()
+            return {
+                "keys": len(self.api_keys),
+                "rate_limit": self.rate_limit,
+                "rate_window": self.rate_window,
+                "headroom": [self._headroom_locked(key, now) for key in self.api_keys],
+                "cooling_down_for": [round(max(0, self.cooldown_until[key] - now), 1) for key in self.api_keys],
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "cooldowns": self.cooldowns
+            }
     
     def with_key_rotation(self, func):
         """
         Decorator to automatically handle API key rotation for rate limits.
+
+        Each attempt claims a slot on the least loaded key. On a 429 the key cools
+        down and the call is retried on another key, or on the same key once its
+        cooldown ends, all within acquire_timeout.
         
         Usage:
             @key_manager.with_key_rotation
             def make_api_call(...):
-                # Use genai API here
+                model = gemini_model()  # bound to the key claimed for this call
         """
         @wraps(func)
         def wrapper(*args, **kwargs):
-            max_retries = len(self.api_keys)
-            retries = 0
-            
-            while retries < max_retries:
-                # Get an available key
-                key = self.get_available_key()
-                genai.configure(api_key=key)
-                
+            deadline = None if self.acquire_timeout is None else self._clock() + self.acquire_timeout
+            attempt = 0
+
+            while True:
+                # Claim a slot on an available key, waiting for one if all are busy
+                remaining = None if deadline is None else max(0, deadline - self._clock())
+                key = self.acquire(timeout=remaining)
+                if key is None:
+                    raise Exception("All API keys are rate limited")
+
+                # Models built with gemini_model() inside func use this key, and only this call sees it
+                token = ACTIVE_API_KEY.set(key)
                 try:
-                    # Record this request
-                    self.record_request()
-                    
                     # Call the function
-                    return func(*args, **kwargs)
-                    
+                    result = func(*args, **kwargs)
                 except Exception as e:
-                    error_message = str(e).lower()
-
-                    # Check if this is a rate limit error
-                    if "rate limit" in error_message or "quota" in error_message:
-                        retries += 1
-                        if retries < max_retries:
-                            print(f"Rate limit hit, rotating to next key. Retry {retries}/{max_retries}")
-                            self.rotate_key()
-                        else:
-                            print("All API keys are rate limited. Raising exception.")
-                            raise
-                    else:
-                        # If it's not a rate limit error, re-raise it
+                    # If it's not a rate limit error, re-raise it
+                    if not is_rate_limit_error(e):
                         raise
-            
-            # If we've exhausted all retries
-            raise Exception("All API keys are rate limited")
+
+                    attempt += 1
+                    cooldown = self.report_rate_limit(key, retry_delay_from_error(e))
+                    if attempt >= self.max_attempts:
+                        print("All API keys are rate limited. Raising exception.")
+                        raise
+                    print(f"Rate limit hit, key cooling down for {cooldown:.1f}s. Retry {attempt}/{self.max_attempts - 1}")
+                    continue
+                finally:
+                    ACTIVE_API_KEY.reset(token)
+
+                self.report_success(key)
+                return result
         
         return wrapper
 
+def load_api_keys_from_env(environ=None):
+    """
+    Collect the Gemini API keys from the environment, in order and without duplicates.
+
+    Keys come from GOOGLE_API_KEYS (comma-separated), then GOOGLE_API_KEY, then
+    GOOGLE_API_KEY_2, GOOGLE_API_KEY_3, ... in numeric order, with no upper limit.
+    """
+    environ = os.environ if environ is None else environ
+    keys = [key.strip() for key in environ.get('GOOGLE_API_KEYS', '').split(',')]
+    keys.append(environ.get('GOOGLE_API_KEY'))
+
+    numbered = []
+    for name, value in environ.items():
+        match = re.fullmatch(r'GOOGLE_API_KEY_(\d+)', name)
+        if match:
+            numbered.append((int(match.group(1)), value))
+    keys.extend(value for _, value in sorted(numbered))
+
+    # Filter out empty values and keys listed twice
+    unique_keys = []
+    for key in keys:
+        if key and key not in unique_keys:
+            unique_keys.append(key)
+    return unique_keys
+
 # Lazy initialization - don't create the manager until it's accessed
 _key_manager = None
+_key_manager_lock = threading.Lock()
 
 def get_key_manager():
     """Get or create the singleton key manager instance."""
     global _key_manager
     if _key_manager is None:
-        # Collect API keys from environment
-        api_keys = [
-            os.getenv('GOOGLE_API_KEY'),  # Original key from environment
-            os.getenv('GOOGLE_API_KEY_2'),
-            os.getenv('GOOGLE_API_KEY_3'),
-            os.getenv('GOOGLE_API_KEY_4')
-        ]
-        # Filter out any None values in case the environment variable isn't set
-        api_keys = [key for key in api_keys if key]
-
-        # Create the manager
-        _key_manager = GeminiKeyManager(api_keys)
+        with _key_manager_lock:
+            if _key_manager is None:
+                # Collect API keys from environment
+                api_keys = load_api_keys_from_env()
+
+                # Create the manager
+                # Worker processes on one host share quota state through a SQLite file
+                state_path = os.getenv('GEMINI_KEY_STATE_PATH')
+                shared_state = SqliteKeyState(state_path, rate_window=60) if state_path else None
+
+                _key_manager = GeminiKeyManager(
+                    api_keys,
+                    rate_limit=int(os.getenv('GEMINI_RATE_LIMIT', 15)),
+                    acquire_timeout=float(os.getenv('GEMINI_KEY_ACQUIRE_TIMEOUT', 30)),
+                    shared_state=shared_state,
+                    # Wall-clock time, since monotonic clocks are not comparable across processes
+                    clock=time.time if shared_state else time.monotonic
+                )
 
     return _key_manager
 
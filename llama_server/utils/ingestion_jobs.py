@@ -0,0 +1,206 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+class IngestionQueueFull(Exception):
+    """Raised by IngestionJobs.submit when max_queued jobs are already waiting."""
+
+class IngestionJobs:
+    """
+    Bulk ingestion that runs on a bounded worker pool after the request has returned.
+
+    A job is a list of (index, item) pairs, processed in slices by the function it
+    was submitted with. A slice that raises is retried up to max_retries times with
+    exponential backoff; callers give their items deterministic vector IDs, so a
+    retry overwrites what a failed attempt may have written instead of duplicating
+    it. A slice that keeps failing is recorded as per-item errors and the rest of
+    the job carries on.
+
+    Submitting again with the same key while the job for that key is queued or
+    running returns that job. After a partially failed job, it queues a job for
+    just the items that failed, which keep their deterministic IDs; after any
+    other finished job the items run again. Finished jobs are dropped after
+    ttl_seconds.
+    """
+
+    def __init__(self, workers=2, max_queued=100, max_retries=2, retry_delay=1.0, ttl_seconds=3600,
+                 clock=time.monotonic, sleep=time.sleep):
+        """
+        Initialize the queue.
+
+        Args:
+            workers: Number of jobs that run at the same time.
+            max_queued: Most jobs waiting for a worker; submit raises beyond that.
+            max_retries: Retries of a failing slice before its items are marked failed.
+            retry_delay: Seconds before the first retry; doubles with every retry.
+            ttl_seconds: How long a finished job stays addressable.
+            clock: Monotonic time source, injectable for tests.
+            sleep: Sleep function, injectable for tests.
+        """
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._sleep = sleep
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingestion")
+
+        self._jobs = {}  # job_id -> job dict
+        self._keys = {}  # (user_id, key) -> job_id
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.rejected = 0
+        self.retries = 0
+        self.failed_items = 0
+
+    def submit(self, user_id, items, process_slice, slice_size=32, key=None, errors=(), result=None):
+        """
+        Queue a job and return its ID.
+
+        Args:
+            user_id: The user the job belongs to.
+            items: List of (index, item) pairs; index is what per-item errors report.
+            process_slice: Called with a list of items; may return a dict of counts,
+                which are summed into the job's counts.
+            slice_size: Items per process_slice call.
+            key: Optional idempotency key supplied by the client; items are
+                matched to an earlier job for the key by their index.
+            errors: Items rejected before queueing, as {"index", "error"} dicts.
+            result: Extra fields reported with the job, e.g. the document IDs.
+        """
+        with self._lock:
+            self._prune_locked()
+            retry_of = None
+            if key is not None:
+                existing = self._jobs.get(self._keys.get((user_id, key)))
+                if existing is not None and existing["status"] in ("queued", "running"):
+                    return existing["job_id"]
+                if existing is not None and existing["status"] == "partially_failed":
+                    # What was stored stays; only the items that failed are processed again
+                    items = [(index, item) for index, item in items if index in existing["failed_indices"]]
+                    retry_of = existing["job_id"]
+
+            queued = sum(1 for job in self._jobs.values() if job["status"] == "queued")
+            if queued >= self.max_queued:
+                self.rejected += 1
+                raise IngestionQueueFull(f"{queued} ingestion jobs are already queued")
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "user_id": user_id,
+                "status": "queued",
+                "total": len(items) + len(errors),
+                "processed": 0,
+                "failed": len(errors),
+                "errors": list(errors),
+                "failed_indices": set(),
+                "retries": 0,
+                "counts": {},
+                "result": dict(result or {}, **({"retry_of": retry_of} if retry_of else {})),
+                "submitted_at": self._clock(),
+                "started_at": None,
+                "finished_at": None
+            }
+            if key is not None:
+                self._keys[(user_id, key)] = job_id
+            self.submitted += 1
+
+        self._executor.submit(self._run, job_id, list(items), process_slice, slice_size)
+        return job_id
+
+    def _run(self, job_id, items, process_slice, slice_size):
+        with self._lock:
+            job = self._jobs[job_id]
+            job["status"] = "running"
+            job["started_at"] = self._clock()
+
+        for start in range(0, len(items), slice_size):
+            batch = items[start:start + slice_size]
+            counts, error = self._process_with_retries(job, process_slice, [item for _, item in batch])
+            with self._lock:
+                if error is None:
+                    job["processed"] += len(batch)
+                    for name, value in counts.items():
+                        job["counts"][name] = job["counts"].get(name, 0) + value
+                else:
+                    job["failed"] += len(batch)
+                    job["errors"].extend({"index": index, "error": error} for index, _ in batch)
+                    job["failed_indices"].update(index for index, _ in batch)
+                    self.failed_items += len(batch)
+
+        with self._lock:
+            if job["failed"] == 0:
+                job["status"] = "succeeded"
+            elif job["processed"] == 0:
+                job["status"] = "failed"
+            else:
+                job["status"] = "partially_failed"
+            job["finished_at"] = self._clock()
+        print(f"[INGESTION] Job {job_id} {job['status']}: {job['processed']}/{job['total']} items, "
+              f"{job['failed']} failed, {job['retries']} retries")
+
+    def _process_with_retries(self, job, process_slice, batch):
+        """Run one slice; returns (counts, None) or (None, error message) once retries are used up."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return process_slice(batch) or {}, None
+            except Exception as e:
+                print(f"[INGESTION] Job {job['job_id']} slice failed (attempt {attempt + 1}): {e}")
+                if attempt == self.max_retries:
+                    return None, str(e)
+                with self._lock:
+                    job["retries"] += 1
+                    self.retries += 1
+                self._sleep(self.retry_delay * 2 ** attempt)
+
+    def _prune_locked(self):
+        now = self._clock()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished_at"] is not None and now - job["finished_at"] > self.ttl_seconds
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self._keys = {key: job_id for key, job_id in self._keys.items() if job_id in self._jobs}
+
+    def status(self, job_id, user_id=None):
+        """
+        Return the public state of a job, or None if it is unknown or expired.
+
+        Args:
+            job_id: ID returned by submit.
+            user_id: When given, only the user the job was submitted for can read it.
+        """
+        with self._lock:
+            self._prune_locked()
+            job = self._jobs.get(job_id)
+            if job is None or (user_id is not None and user_id != job["user_id"]):
+                return None
+
+            end = job["finished_at"] if job["finished_at"] is not None else self._clock()
+            status = {
+                key: job[key]
+                for key in ("job_id", "status", "total", "processed", "failed", "retries")
+            }
+            status["errors"] = list(job["errors"])
+            status["counts"] = dict(job["counts"])
+            status.update(job["result"])
+            status["elapsed_ms"] = int((end - job["submitted_at"]) * 1000)
+            return status
+
+    def stats(self):
+        """Return submission counters and the number of jobs in each state."""
+        with self._lock:
+            states = {}
+            for job in self._jobs.values():
+                states[job["status"]] = states.get(job["status"], 0) + 1
+            return {
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "retries": self.retries,
+                "failed_items": self.failed_items,
+                "jobs": states
+            }
@@ -0,0 +1,108 @@
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+class SqliteKeyState:
+    """
+    Gemini key usage (recent request times, cooldowns and backoff strikes) in a
+    SQLite file, so every worker process on a host shares one view of the quota.
+
+    Each read-modify-write of the key manager runs in a BEGIN IMMEDIATE transaction,
+    which holds SQLite's write lock, so two processes can never both take the last
+    slot of a key. API keys are stored only as hashes.
+    """
+
+    def __init__(self, path, rate_window=60, timeout=10):
+        """
+        Initialize the store, creating the database file and tables if needed.
+
+        Args:
+            path: Path of the SQLite database file.
+            rate_window: Request times older than this are deleted.
+            timeout: Seconds to wait for another process's transaction to finish.
+        """
+        self.path = path
+        self.rate_window = rate_window
+        self.timeout = timeout
+        self._local = threading.local()  # sqlite3 connections must stay on their thread
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS key_requests ("
+            "key_id TEXT NOT NULL, requested_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS key_requests_by_time "
+            "ON key_requests (requested_at)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS key_cooldowns ("
+            "key_id TEXT PRIMARY KEY, cooldown_until REAL NOT NULL, strikes INTEGER NOT NULL)"
+        )
+
+    @staticmethod
+    def key_id(api_key):
+        """Stable identifier of an API key that does not reveal it."""
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self, now):
+        """
+        Hold the cross-process write lock and yield a KeyStateTransaction.
+
+        Request times that left the window are deleted first. Changes are committed
+        when the block exits normally and rolled back if it raises.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM key_requests WHERE requested_at <= ?", (now - self.rate_window,))
+            yield KeyStateTransaction(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+class KeyStateTransaction:
+    """Reads and writes of key state inside one SqliteKeyState transaction."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def request_times(self):
+        """Request times in the window, per key ID, oldest first."""
+        times = {}
+        for key_id, requested_at in self._conn.execute(
+            "SELECT key_id, requested_at FROM key_requests ORDER BY requested_at"
+        ):
+            times.setdefault(key_id, []).append(requested_at)
+        return times
+
+    def cooldowns(self):
+        """(cooldown_until, strikes) per key ID."""
+        return {
+            key_id: (cooldown_until, strikes)
+            for key_id, cooldown_until, strikes in self._conn.execute(
+                "SELECT key_id, cooldown_until, strikes FROM key_cooldowns"
+            )
+        }
+
+    def add_requests(self, requests):
+        """Record (key_id, requested_at) pairs."""
+        self._conn.executemany("INSERT INTO key_requests (key_id, requested_at) VALUES (?, ?)", requests)
+
+    def set_cooldown(self, key_id, cooldown_until, strikes):
+        self._conn.execute(
+            "INSERT INTO key_cooldowns (key_id, cooldown_until, strikes) VALUES (?, ?, ?) "
+            "ON CONFLICT(key_id) DO UPDATE SET cooldown_until = excluded.cooldown_until, strikes = excluded.strikes",
+            (key_id, cooldown_until, strikes)
+        )
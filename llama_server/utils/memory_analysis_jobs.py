@@ -0,0 +1,101 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+
+class MemoryAnalysisJobs:
+    """
+    Memory analyses that run on a worker pool after the answer has been returned.
+
+    Each submitted analysis gets an ID the client polls until the result is ready.
+    Finished and abandoned analyses are dropped after ttl_seconds.
+    """
+
+    def __init__(self, workers=4, ttl_seconds=600, clock=time.monotonic):
+        """
+        Initialize the job registry.
+
+        Args:
+            workers: Number of analyses that run at the same time.
+            ttl_seconds: How long an analysis stays addressable after it was submitted.
+            clock: Monotonic time source, injectable for tests.
+        """
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="memory-analysis")
+
+        self._jobs = {}  # analysis_id -> (future, user_id, submitted_at)
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.failed = 0
+        self.expired = 0
+
+    def submit(self, user_id, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in the background and return the ID of the analysis."""
+        analysis_id = uuid.uuid4().hex
+        future = self._executor.submit(func, *args, **kwargs)
+        future.add_done_callback(self._count_failure)
+        with self._lock:
+            self._prune_locked()
+            self._jobs[analysis_id] = (future, user_id, self._clock())
+            self.submitted += 1
+        return analysis_id
+
+    def _count_failure(self, future):
+        if future.exception() is not None:
+            with self._lock:
+                self.failed += 1
+
+    def _prune_locked(self):
+        now = self._clock()
+        expired = [
+            analysis_id for analysis_id, (_, _, submitted_at) in self._jobs.items()
+            if now - submitted_at > self.ttl_seconds
+        ]
+        for analysis_id in expired:
+            del self._jobs[analysis_id]
+        self.expired += len(expired)
+
+    def status(self, analysis_id, user_id=None, timeout=0):
+        """
+        Return the state of an analysis, or None if it is unknown or expired.
+
+        Args:
+            analysis_id: ID returned by submit.
+            user_id: When given, only the user the analysis was submitted for can read it.
+            timeout: Seconds to wait for a pending analysis before reporting it as pending.
+
+        Returns:
+            {"status": "pending"}, {"status": "done", "result": ...} or
+            {"status": "failed", "error": ...}.
+        """
+        with self._lock:
+            self._prune_locked()
+            job = self._jobs.get(analysis_id)
+        if job is None:
+            return None
+
+        future, job_user_id, _ = job
+        if user_id is not None and user_id != job_user_id:
+            return None
+
+        try:
+            result = future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            return {"status": "pending"}
+        except Exception as e:
+            return {"status": "failed", "error": str(e)}
+        return {"status": "done", "result": result}
+
+    def stats(self):
+        """Return submission counters and the number of analyses still held."""
+        with self._lock:
+            pending = sum(1 for future, _, _ in self._jobs.values() if not future.done())
+            return {
+                "submitted": self.submitted,
+                "failed": self.failed,
+                "expired": self.expired,
+                "pending": pending,
+                "held": len(self._jobs)
+            }
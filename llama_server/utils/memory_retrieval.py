@@ -0,0 +1,131 @@
+import datetime
+import os
+
+import numpy as np
+
+# Keywords that route a query to category-specific memory selection
+MEMORY_QUERY_CATEGORIES = {
+    "contact": ["email", "phone", "address", "contact", "number", "uid"],
+    "preference": ["prefer", "like", "dislike", "favorite", "hate"],
+    "personal": ["birthday", "age", "name", "family", "spouse", "child"],
+    "work": ["job", "work", "career", "company", "position", "role", "business"],
+    "education": ["university", "college", "school", "degree", "major", "study", "class"],
+    "health": ["allergy", "medication", "condition", "doctor", "health"],
+    "technical": ["software", "hardware", "version", "upgrade", "api", "code", "app", "application"],
+}
+
+# How many of a user's memories one candidate query pulls back. Memory sets are
+# small, so this normally covers the whole set and local selection is exact.
+MEMORY_CANDIDATE_TOP_K = int(os.getenv('MEMORY_CANDIDATE_TOP_K', 200))
+
+# Memories at or above this importance are included regardless of query relevance
+CRITICAL_IMPORTANCE = 8
+MAX_CRITICAL_MEMORIES = 5
+
+def detect_query_categories(query_text):
+    """Return the memory categories whose keywords appear in the query, in declaration order."""
+    query_lower = query_text.lower()
+    query_categories = []
+    for category, keywords in MEMORY_QUERY_CATEGORIES.items():
+        if any(keyword in query_lower for keyword in keywords):
+            query_categories.append(category)
+            print(f"[MEMORY RETRIEVAL] Query matches category: {category}")
+
+    if not query_categories:
+        print("[MEMORY RETRIEVAL] No specific category matched, using general search")
+    return query_categories
+
+def memory_candidate_query(query_vector, user_id, optimal_doc_count=3):
+    """Keyword arguments for the single Pinecone query that fetches a user's candidate memories."""
+    return {
+        "vector": query_vector,
+        "top_k": max(MEMORY_CANDIDATE_TOP_K, optimal_doc_count * 2),
+        "include_metadata": True,
+        "filter": {"user_id": user_id, "type": "memory"}
+    }
+
+def _days_old(timestamp_str, now):
+    """Age of a memory in whole days, or NaN when it has no usable timestamp."""
+    if not timestamp_str:
+        return np.nan
+    try:
+        timestamp = datetime.datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
+        return (now - timestamp).days
+    except Exception as e:
+        print(f"[MEMORY RETRIEVAL] Error calculating recency: {e}")
+        return np.nan
+
+def score_memories(memories, now):
+    """
+    Final scores for a list of memories as a float64 array: semantic similarity plus
+    an importance boost (up to 0.5) and a recency boost (up to 0.3, fading over 100 days).
+    """
+    base_scores = np.array([memory.get("score", 0) for memory in memories], dtype=np.float64)
+    importance = np.array([memory["metadata"].get("importance", 5) for memory in memories], dtype=np.float64)
+    days_old = np.array([_days_old(memory["metadata"].get("timestamp"), now) for memory in memories], dtype=np.float64)
+
+    recency_modifiers = np.where(np.isnan(days_old), 0, np.maximum(0, 0.3 - (days_old / 100 * 0.3)))
+    return base_scores + importance / 20 + recency_modifiers
+
+def select_memories(candidates, query_categories, optimal_doc_count=3, now=None):
+    """
+    Select and rank memories from one candidate set, locally.
+
+    candidates are the matches of memory_candidate_query, sorted by similarity.
+    The selection mirrors the former multi-query retrieval:
+      1. the top optimal_doc_count memories of each category matched by the query,
+      2. the top optimal_doc_count * 2 memories overall,
+      3. up to MAX_CRITICAL_MEMORIES memories with importance >= CRITICAL_IMPORTANCE,
+         included regardless of relevance (with a similarity of 0).
+    De-duplication is set-based. Returns the top optimal_doc_count memories by
+    final_score, each annotated with its source and final_score.
+    """
+    now = now or datetime.datetime.now()
+    selected = []
+    seen_ids = set()
+
+    def add(match, source, score=None):
+        seen_ids.add(match["id"])
+        selected.append({
+            "id": match["id"],
+            "score": match["score"] if score is None else score,
+            "values": match.get("values", []),
+            "metadata": match["metadata"],
+            "source": source
+        })
+
+    # Step 1: category-specific memories
+    for category in query_categories:
+        in_category = [m for m in candidates if m["metadata"].get("category") == category]
+        for match in in_category[:optimal_doc_count]:
+            if match["id"] not in seen_ids:
+                add(match, f"category:{category}")
+        print(f"[MEMORY RETRIEVAL] Found {min(len(in_category), optimal_doc_count)} memories in category {category}")
+
+    # Step 2: general memories by semantic similarity
+    general = candidates[:optimal_doc_count * 2]
+    for match in general:
+        if match["id"] not in seen_ids:
+            add(match, "general")
+    print(f"[MEMORY RETRIEVAL] Found {len(general)} general memories")
+
+    # Step 3: critical high-importance memories regardless of query relevance
+    critical = [
+        m for m in candidates
+        if m["id"] not in seen_ids and m["metadata"].get("importance", 0) >= CRITICAL_IMPORTANCE
+    ]
+    critical.sort(key=lambda m: (m["metadata"].get("importance", 0), m["metadata"].get("timestamp", "")), reverse=True)
+    for match in critical[:MAX_CRITICAL_MEMORIES]:
+        add(match, "important", score=0)
+    print(f"[MEMORY RETRIEVAL] Found {min(len(critical), MAX_CRITICAL_MEMORIES)} important memories")
+
+    # Step 4: rank by a combined score of similarity, importance and recency
+    if not selected:
+        return []
+    final_scores = score_memories(selected, now)
+    final_memories = []
+    for position in np.argsort(-final_scores, kind="stable")[:optimal_doc_count]:
+        memory = selected[position]
+        memory["final_score"] = float(final_scores[position])
+        final_memories.append(memory)
+    return final_memories
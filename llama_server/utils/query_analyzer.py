@@ -0,0 +1,153 @@
+import re
+import threading
+
+import numpy as np
+
+# Words that usually point back at the conversation, so the query cannot be
+# understood (or expanded) without the history
+CONTEXT_DEPENDENT_WORDS = {
+    "it", "its", "that", "this", "these", "those", "they", "them", "their",
+    "he", "him", "his", "she", "her", "there", "same", "else", "more", "again",
+    "above", "previous", "earlier", "also", "too"
+}
+
+# Queries that need more than a quick lookup; left to the LLM analyzer
+COMPLEX_QUERY_WORDS = {
+    "compare", "comparison", "difference", "differences", "versus", "vs",
+    "why", "explain", "pros", "cons", "between"
+}
+
+# Prototype queries per document count, used by the nearest-prototype classifier
+DOCUMENT_COUNT_PROTOTYPES = {
+    2: [
+        "hi",
+        "hello there",
+        "how are you?",
+        "thanks!",
+        "good morning",
+    ],
+    3: [
+        "who are you?",
+        "what is your name?",
+        "where do you work?",
+        "what is your email?",
+        "where did you study?",
+        "what is your current job title?",
+    ],
+    8: [
+        "tell me about yourself",
+        "what projects have you worked on?",
+        "summarize your experience",
+        "what are all of your skills?",
+        "describe your career so far",
+        "what have you written about?",
+    ],
+}
+
+class LocalQueryAnalyzer:
+    """
+    A local tier in front of the LLM query analysis call.
+
+    Short, self-contained queries need no expansion, and their document count can be
+    estimated with a nearest-prototype classifier over the query embedding. When the
+    analyzer is unsure it returns None and the caller falls back to the LLM.
+    """
+
+    def __init__(self, embed, max_words=12, min_similarity=0.5, min_margin=0.05):
+        """
+        Initialize the analyzer.
+
+        Args:
+            embed: Callable that takes a list of texts and returns a 2D array of embeddings.
+            max_words: Longest query (in words) handled locally.
+            min_similarity: Minimum cosine similarity to the best prototype class.
+            min_margin: Minimum lead of the best prototype class over the runner-up.
+        """
+        self._embed = embed
+        self.max_words = max_words
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+
+        self._prototype_matrix = None
+        self._prototype_counts = None
+        self._lock = threading.Lock()
+
+        self.local_decisions = 0
+        self.llm_fallbacks = 0
+        self.fallback_reasons = {}
+
+    def _prototypes(self):
+        """Embed the prototype queries once, as a normalized matrix."""
+        if self._prototype_matrix is None:
+            with self._lock:
+                if self._prototype_matrix is None:
+                    texts = []
+                    counts = []
+                    for doc_count, prototypes in DOCUMENT_COUNT_PROTOTYPES.items():
+                        texts.extend(prototypes)
+                        counts.extend([doc_count] * len(prototypes))
+                    matrix = np.asarray(self._embed(texts), dtype=np.float32)
+                    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+                    self._prototype_counts = np.asarray(counts)
+                    self._prototype_matrix = matrix
+        return self._prototype_matrix, self._prototype_counts
+
+    def classify_document_count(self, query_text):
+        """Return (document count, confident) from the nearest prototype class."""
+        matrix, counts = self._prototypes()
+        query_vector = np.asarray(self._embed([query_text])[0], dtype=np.float32)
+        norm = np.linalg.norm(query_vector)
+        if norm == 0:
+            return None, False
+
+        similarities = matrix @ (query_vector / norm)
+        class_counts = sorted(DOCUMENT_COUNT_PROTOTYPES)
+        class_scores = np.array([similarities[counts == count].max() for count in class_counts])
+
+        ranked = np.argsort(-class_scores)
+        best, runner_up = class_scores[ranked[0]], class_scores[ranked[1]]
+        confident = best >= self.min_similarity and best - runner_up >= self.min_margin
+        return class_counts[ranked[0]], confident
+
+    def _fallback(self, reason):
+        with self._lock:
+            self.llm_fallbacks += 1
+            self.fallback_reasons[reason] = self.fallback_reasons.get(reason, 0) + 1
+        return None
+
+    def analyze(self, query_text, conversation_history=""):
+        """
+        Try to analyze the query locally.
+
+        Returns (expanded_query, document_count) when the query is simple enough,
+        or None when the caller should fall back to the LLM analyzer.
+        """
+        words = re.findall(r"[a-z0-9']+", query_text.lower())
+        if not words:
+            return self._fallback("empty")
+        if len(words) > self.max_words:
+            return self._fallback("long")
+        if query_text.count("?") > 1 or COMPLEX_QUERY_WORDS.intersection(words):
+            return self._fallback("complex")
+        if conversation_history and conversation_history.strip() and CONTEXT_DEPENDENT_WORDS.intersection(words):
+            return self._fallback("refers_to_history")
+
+        doc_count, confident = self.classify_document_count(query_text)
+        if not confident:
+            return self._fallback("low_confidence")
+
+        with self._lock:
+            self.local_decisions += 1
+        # A self-contained query is its own best expansion
+        return query_text, doc_count
+
+    def stats(self):
+        """Return how often the LLM call was skipped and why it was not."""
+        with self._lock:
+            total = self.local_decisions + self.llm_fallbacks
+            return {
+                "local_decisions": self.local_decisions,
+                "llm_fallbacks": self.llm_fallbacks,
+                "skip_rate": round(self.local_decisions / total, 4) if total else 0.0,
+                "fallback_reasons": dict(self.fallback_reasons)
+            }
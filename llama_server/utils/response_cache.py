@@ -0,0 +1,119 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+class ResponseCache:
+    """
+    An LRU cache with TTL for generated answers, versioned per user.
+
+    Every user has a corpus version that write paths bump whenever the user's
+    documents or memories change. Entries are stored under the version that was
+    current when the answer was computed, so after a bump the old answers can never
+    be served again (and are dropped right away to free memory).
+
+    Versions live in process unless a shared store is given (see
+    utils/corpus_versions.py); with several worker processes it must be, or a
+    write handled by one worker would not invalidate answers cached by the others.
+    """
+
+    def __init__(self, max_entries=2048, ttl_seconds=3600, clock=time.monotonic, versions=None):
+        """
+        Initialize the cache.
+
+        Args:
+            max_entries: Most answers kept; the least recently used one is evicted beyond that.
+            ttl_seconds: How long an answer stays valid after it was stored.
+            clock: Monotonic time source, injectable for tests.
+            versions: Optional shared version store with get(user_id) and bump(user_id).
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+
+        self._entries = OrderedDict()  # (user_id, version, digest) -> (value, stored_at)
+        self._versions = {}  # user_id -> corpus version, unless shared_versions is set
+        self.shared_versions = versions
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(*parts):
+        """Digest of the request parts an answer depends on."""
+        encoded = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def version(self, user_id):
+        """Current corpus version of user_id; read it before computing an answer."""
+        if self.shared_versions is not None:
+            return self.shared_versions.get(user_id)
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def bump(self, user_id):
+        """Mark user_id's corpus as changed, invalidating every cached answer for it."""
+        if self.shared_versions is not None:
+            self.shared_versions.bump(user_id)
+        with self._lock:
+            if self.shared_versions is None:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            stale = [key for key in self._entries if key[0] == user_id]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def get(self, user_id, version, digest):
+        """Return the cached answer, or None if it is missing, expired or from an older version."""
+        key = (user_id, version, digest)
+        current = self.version(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or version != current:
+                self.misses += 1
+                return None
+
+            value, stored_at = entry
+            if self._clock() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, user_id, version, digest, value):
+        """
+        Store an answer computed against corpus version. Does nothing if the corpus
+        changed while the answer was being computed.
+        """
+        current = self.version(user_id)
+        with self._lock:
+            if version != current:
+                return
+            key = (user_id, version, digest)
+            self._entries[key] = (value, self._clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds
+            }
@@ -0,0 +1,171 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+class _ScopeEntries:
+    """The cached (query vector, answer) pairs of one scope, as rows of a float32 matrix."""
+
+    def __init__(self, dimension, version, initial_capacity=8):
+        self.version = version
+        self.vectors = np.zeros((initial_capacity, dimension), dtype=np.float32)
+        self.stored_at = np.zeros(initial_capacity, dtype=np.float64)
+        self.answers = [None] * initial_capacity
+        self.context_hashes = [None] * initial_capacity
+        self.size = 0
+
+    def grow(self, capacity):
+        extra = capacity - len(self.answers)
+        self.vectors = np.vstack([self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)])
+        self.stored_at = np.concatenate([self.stored_at, np.zeros(extra)])
+        self.answers.extend([None] * extra)
+        self.context_hashes.extend([None] * extra)
+
+class SemanticAnswerCache:
+    """
+    Answers to recent questions, found again by query embedding similarity.
+
+    Each scope (a profile plus whatever else the answer depends on) keeps its
+    normalized query vectors in one NumPy matrix, so a lookup is a single
+    matrix-vector product. An answer is served when the best cosine similarity
+    reaches threshold and it was stored under the scope's current corpus version.
+
+    Entries expire after ttl_seconds; a full scope replaces its oldest entry, and
+    the least recently used scope is dropped beyond max_scopes.
+
+    A sample of hits (audit_rate) can be audited by the caller: it recomputes the
+    context the new question would retrieve and reports with record_audit whether
+    it matches the cached answer's context. A mismatch counts as a false hit.
+    """
+
+    def __init__(self, dimension=768, threshold=0.92, max_entries_per_scope=64, max_scopes=256,
+                 ttl_seconds=3600, audit_rate=0.05, clock=time.monotonic, rng=None):
+        """
+        Initialize the cache.
+
+        Args:
+            dimension: Length of the query vectors.
+            threshold: Minimum cosine similarity for a cached answer to be served.
+            max_entries_per_scope: Most answers kept per scope.
+            max_scopes: Most scopes kept; the least recently used one is dropped beyond that.
+            ttl_seconds: How long an answer stays valid after it was stored.
+            audit_rate: Fraction of hits flagged for a false-hit audit.
+            clock: Monotonic time source, injectable for tests.
+            rng: random.Random used to sample audits, injectable for tests.
+        """
+        self.dimension = dimension
+        self.threshold = threshold
+        self.max_entries_per_scope = max_entries_per_scope
+        self.max_scopes = max_scopes
+        self.ttl_seconds = ttl_seconds
+        self.audit_rate = audit_rate
+        self._clock = clock
+        self._rng = rng or random.Random()
+
+        self._scopes = OrderedDict()  # scope -> _ScopeEntries
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.audits = 0
+        self.false_hits = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _entries_locked(self, scope, version):
+        """The entries of scope, reset if they belong to an older corpus version."""
+        entries = self._scopes.get(scope)
+        if entries is not None and entries.version != version:
+            del self._scopes[scope]
+            entries = None
+        if entries is not None:
+            self._scopes.move_to_end(scope)
+        return entries
+
+    def lookup(self, scope, version, vector):
+        """
+        Find a cached answer for a query vector.
+
+        Returns:
+            (answer, similarity, context_hash, audit) for a hit, where audit tells the
+            caller to check this hit; None for a miss.
+        """
+        query = self._normalize(vector)
+        with self._lock:
+            entries = self._entries_locked(scope, version)
+            if entries is None or entries.size == 0:
+                self.misses += 1
+                return None
+
+            similarities = entries.vectors[:entries.size] @ query
+            expired = self._clock() - entries.stored_at[:entries.size] > self.ttl_seconds
+            similarities[expired] = -np.inf
+
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            audit = self._rng.random() < self.audit_rate
+            return entries.answers[best], similarity, entries.context_hashes[best], audit
+
+    def store(self, scope, version, vector, answer, context_hash=None):
+        """Cache answer for a query vector under the scope's corpus version."""
+        row = self._normalize(vector)
+        with self._lock:
+            entries = self._entries_locked(scope, version)
+            if entries is None:
+                entries = _ScopeEntries(self.dimension, version, min(8, self.max_entries_per_scope))
+                self._scopes[scope] = entries
+                while len(self._scopes) > self.max_scopes:
+                    self._scopes.popitem(last=False)
+
+            if entries.size < len(entries.answers):
+                position = entries.size
+                entries.size += 1
+            elif entries.size < self.max_entries_per_scope:
+                entries.grow(min(self.max_entries_per_scope, entries.size * 2))
+                position = entries.size
+                entries.size += 1
+            else:
+                # Full: replace the oldest entry (expired ones are always the oldest)
+                position = int(np.argmin(entries.stored_at[:entries.size]))
+                self.evictions += 1
+
+            entries.vectors[position] = row
+            entries.stored_at[position] = self._clock()
+            entries.answers[position] = answer
+            entries.context_hashes[position] = context_hash
+
+    def record_audit(self, false_hit):
+        """Record the outcome of an audited hit."""
+        with self._lock:
+            self.audits += 1
+            if false_hit:
+                self.false_hits += 1
+
+    def stats(self):
+        """Return hit and audit counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "audits": self.audits,
+                "false_hits": self.false_hits,
+                "false_hit_rate": round(self.false_hits / self.audits, 4) if self.audits else 0.0,
+                "scopes": len(self._scopes),
+                "entries": sum(entries.size for entries in self._scopes.values()),
+                "threshold": self.threshold
+            }
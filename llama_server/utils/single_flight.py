@@ -0,0 +1,89 @@
+import threading
+
+class _Call:
+    """One in-flight call: its result (or error) and the event followers wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call for a key is running, other
+    callers with the same key wait for its result instead of repeating the work.
+
+    Followers wait at most timeout seconds. If the leader is stuck they run the call
+    themselves, so one slow request cannot hang everyone behind it. Nothing is cached
+    once the leader finishes; the next call for the key starts a new flight.
+    """
+
+    def __init__(self, timeout=30):
+        """
+        Initialize the coalescer.
+
+        Args:
+            timeout: Longest time a follower waits for the leader before running the call itself.
+        """
+        self.timeout = timeout
+        self._calls = {}  # key -> _Call
+        self._lock = threading.Lock()
+
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def do(self, key, func):
+        """
+        Return func(), sharing the result with concurrent callers that pass the same key.
+
+        If the leader's call raises, its followers get the same exception.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+                leader = True
+            else:
+                call.followers += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = func()
+                return call.result
+            except Exception as e:
+                call.error = e
+                with self._lock:
+                    self.errors += 1
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if not call.done.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            return func()
+
+        with self._lock:
+            self.coalesced += 1
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        """Return how many calls led, how many were coalesced and how many gave up waiting."""
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+                "in_flight": len(self._calls)
+            }
@@ -0,0 +1,96 @@
+import re
+
+# Headers the Node server puts at the start of documents it collects
+_SOURCE_HEADERS = (
+    ("Repository Name:", "github"),
+    ("Medium Aricle", "medium"),
+    ("Medium Article", "medium"),
+    ("Reddit Post", "reddit"),
+    ("Image Analysis:", "image"),
+)
+
+# Documents are JSON-encoded strings, so the newline may be a literal "\n"
+_PDF_NAME = re.compile(r'PDF Name:\s*(.*?)\s*(?:\\n|\n)\s*PDF Content:')
+
+def infer_source_metadata(text):
+    """
+    Guess a document's source from the header the Node server gave its text.
+
+    Returns {"source": ...} (plus "pdf_filename" for PDFs), or {} when the text
+    has no recognizable header, e.g. JSON-encoded profiles.
+    """
+    head = (text or "")[:1000].lstrip('"').lstrip()
+    if head.startswith("PDF Name:"):
+        match = _PDF_NAME.search(head)
+        if match:
+            return {"source": "pdf", "pdf_filename": match.group(1)}
+        return {"source": "pdf"}
+    for header, source in _SOURCE_HEADERS:
+        if head.startswith(header):
+            return {"source": source}
+    return {}
+
+def source_metadata(source="", pdf_filename="", text=""):
+    """
+    The source fields to store with a document. Explicit values win; otherwise they
+    are inferred from the text's header. Sources are stored lowercase.
+    """
+    fields = {} if source else infer_source_metadata(text)
+    if source:
+        fields["source"] = source.lower()
+    if pdf_filename:
+        fields["pdf_filename"] = pdf_filename
+        fields.setdefault("source", "pdf")
+    return fields
+
+def matches_legacy_source(text, source, pdf_filename=""):
+    """
+    Text match for vectors stored before source metadata was recorded: a PDF is
+    matched by the file name in its header, any other source by its name appearing
+    in the text.
+    """
+    if source == "pdf" and pdf_filename:
+        return f"PDF Name: {pdf_filename}" in text
+    return source.lower() in text.lower()
+
+def source_deletion_pages(store, user_id, source="", pdf_filename="", page_size=1000):
+    """
+    Yield pages of the vector IDs of user_id's documents from source (all of the
+    user's vectors when source is empty), or of one PDF when pdf_filename is given.
+
+    Documents are selected by their source metadata. Vectors without any, such as
+    JSON profiles stored before it was recorded, fall back to matches_legacy_source;
+    a match on any chunk selects the whole document. Only those vectors' texts are
+    fetched.
+    """
+    if not source:
+        for page in store.user_pages(user_id, page_size=page_size):
+            yield [record["id"] for record in page]
+        return
+
+    source = source.lower()
+    if source == "pdf" and pdf_filename:
+        source_filter = {"source": "pdf", "pdf_filename": pdf_filename}
+    else:
+        source_filter = {"source": source}
+    for page in store.user_pages(user_id, filter=source_filter, page_size=page_size):
+        yield [record["id"] for record in page]
+
+    ids_by_parent = {}
+    matched_parents = set()
+    for page in store.user_pages(user_id, page_size=page_size):
+        unlabeled = [record for record in page if not record["metadata"].get("source")]
+        for start in range(0, len(unlabeled), 100):
+            batch = unlabeled[start:start + 100]
+            stored = store.fetch([record["id"] for record in batch])
+            for record in batch:
+                vector_id = record["id"]
+                parent_id = record["metadata"].get("parent_id", vector_id)
+                ids_by_parent.setdefault(parent_id, []).append(vector_id)
+                text = stored.get(vector_id, {}).get("metadata", {}).get("text", "")
+                if matches_legacy_source(text, source, pdf_filename):
+                    matched_parents.add(parent_id)
+
+    legacy_ids = [vector_id for parent_id in matched_parents for vector_id in ids_by_parent[parent_id]]
+    for start in range(0, len(legacy_ids), page_size):
+        yield legacy_ids[start:start + page_size]
@@ -0,0 +1,313 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.single_flight import SingleFlight
+from utils.vector_store import VectorStore, filter_user_id, matches_filter
+
+# Rough per-record cost of the metadata dict on top of its text
+METADATA_OVERHEAD_BYTES = 256
+
+class _UserVectors:
+    """One user's records: a float32 matrix with its norms, plus IDs and metadata per row."""
+
+    def __init__(self, records, dimension):
+        self.ids = [record["id"] for record in records]
+        self.metadata = [dict(record.get("metadata") or {}) for record in records]
+        self.vectors = np.zeros((max(len(records), 8), dimension), dtype=np.float32)
+        for row, record in enumerate(records):
+            self.vectors[row] = record["values"]
+        self.norms = np.linalg.norm(self.vectors, axis=1)
+        self.row_of = {vector_id: row for row, vector_id in enumerate(self.ids)}
+        self.loaded_at = 0.0
+        self.corpus_version = None
+
+    @property
+    def size(self):
+        return len(self.ids)
+
+    def nbytes(self):
+        metadata_bytes = sum(len(str(metadata.get("text", ""))) + METADATA_OVERHEAD_BYTES for metadata in self.metadata)
+        return self.vectors.nbytes + self.norms.nbytes + metadata_bytes
+
+    def put(self, vector_id, values, metadata):
+        row = self.row_of.get(vector_id)
+        if row is None:
+            row = self.size
+            if row >= len(self.vectors):
+                self.vectors = np.vstack([self.vectors, np.zeros_like(self.vectors)])
+                self.norms = np.concatenate([self.norms, np.zeros_like(self.norms)])
+            self.ids.append(vector_id)
+            self.metadata.append(None)
+            self.row_of[vector_id] = row
+        self.vectors[row] = values
+        self.norms[row] = np.linalg.norm(self.vectors[row])
+        self.metadata[row] = dict(metadata or {})
+
+    def remove(self, vector_id):
+        """Remove a record by moving the last row into its place."""
+        row = self.row_of.pop(vector_id)
+        last = self.size - 1
+        if row != last:
+            self.vectors[row] = self.vectors[last]
+            self.norms[row] = self.norms[last]
+            self.ids[row] = self.ids[last]
+            self.metadata[row] = self.metadata[last]
+            self.row_of[self.ids[row]] = row
+        self.ids.pop()
+        self.metadata.pop()
+
+class HotTierVectorStore(VectorStore):
+    """
+    Keeps the vectors of recently active users in process, in front of a slower store.
+
+    The first user-scoped query for a user loads all of that user's records from the
+    backing store into a float32 matrix; later queries are answered locally with one
+    matrix-vector product and the filter applied to the cached metadata. Users are
+    evicted least recently used once the tier exceeds max_bytes, and reloaded after
+    ttl_seconds so writes made by other processes show up eventually. Given a
+    corpus_version function, a user is also reloaded as soon as their version moves
+    on, so writes announced through a shared version store show up right away.
+
+    Writes go to the backing store first and are then applied to the loaded users,
+    so this process always reads its own writes. A load that overlaps an upsert
+    of the same user's records is not installed, since its snapshot may predate
+    the write; records deleted while a load is in flight are left out of it. Users with
+    max_user_vectors or more records, and queries not restricted to one user, go
+    straight to the backing store.
+    """
+
+    def __init__(self, backing, dimension=768, max_bytes=256 * 1024 * 1024, ttl_seconds=300,
+                 max_user_vectors=1000, corpus_version=None, clock=time.monotonic):
+        """
+        Initialize the tier.
+
+        Args:
+            backing: The VectorStore holding the data.
+            dimension: Length of the vectors.
+            max_bytes: Memory budget for all loaded users together.
+            ttl_seconds: How long a loaded user is served before it is reloaded.
+            max_user_vectors: Users with at least this many records are not loaded.
+            corpus_version: Optional function returning a user's current corpus
+                version, bumped after every write to their vectors.
+            clock: Monotonic time source, injectable for tests.
+        """
+        self.backing = backing
+        self.dimension = dimension
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_user_vectors = max_user_vectors
+        self.corpus_version = corpus_version
+        self._clock = clock
+
+        self._users = OrderedDict()  # user_id -> _UserVectors, least recently used first
+        self._user_of_id = {}  # vector_id -> user_id, for loaded users
+        self._bytes = 0
+        self._oversized = {}  # user_id -> time it was found too large to load
+        self._loads_in_flight = {}  # user_id -> {"changed": bool, "deleted": set of IDs}
+        self._lock = threading.Lock()
+        self._loads = SingleFlight()
+
+        self.hits = 0
+        self.loads = 0
+        self.bypasses = 0
+        self.evictions = 0
+        self.discarded_loads = 0
+        self.stale_drops = 0
+
+    def _current_version(self, user_id):
+        return self.corpus_version(user_id) if self.corpus_version is not None else None
+
+    def _loaded(self, user_id, version=None):
+        """
+        The cached records of user_id, or None if they are missing, expired or older
+        than corpus version version. Holds the lock.
+        """
+        entry = self._users.get(user_id)
+        if entry is not None and (self._clock() - entry.loaded_at > self.ttl_seconds
+                                  or entry.corpus_version != version):
+            if entry.corpus_version != version:
+                self.stale_drops += 1
+            self._drop_locked(user_id)
+            entry = None
+        if entry is not None:
+            self._users.move_to_end(user_id)
+        return entry
+
+    def _drop_locked(self, user_id):
+        entry = self._users.pop(user_id)
+        self._bytes -= entry.nbytes()
+        for vector_id in entry.ids:
+            self._user_of_id.pop(vector_id, None)
+
+    def _load(self, user_id):
+        """Load user_id's records from the backing store; returns the entry or None."""
+        with self._lock:
+            watch = self._loads_in_flight[user_id] = {"changed": False, "deleted": set()}
+        try:
+            # Read before listing: a write after this point moves the version on
+            version = self._current_version(user_id)
+            records = self.backing.list_by_user(user_id, include_values=True)
+        finally:
+            with self._lock:
+                del self._loads_in_flight[user_id]
+
+        with self._lock:
+            self.loads += 1
+            if len(records) >= self.max_user_vectors:
+                self._oversized[user_id] = self._clock()
+                return None
+            if watch["changed"]:
+                self.discarded_loads += 1
+                return None
+            records = [record for record in records if record["id"] not in watch["deleted"]]
+
+            entry = _UserVectors(records, self.dimension)
+            entry.loaded_at = self._clock()
+            entry.corpus_version = version
+            if user_id in self._users:
+                self._drop_locked(user_id)
+            self._users[user_id] = entry
+            self._bytes += entry.nbytes()
+            for vector_id in entry.ids:
+                self._user_of_id[vector_id] = user_id
+
+            while self._bytes > self.max_bytes and self._users:
+                evicted_user = next(iter(self._users))
+                self._drop_locked(evicted_user)
+                self.evictions += 1
+            return self._users.get(user_id)
+
+    def _user_entry(self, user_id):
+        """The loaded records of user_id, loading them if needed; None to use the backing store."""
+        version = self._current_version(user_id)
+        with self._lock:
+            entry = self._loaded(user_id, version)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            found_oversized_at = self._oversized.get(user_id)
+            if found_oversized_at is not None and self._clock() - found_oversized_at <= self.ttl_seconds:
+                self.bypasses += 1
+                return None
+
+        try:
+            self._loads.do(user_id, lambda: self._load(user_id))
+        except Exception as e:
+            print(f"[HOT TIER] Could not load vectors for {user_id}: {e}")
+            return None
+        with self._lock:
+            return self._loaded(user_id, version)
+
+    def query(self, vector, top_k, filter=None, include_metadata=True, include_values=False):
+        user_id = filter_user_id(filter)
+        entry = self._user_entry(user_id) if user_id is not None else None
+        if entry is None:
+            if user_id is None:
+                with self._lock:
+                    self.bypasses += 1
+            return self.backing.query(vector, top_k, filter=filter, include_metadata=include_metadata,
+                                      include_values=include_values)
+
+        query_vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            rows = [row for row in range(entry.size) if matches_filter(entry.metadata[row], filter)]
+            values = entry.vectors[rows]
+            norms = entry.norms[rows] * np.linalg.norm(query_vector)
+            ids = [entry.ids[row] for row in rows]
+            metadata = [entry.metadata[row] for row in rows]
+
+        if not rows:
+            return {"matches": []}
+        scores = np.divide(values @ query_vector, norms, out=np.zeros(len(rows), dtype=np.float32), where=norms > 0)
+        if top_k < len(scores):
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            order = top[np.argsort(-scores[top], kind="stable")]
+        else:
+            order = np.argsort(-scores, kind="stable")
+
+        matches = []
+        for position in order:
+            match = {"id": ids[position], "score": float(scores[position])}
+            if include_metadata:
+                match["metadata"] = dict(metadata[position])
+            if include_values:
+                match["values"] = values[position].tolist()
+            matches.append(match)
+        return {"matches": matches}
+
+    def upsert(self, vectors):
+        vectors = list(vectors)
+        self.backing.upsert(vectors)
+        with self._lock:
+            for vector_id, values, metadata in vectors:
+                user_id = (metadata or {}).get("user_id")
+                previous_user = self._user_of_id.get(vector_id)
+                self._mark_changed_locked(user_id)
+                self._mark_changed_locked(previous_user)
+                if previous_user is not None and previous_user != user_id:
+                    self._change_locked(previous_user, lambda entry: entry.remove(vector_id))
+                    del self._user_of_id[vector_id]
+                if user_id in self._users:
+                    self._change_locked(user_id, lambda entry: entry.put(vector_id, values, metadata))
+                    self._user_of_id[vector_id] = user_id
+                self._oversized.pop(user_id, None)
+
+    def delete(self, ids):
+        ids = list(ids)
+        self.backing.delete(ids)
+        with self._lock:
+            for vector_id in ids:
+                user_id = self._user_of_id.pop(vector_id, None)
+                if user_id is not None:
+                    self._change_locked(user_id, lambda entry: entry.remove(vector_id))
+                # The owner of an ID that isn't loaded is unknown, so every load in
+                # flight leaves it out in case its snapshot still has it
+                for watch in self._loads_in_flight.values():
+                    watch["deleted"].add(vector_id)
+
+    def _mark_changed_locked(self, user_id):
+        """Discard a load of user_id that is in flight, since its snapshot may miss a write."""
+        watch = self._loads_in_flight.get(user_id)
+        if watch is not None:
+            watch["changed"] = True
+
+    def _change_locked(self, user_id, change):
+        """Apply change to a loaded user's records, keeping the byte count current."""
+        entry = self._users[user_id]
+        self._bytes -= entry.nbytes()
+        change(entry)
+        self._bytes += entry.nbytes()
+
+    def fetch(self, ids):
+        return self.backing.fetch(ids)
+
+    def list_by_user(self, user_id, filter=None, include_values=False):
+        # Listings feed cleanup and deletion, so they always see the backing store
+        return self.backing.list_by_user(user_id, filter=filter, include_values=include_values)
+
+    def iter_ids(self, prefix, page_size=100):
+        return self.backing.iter_ids(prefix, page_size=page_size)
+
+    def describe(self):
+        return self.backing.describe()
+
+    def stats(self):
+        """Return hit/load counters and memory use."""
+        with self._lock:
+            lookups = self.hits + self.loads
+            return {
+                "hits": self.hits,
+                "loads": self.loads,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "bypasses": self.bypasses,
+                "evictions": self.evictions,
+                "discarded_loads": self.discarded_loads,
+                "stale_drops": self.stale_drops,
+                "users": len(self._users),
+                "vectors": len(self._user_of_id),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes
+            }
@@ -0,0 +1,213 @@
+import json
+import sqlite3
+import threading
+
+from utils.single_flight import SingleFlight
+from utils.vector_store import VectorStore, matches_filter
+
+# Metadata fields copied into the manifest; everything cleanup and deletion select on
+MANIFEST_FIELDS = ("user_id", "type", "platform", "content_type", "unique_id", "source", "pdf_filename", "parent_id")
+
+class SqliteVectorManifest:
+    """
+    The IDs of every user's vectors with a few selection fields, in a SQLite table.
+
+    Lets cleanup and deletion find a user's vectors by paging through a local index
+    instead of downloading the full metadata of every vector from the vector store.
+    A user's entries are only trusted once the user is marked built, meaning the
+    entries written before the manifest existed were imported.
+    """
+
+    def __init__(self, path=":memory:", timeout=10):
+        """
+        Initialize the manifest, creating the database file and tables if needed.
+
+        Args:
+            path: Path of the SQLite database file; ":memory:" keeps it in process.
+            timeout: Seconds to wait for another process's write to finish.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            "id TEXT PRIMARY KEY, user_id TEXT NOT NULL, fields TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS manifest_by_user ON manifest (user_id, id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS manifest_users (user_id TEXT PRIMARY KEY)")
+
+    @staticmethod
+    def fields(metadata):
+        """The manifest fields present in a vector's metadata."""
+        return {field: metadata[field] for field in MANIFEST_FIELDS if field in (metadata or {})}
+
+    def record(self, records):
+        """Add or update (id, metadata) pairs; records without a user_id are skipped."""
+        rows = []
+        for vector_id, metadata in records:
+            fields = self.fields(metadata)
+            if fields.get("user_id") is not None:
+                rows.append((vector_id, fields["user_id"], json.dumps(fields, default=str)))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO manifest (id, user_id, fields) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET user_id = excluded.user_id, fields = excluded.fields",
+                rows
+            )
+
+    def remove(self, ids):
+        with self._lock:
+            self._conn.executemany("DELETE FROM manifest WHERE id = ?", [(vector_id,) for vector_id in ids])
+
+    def is_built(self, user_id):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM manifest_users WHERE user_id = ?", (user_id,)
+            ).fetchone() is not None
+
+    def mark_built(self, user_id):
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO manifest_users (user_id) VALUES (?)", (user_id,))
+
+    def pages(self, user_id, filter=None, page_size=1000):
+        """
+        Yield [{"id", "metadata"}] pages of user_id's entries matching filter, in ID
+        order. Pages are read by key, so entries may be deleted between pages.
+        """
+        after = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, fields FROM manifest WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?",
+                    (user_id, after, page_size)
+                ).fetchall()
+            if not rows:
+                return
+            after = rows[-1][0]
+            page = [{"id": vector_id, "metadata": json.loads(fields)} for vector_id, fields in rows]
+            page = [record for record in page if matches_filter(record["metadata"], filter)]
+            if page:
+                yield page
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM manifest").fetchone()[0]
+            users = self._conn.execute("SELECT COUNT(*) FROM manifest_users").fetchone()[0]
+        return {"entries": entries, "built_users": users}
+
+class ManifestVectorStore(VectorStore):
+    """
+    Keeps a SqliteVectorManifest in step with every write to another VectorStore.
+
+    list_by_user and user_pages (without values) are answered from the manifest.
+    The first time a user is listed, the user's existing vectors are imported by
+    paging through their ID prefixes in the backing store and fetching their
+    metadata, so the manifest also covers vectors written before it existed.
+    """
+
+    def __init__(self, backing, manifest, id_prefixes, page_size=100):
+        """
+        Initialize the store.
+
+        Args:
+            backing: The VectorStore holding the data.
+            manifest: The SqliteVectorManifest to maintain.
+            id_prefixes: Function returning the ID prefixes a user's vectors can have.
+            page_size: IDs listed and fetched per request while importing a user.
+        """
+        self.backing = backing
+        self.manifest = manifest
+        self.id_prefixes = id_prefixes
+        self.page_size = page_size
+        self._builds = SingleFlight(timeout=300)
+        self.imported = 0
+
+    def _ensure_built(self, user_id):
+        if not self.manifest.is_built(user_id):
+            self._builds.do(user_id, lambda: self._build(user_id))
+
+    def rebuild(self, user_id):
+        """
+        Import user_id's vectors from the backing store again and drop the entries it
+        no longer has. The manifest only sees writes made through it, so callers that
+        must not miss a vector, such as account deletion, rebuild first.
+        """
+        self._builds.do(("rebuild", user_id), lambda: self._build(user_id, replace=True))
+
+    def _build(self, user_id, replace=False):
+        """Import user_id's existing vectors into the manifest."""
+        if self.manifest.is_built(user_id) and not replace:
+            return
+        previous_ids = {record["id"] for page in self.manifest.pages(user_id) for record in page}
+        imported_ids = set()
+        try:
+            for prefix in self.id_prefixes(user_id):
+                for ids in self.backing.iter_ids(prefix, page_size=self.page_size):
+                    records = self.backing.fetch(ids)
+                    # A prefix can also match another user whose name extends this one
+                    owned = [
+                        (vector_id, record["metadata"]) for vector_id, record in records.items()
+                        if record["metadata"].get("user_id") == user_id
+                    ]
+                    self.manifest.record(owned)
+                    imported_ids.update(vector_id for vector_id, _ in owned)
+        except Exception as e:
+            # ID listing is unsupported (e.g. pod-based Pinecone indexes) or failed;
+            # fall back to the backing store's metadata listing
+            print(f"[MANIFEST] Listing IDs for {user_id} failed ({e}), using a metadata listing")
+            owned = [(record["id"], record["metadata"]) for record in self.backing.list_by_user(user_id)]
+            self.manifest.record(owned)
+            imported_ids = {vector_id for vector_id, _ in owned}
+        # Entries the listing did not return are dropped once the backing store
+        # confirms they are gone or belong to someone else (their IDs may not
+        # carry the user's prefix)
+        unlisted = sorted(previous_ids - imported_ids)
+        for start in range(0, len(unlisted), self.page_size):
+            batch = unlisted[start:start + self.page_size]
+            records = self.backing.fetch(batch)
+            self.manifest.remove(
+                vector_id for vector_id in batch
+                if records.get(vector_id, {}).get("metadata", {}).get("user_id") != user_id
+            )
+        self.manifest.mark_built(user_id)
+        self.imported += len(imported_ids)
+        print(f"[MANIFEST] Imported {len(imported_ids)} existing vectors for {user_id}")
+
+    def upsert(self, vectors):
+        vectors = list(vectors)
+        self.backing.upsert(vectors)
+        self.manifest.record((vector_id, metadata) for vector_id, _, metadata in vectors)
+
+    def delete(self, ids):
+        ids = list(ids)
+        self.backing.delete(ids)
+        self.manifest.remove(ids)
+
+    def query(self, vector, top_k, filter=None, include_metadata=True, include_values=False):
+        return self.backing.query(vector, top_k, filter=filter, include_metadata=include_metadata,
+                                  include_values=include_values)
+
+    def fetch(self, ids):
+        return self.backing.fetch(ids)
+
+    def list_by_user(self, user_id, filter=None, include_values=False):
+        if include_values:
+            return self.backing.list_by_user(user_id, filter=filter, include_values=True)
+        return [record for page in self.user_pages(user_id, filter=filter) for record in page]
+
+    def user_pages(self, user_id, filter=None, page_size=1000):
+        self._ensure_built(user_id)
+        return self.manifest.pages(user_id, filter=filter, page_size=page_size)
+
+    def iter_ids(self, prefix, page_size=100):
+        return self.backing.iter_ids(prefix, page_size=page_size)
+
+    def describe(self):
+        return self.backing.describe()
+
+    def stats(self):
+        stats = self.manifest.stats()
+        stats["imported"] = self.imported
+        return stats
@@ -0,0 +1,433 @@
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+# Pinecone caps top_k at 10000, which also bounds a metadata-only listing, and
+# at 1000 when the vector values are returned
+LIST_TOP_K = 10000
+LIST_WITH_VALUES_TOP_K = 1000
+
+def _compare(stored, operator, expected):
+    """Evaluate one Pinecone filter operator against a stored metadata value."""
+    if operator == "$eq":
+        return expected in stored if isinstance(stored, list) else stored == expected
+    if operator == "$ne":
+        return expected not in stored if isinstance(stored, list) else stored != expected
+    if operator == "$in":
+        if isinstance(stored, list):
+            return any(value in expected for value in stored)
+        return stored in expected
+    if operator == "$nin":
+        if isinstance(stored, list):
+            return not any(value in expected for value in stored)
+        return stored not in expected
+    if operator in ("$gt", "$gte", "$lt", "$lte"):
+        if stored is None or isinstance(stored, (bool, str, list)):
+            return False
+        try:
+            stored = float(stored)
+        except (TypeError, ValueError):
+            return False
+        if operator == "$gt":
+            return stored > expected
+        if operator == "$gte":
+            return stored >= expected
+        if operator == "$lt":
+            return stored < expected
+        return stored <= expected
+    raise ValueError(f"Unsupported filter operator: {operator}")
+
+def matches_filter(metadata, filter):
+    """
+    Whether metadata satisfies a Pinecone-style metadata filter.
+
+    Supports plain equality ({"user_id": "alice"}), the $eq, $ne, $in, $nin, $gt,
+    $gte, $lt and $lte operators, and $and/$or. As in Pinecone, a list value
+    matches $eq/$in when any of its elements does.
+    """
+    for key, condition in (filter or {}).items():
+        if key == "$and":
+            if not all(matches_filter(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            if key not in metadata and not any(operator in ("$ne", "$nin") for operator in condition):
+                return False
+            stored = metadata.get(key)
+            if not all(_compare(stored, operator, expected) for operator, expected in condition.items()):
+                return False
+        elif not _compare(metadata.get(key), "$eq", condition):
+            return False
+    return True
+
+def filter_user_id(filter):
+    """The single user_id a filter is restricted to, or None."""
+    user_id = (filter or {}).get("user_id")
+    if isinstance(user_id, dict):
+        user_id = user_id.get("$eq") if set(user_id) == {"$eq"} else None
+    return user_id
+
+def _field(obj, name, default=None):
+    """Read a field from a Pinecone response object or a plain dict."""
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+class VectorStore:
+    """
+    Storage for (id, vector, metadata) records, queried by cosine similarity.
+
+    Results are plain Python structures so callers do not depend on a backend:
+    query returns {"matches": [{"id", "score", "metadata", "values"}]} sorted by
+    score, fetch returns {id: {"id", "values", "metadata"}} for the IDs that exist.
+    Filters use Pinecone's metadata filter syntax (see matches_filter).
+    """
+
+    def upsert(self, vectors):
+        """Insert or replace (id, values, metadata) tuples."""
+        raise NotImplementedError
+
+    def query(self, vector, top_k, filter=None, include_metadata=True, include_values=False):
+        """Return the top_k records most similar to vector that match filter."""
+        raise NotImplementedError
+
+    def fetch(self, ids):
+        """Return the stored records for ids."""
+        raise NotImplementedError
+
+    def delete(self, ids):
+        """Delete the records with the given IDs; unknown IDs are ignored."""
+        raise NotImplementedError
+
+    def list_by_user(self, user_id, filter=None, include_values=False):
+        """
+        Return [{"id", "metadata"}] for every record of user_id that matches filter,
+        with "values" too when include_values is set.
+        """
+        raise NotImplementedError
+
+    def user_pages(self, user_id, filter=None, page_size=1000):
+        """
+        Yield the records of list_by_user (without values) in pages of at most
+        page_size, so callers can work through a large account in bounded steps.
+        """
+        records = self.list_by_user(user_id, filter=filter)
+        for start in range(0, len(records), page_size):
+            yield records[start:start + page_size]
+
+    def iter_ids(self, prefix, page_size=100):
+        """Yield pages of the IDs that start with prefix."""
+        raise NotImplementedError
+
+    def describe(self):
+        """Return a small summary of the store; also used as a connectivity check."""
+        raise NotImplementedError
+
+class PineconeVectorStore(VectorStore):
+    """VectorStore backed by a Pinecone index."""
+
+    def __init__(self, index, dimension=768):
+        """
+        Initialize the store.
+
+        Args:
+            index: A connected pinecone Index.
+            dimension: Length of the index's vectors.
+        """
+        self.index = index
+        self.dimension = dimension
+
+    def upsert(self, vectors):
+        if vectors:
+            self.index.upsert(vectors=list(vectors))
+
+    def query(self, vector, top_k, filter=None, include_metadata=True, include_values=False):
+        response = self.index.query(vector=vector, top_k=top_k, filter=filter,
+                                    include_metadata=include_metadata, include_values=include_values)
+        matches = []
+        for match in _field(response, "matches") or []:
+            result = {"id": _field(match, "id"), "score": _field(match, "score")}
+            if include_metadata:
+                result["metadata"] = _field(match, "metadata") or {}
+            if include_values:
+                result["values"] = list(_field(match, "values") or [])
+            matches.append(result)
+        return {"matches": matches}
+
+    def fetch(self, ids):
+        if not ids:
+            return {}
+        vectors = _field(self.index.fetch(ids=list(ids)), "vectors") or {}
+        return {
+            vector_id: {
+                "id": vector_id,
+                "values": list(_field(vector, "values") or []),
+                "metadata": _field(vector, "metadata") or {}
+            }
+            for vector_id, vector in vectors.items()
+        }
+
+    def delete(self, ids):
+        if ids:
+            self.index.delete(ids=list(ids))
+
+    def list_by_user(self, user_id, filter=None, include_values=False):
+        # Pinecone has no filtered listing, so this is a metadata-only query
+        user_filter = dict(filter or {})
+        user_filter["user_id"] = user_id
+        top_k = LIST_WITH_VALUES_TOP_K if include_values else LIST_TOP_K
+        response = self.query([0] * self.dimension, top_k, filter=user_filter, include_values=include_values)
+        return [
+            {key: match[key] for key in ("id", "metadata", "values") if key in match}
+            for match in response["matches"]
+        ]
+
+    def iter_ids(self, prefix, page_size=100):
+        # Paginated ID listing, available on serverless indexes
+        prefix_filter = {"prefix": prefix} if prefix else {}
+        for ids in self.index.list(limit=page_size, **prefix_filter):
+            yield list(ids)
+
+    def describe(self):
+        stats = self.index.describe_index_stats()
+        return {"backend": "pinecone", "vectors": _field(stats, "total_vector_count")}
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process VectorStore: vectors in a float32 matrix, metadata in a SQLite table.
+
+    With a path the matrix is a memory-mapped file (vectors.f32) next to the table
+    (metadata.sqlite3), so the data survives restarts and the OS pages vectors in
+    on demand; without one everything lives in memory, which suits tests.
+
+    Queries are exact: the rows of the filtered records are scored with one
+    matrix-vector product. A per-user row index keeps user-scoped queries from
+    touching other users' records. Meant for a single process (small deployments,
+    tests, benchmarks, or as a cache tier in front of another store).
+    """
+
+    VECTORS_FILE = "vectors.f32"
+    METADATA_FILE = "metadata.sqlite3"
+
+    def __init__(self, path=None, dimension=768, initial_capacity=1024):
+        """
+        Initialize the store, loading existing data from path.
+
+        Args:
+            path: Directory holding the vector and metadata files, or None to keep
+                everything in memory.
+            dimension: Length of the vectors.
+            initial_capacity: Rows allocated up front; the matrix doubles when full.
+        """
+        self.path = path
+        self.dimension = dimension
+        self._lock = threading.RLock()
+
+        self._ids = []  # row -> id (None for a free row)
+        self._metadata = []  # row -> metadata dict
+        self._row_of = {}  # id -> row
+        self._rows_by_user = {}  # user_id -> set of rows
+        self._free_rows = []
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._vectors_path = os.path.join(path, self.VECTORS_FILE)
+            self._db = sqlite3.connect(os.path.join(path, self.METADATA_FILE), check_same_thread=False)
+        else:
+            self._vectors_path = None
+            self._db = sqlite3.connect(":memory:", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            "id TEXT PRIMARY KEY, row INTEGER NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self._db.commit()
+
+        self._vectors = self._open_matrix(initial_capacity)
+        self._norms = np.linalg.norm(self._vectors, axis=1)
+        self._load()
+
+    def _open_matrix(self, capacity):
+        """Open (or allocate) the vector matrix with at least capacity rows."""
+        if self._vectors_path is None:
+            return np.zeros((capacity, self.dimension), dtype=np.float32)
+
+        row_bytes = self.dimension * 4
+        existing_rows = os.path.getsize(self._vectors_path) // row_bytes if os.path.exists(self._vectors_path) else 0
+        capacity = max(capacity, existing_rows)
+        with open(self._vectors_path, "ab") as f:
+            f.truncate(capacity * row_bytes)
+        return np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dimension))
+
+    def _load(self):
+        rows = self._db.execute("SELECT id, row, metadata FROM vectors").fetchall()
+        used = max((row for _, row, _ in rows), default=-1) + 1
+        self._ids = [None] * used
+        self._metadata = [None] * used
+        for vector_id, row, metadata in rows:
+            self._place(vector_id, row, json.loads(metadata))
+        self._free_rows = [row for row in range(used) if self._ids[row] is None]
+
+    def _place(self, vector_id, row, metadata):
+        self._ids[row] = vector_id
+        self._metadata[row] = metadata
+        self._row_of[vector_id] = row
+        self._rows_by_user.setdefault(metadata.get("user_id"), set()).add(row)
+
+    def _unplace(self, row):
+        vector_id = self._ids[row]
+        user_rows = self._rows_by_user.get(self._metadata[row].get("user_id"))
+        if user_rows is not None:
+            user_rows.discard(row)
+            if not user_rows:
+                del self._rows_by_user[self._metadata[row].get("user_id")]
+        del self._row_of[vector_id]
+        self._ids[row] = None
+        self._metadata[row] = None
+
+    def _allocate_row(self):
+        if self._free_rows:
+            return self._free_rows.pop()
+        row = len(self._ids)
+        if row >= len(self._vectors):
+            self._grow(len(self._vectors) * 2)
+        self._ids.append(None)
+        self._metadata.append(None)
+        return row
+
+    def _grow(self, capacity):
+        if self._vectors_path is None:
+            vectors = np.zeros((capacity, self.dimension), dtype=np.float32)
+            vectors[:len(self._vectors)] = self._vectors
+        else:
+            self._vectors.flush()
+            del self._vectors
+            vectors = self._open_matrix(capacity)
+        norms = np.zeros(capacity, dtype=np.float32)
+        norms[:len(self._norms)] = self._norms
+        self._vectors = vectors
+        self._norms = norms
+
+    def _candidate_rows(self, filter):
+        """Rows that may match filter, narrowed by the per-user index when possible."""
+        user_id = filter_user_id(filter)
+        if user_id is not None:
+            rows = self._rows_by_user.get(user_id, ())
+        else:
+            rows = self._row_of.values()
+        return [row for row in rows if matches_filter(self._metadata[row], filter)]
+
+    def upsert(self, vectors):
+        records = []
+        with self._lock:
+            for vector_id, values, metadata in vectors:
+                values = np.asarray(values, dtype=np.float32)
+                if values.shape != (self.dimension,):
+                    raise ValueError(f"Vector {vector_id} has shape {values.shape}, expected ({self.dimension},)")
+                row = self._row_of.get(vector_id)
+                if row is None:
+                    row = self._allocate_row()
+                else:
+                    self._unplace(row)
+                metadata = dict(metadata or {})
+                self._vectors[row] = values
+                self._norms[row] = np.linalg.norm(values)
+                self._place(vector_id, row, metadata)
+                records.append((vector_id, row, json.dumps(metadata, default=str)))
+
+            if self._vectors_path is not None:
+                self._vectors.flush()
+            self._db.executemany("INSERT OR REPLACE INTO vectors (id, row, metadata) VALUES (?, ?, ?)", records)
+            self._db.commit()
+
+    def query(self, vector, top_k, filter=None, include_metadata=True, include_values=False):
+        query_vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            rows = np.asarray(self._candidate_rows(filter), dtype=np.int64)
+            if len(rows) == 0:
+                return {"matches": []}
+            values = self._vectors[rows]
+            norms = self._norms[rows] * np.linalg.norm(query_vector)
+            ids = [self._ids[row] for row in rows]
+            metadata = [self._metadata[row] for row in rows]
+
+        scores = np.divide(values @ query_vector, norms, out=np.zeros(len(rows), dtype=np.float32), where=norms > 0)
+        if top_k < len(scores):
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            order = top[np.argsort(-scores[top], kind="stable")]
+        else:
+            order = np.argsort(-scores, kind="stable")
+
+        matches = []
+        for position in order:
+            match = {"id": ids[position], "score": float(scores[position])}
+            if include_metadata:
+                match["metadata"] = dict(metadata[position])
+            if include_values:
+                match["values"] = values[position].tolist()
+            matches.append(match)
+        return {"matches": matches}
+
+    def fetch(self, ids):
+        with self._lock:
+            return {
+                vector_id: {
+                    "id": vector_id,
+                    "values": self._vectors[self._row_of[vector_id]].tolist(),
+                    "metadata": dict(self._metadata[self._row_of[vector_id]])
+                }
+                for vector_id in ids if vector_id in self._row_of
+            }
+
+    def delete(self, ids):
+        with self._lock:
+            deleted = []
+            for vector_id in ids:
+                row = self._row_of.get(vector_id)
+                if row is None:
+                    continue
+                self._unplace(row)
+                self._norms[row] = 0
+                self._free_rows.append(row)
+                deleted.append((vector_id,))
+            if deleted:
+                self._db.executemany("DELETE FROM vectors WHERE id = ?", deleted)
+                self._db.commit()
+
+    def list_by_user(self, user_id, filter=None, include_values=False):
+        user_filter = dict(filter or {})
+        user_filter["user_id"] = user_id
+        records = []
+        with self._lock:
+            for row in sorted(self._candidate_rows(user_filter)):
+                record = {"id": self._ids[row], "metadata": dict(self._metadata[row])}
+                if include_values:
+                    record["values"] = self._vectors[row].tolist()
+                records.append(record)
+        return records
+
+    def iter_ids(self, prefix, page_size=100):
+        with self._lock:
+            ids = sorted(vector_id for vector_id in self._row_of if vector_id.startswith(prefix))
+        for start in range(0, len(ids), page_size):
+            yield ids[start:start + page_size]
+
+    def describe(self):
+        with self._lock:
+            return {
+                "backend": "local",
+                "vectors": len(self._row_of),
+                "users": len(self._rows_by_user),
+                "capacity": len(self._vectors)
+            }
+
+    def close(self):
+        """Flush the vector file and close the metadata table."""
+        with self._lock:
+            if self._vectors_path is not None:
+                self._vectors.flush()
+            self._db.close()
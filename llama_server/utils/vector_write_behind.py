@@ -0,0 +1,418 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+from utils.vector_store import VectorStore, filter_user_id
+
+# Upper bounds of the flushed batch size histogram reported by stats()
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100)
+
+# Records that could not be written, kept for inspection through dead_letters()
+DEAD_LETTER_HISTORY = 100
+
+# IDs of dead-lettered records remembered so a flush can report them to the writer
+FAILED_ID_HISTORY = 10000
+
+def record_bytes(record):
+    """Approximate request payload of an (id, values, metadata) record: its text plus float32 values."""
+    return len(str((record[2] or {}).get("text", "")).encode("utf-8")) + len(record[1]) * 4
+
+def is_retryable_error(error):
+    """
+    Whether a failed upsert may succeed when sent again: throttling, server errors
+    and network failures. Other client errors (a wrong dimension, oversized
+    metadata) fail the same way every time.
+    """
+    status = getattr(error, "status", None) or getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    return not isinstance(error, (ValueError, TypeError, KeyError))
+
+class _Pending:
+    """A buffered upsert with what the flusher and read-your-writes checks need."""
+
+    __slots__ = ("record", "user_id", "nbytes", "queued_at", "attempts", "retry_at")
+
+    def __init__(self, record, queued_at):
+        self.record = record
+        self.user_id = (record[2] or {}).get("user_id")
+        self.nbytes = record_bytes(record)
+        self.queued_at = queued_at
+        self.attempts = 0
+        self.retry_at = 0.0
+
+class WriteBehindVectorStore(VectorStore):
+    """
+    Buffers upserts in front of a remote store and writes them out in bulk.
+
+    upsert only queues the records and returns. A background thread sends the
+    buffer to the backing store as one request once it holds max_batch records or
+    max_batch_bytes of payload, or once the oldest record has waited max_delay
+    seconds, so concurrent single-vector writes share round trips. A record written
+    again before it is flushed is sent once, with its latest values.
+
+    Reads keep read-your-writes: a query, fetch or listing first flushes the
+    buffered records it could see (the user's, for user-scoped queries) and waits
+    for a flush that is in flight. Deletes drop matching buffered records. Backing
+    writes are serialized, so an older version of a record never lands after a
+    newer one.
+
+    A batch the backing store rejects as invalid is split until the offending
+    records are isolated; those are dead-lettered and the rest is written. Records
+    that fail for a transient reason go to the back of the buffer and are retried
+    with exponential backoff, max_retries times before they are dead-lettered too,
+    so one bad record never holds up other users' writes. Once max_pending records
+    are buffered, upsert flushes synchronously and raises if that fails. close()
+    flushes everything that is left and is meant to run at shutdown.
+    """
+
+    def __init__(self, backing, max_batch=100, max_batch_bytes=1_500_000, max_delay=0.05,
+                 max_pending=2000, retry_delay=1.0, max_retries=5):
+        """
+        Initialize the buffer and start its flusher thread.
+
+        Args:
+            backing: The VectorStore the records are written to.
+            max_batch: Most records sent in one upsert request.
+            max_batch_bytes: Most payload bytes sent in one upsert request.
+            max_delay: Seconds a record may wait before the buffer is flushed.
+            max_pending: Buffered records at which upsert flushes synchronously.
+            retry_delay: Seconds before a failed record is retried; doubles with every retry.
+            max_retries: Retries of a transiently failing record before it is dead-lettered.
+        """
+        self.backing = backing
+        self.max_batch = max_batch
+        self.max_batch_bytes = max_batch_bytes
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+
+        self._pending = OrderedDict()  # vector_id -> _Pending, oldest first
+        self._pending_bytes = 0
+        self._in_flight = {}  # vector_id -> _Pending, for the batch being written
+        self._dead_letters = deque(maxlen=DEAD_LETTER_HISTORY)
+        self._failed = OrderedDict()  # vector_id -> error of its last dead-lettered write
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()  # Serializes writes to the backing store
+
+        self.upserts = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.flushed_records = 0
+        self.max_batch_size = 0
+        self.batch_sizes = {bucket: 0 for bucket in BATCH_SIZE_BUCKETS + (None,)}
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.flush_errors = 0
+        self.retried_records = 0
+        self.dead_lettered = 0
+        self.read_flushes = 0
+        self.sync_flushes = 0
+
+        self._thread = threading.Thread(target=self._flush_loop, name="vector-write-behind", daemon=True)
+        self._thread.start()
+
+    def upsert(self, vectors):
+        vectors = list(vectors)
+        with self._lock:
+            if self._closed:
+                write_through = True
+            else:
+                write_through = False
+                now = time.monotonic()
+                self.upserts += 1
+                for record in vectors:
+                    self._failed.pop(record[0], None)
+                    entry = _Pending(record, now)
+                    previous = self._pending.get(record[0])
+                    if previous is not None:
+                        # Keep the original position so the record's deadline still holds
+                        entry.queued_at = previous.queued_at
+                        self._pending_bytes -= previous.nbytes
+                        self.coalesced += 1
+                    self._pending[record[0]] = entry
+                    self._pending_bytes += entry.nbytes
+                over_limit = len(self._pending) >= self.max_pending
+                self._wakeup.notify()
+
+        if write_through:
+            self.backing.upsert(vectors)
+        elif over_limit:
+            with self._lock:
+                self.sync_flushes += 1
+            self._flush_matching(None)
+
+    def flush(self, user_id=None, matches=None):
+        """
+        Write out buffered records now and wait for them.
+
+        Args:
+            user_id: Only wait for this user's records.
+            matches: Only wait for records whose vector ID this predicate accepts.
+                Raises if one of them was not written, including when a concurrent
+                flush gave up on it.
+        """
+        if user_id is None and matches is None:
+            selects = None
+        else:
+            def selects(entry_id, entry):
+                return (user_id is None or entry.user_id == user_id) and (matches is None or matches(entry_id))
+        self._flush_matching(selects)
+
+        if matches is not None:
+            with self._lock:
+                errors = [error for vector_id, error in self._failed.items() if matches(vector_id)]
+            if errors:
+                raise errors[0]
+
+    def _flush_before_read(self, selects):
+        """Flush what a read could see; cheap when none of it is buffered or in flight."""
+        with self._lock:
+            needed = any(
+                selects is None or selects(entry_id, entry)
+                for entries in (self._pending, self._in_flight)
+                for entry_id, entry in entries.items()
+            )
+            if needed:
+                self.read_flushes += 1
+        if needed:
+            self._flush_matching(selects)
+
+    def _flush_matching(self, selects):
+        """
+        Write every buffered record accepted by selects (all if None), including ones
+        backing off after a failure; other buffered records fill up the same requests.
+        Raises the first error of a selected record that was not written.
+        """
+        failures = []
+        tried = set()
+        with self._flush_lock:
+            while True:
+                batch = self._take(
+                    lambda entry_id, entry: entry_id not in tried and (selects is None or selects(entry_id, entry)),
+                    fill=True
+                )
+                if not batch:
+                    break
+                tried.update(entry.record[0] for entry in batch)
+                failures.extend(
+                    (entry, error) for entry, error in self._write_batch(batch)
+                    if selects is None or selects(entry.record[0], entry)
+                )
+        if failures:
+            raise failures[0][1]
+
+    def _take(self, selects, ready_only=False, fill=False):
+        """
+        Move the oldest records accepted by selects, up to one request's worth, from the
+        buffer to in flight. With fill set, other records that are due take up the
+        room the selected ones leave.
+        """
+        with self._lock:
+            now = time.monotonic()
+            chosen = [
+                entry for entry_id, entry in self._pending.items()
+                if (not ready_only or entry.retry_at <= now) and (selects is None or selects(entry_id, entry))
+            ]
+            if chosen and fill and selects is not None:
+                chosen_ids = {id(entry) for entry in chosen}
+                chosen.extend(
+                    entry for entry in self._pending.values()
+                    if entry.retry_at <= now and id(entry) not in chosen_ids
+                )
+
+            batch = []
+            batch_bytes = 0
+            for entry in chosen:
+                if batch and (len(batch) >= self.max_batch or batch_bytes + entry.nbytes > self.max_batch_bytes):
+                    break
+                batch.append(entry)
+                batch_bytes += entry.nbytes
+            for entry in batch:
+                del self._pending[entry.record[0]]
+                self._in_flight[entry.record[0]] = entry
+            self._pending_bytes -= batch_bytes
+            return batch
+
+    def _write_batch(self, batch):
+        """Write a batch taken from the buffer and settle its failures. Holds the flush lock."""
+        failures = self._write(batch)
+        with self._lock:
+            now = time.monotonic()
+            for entry, error in failures:
+                entry_id = entry.record[0]
+                entry.attempts += 1
+                if not is_retryable_error(error) or entry.attempts > self.max_retries:
+                    if entry_id not in self._pending:
+                        self._failed[entry_id] = error
+                        while len(self._failed) > FAILED_ID_HISTORY:
+                            self._failed.popitem(last=False)
+                    self._dead_letter_locked(entry, error)
+                elif entry_id not in self._pending:
+                    # Retried from the back of the buffer, behind everyone else's writes
+                    entry.retry_at = now + self.retry_delay * 2 ** (entry.attempts - 1)
+                    self._pending[entry_id] = entry
+                    self._pending_bytes += entry.nbytes
+                    self.retried_records += 1
+                # Otherwise the record was written again meanwhile and the newer version wins
+            self._in_flight.clear()
+        return failures
+
+    def _dead_letter_locked(self, entry, error):
+        self.dead_lettered += 1
+        self._dead_letters.append({
+            "id": entry.record[0],
+            "user_id": entry.user_id,
+            "attempts": entry.attempts,
+            "error": str(error)
+        })
+        print(f"[WRITE BEHIND] Dropping vector {entry.record[0]} after {entry.attempts} attempts: {error}")
+
+    def _write(self, batch):
+        """
+        Send records to the backing store and return [(entry, error)] for those not
+        written. A batch rejected as invalid is split to find the records at fault.
+        """
+        start = time.monotonic()
+        try:
+            self.backing.upsert([entry.record for entry in batch])
+        except Exception as e:
+            with self._lock:
+                self.flush_errors += 1
+            if len(batch) > 1 and not is_retryable_error(e):
+                middle = len(batch) // 2
+                return self._write(batch[:middle]) + self._write(batch[middle:])
+            return [(entry, e) for entry in batch]
+
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.batches += 1
+            self.flushed_records += len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            bucket = next((bound for bound in BATCH_SIZE_BUCKETS if len(batch) <= bound), None)
+            self.batch_sizes[bucket] += 1
+            self.flush_seconds += elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        return []
+
+    def _next_flush_in(self):
+        """Seconds until the buffer is due to be flushed, or None if it is empty. Holds the lock."""
+        now = time.monotonic()
+        ready = [entry for entry in self._pending.values() if entry.retry_at <= now]
+        if len(ready) >= self.max_batch or sum(entry.nbytes for entry in ready) >= self.max_batch_bytes:
+            return 0
+        due = [entry.queued_at + self.max_delay for entry in ready]
+        due.extend(entry.retry_at for entry in self._pending.values() if entry.retry_at > now)
+        return min(due) - now if due else None
+
+    def _flush_loop(self):
+        while True:
+            with self._wakeup:
+                while not self._closed:
+                    wait = self._next_flush_in()
+                    if wait is not None and wait <= 0:
+                        break
+                    self._wakeup.wait(wait)
+                if self._closed:
+                    return
+
+            try:
+                with self._flush_lock:
+                    batch = self._take(None, ready_only=True)
+                    failures = self._write_batch(batch) if batch else []
+                if failures:
+                    print(f"[WRITE BEHIND] {len(failures)} of {len(batch)} vectors were not written: {failures[0][1]}")
+            except Exception as e:
+                print(f"[WRITE BEHIND] Flush failed: {e}")
+
+    def close(self):
+        """Stop the flusher and write out everything still buffered; later upserts write through."""
+        with self._wakeup:
+            if self._closed:
+                return
+            self._closed = True
+            pending = len(self._pending)
+            self._wakeup.notify()
+        self._thread.join(timeout=30)
+        if pending:
+            print(f"[WRITE BEHIND] Flushing {pending} buffered vectors before shutdown")
+        for attempt in range(2):
+            try:
+                self._flush_matching(None)
+                return
+            except Exception as e:
+                print(f"[WRITE BEHIND] Shutdown flush failed (attempt {attempt + 1}): {e}")
+                if attempt == 0:
+                    time.sleep(self.retry_delay)
+        print(f"[WRITE BEHIND] {len(self._pending)} buffered vectors were not written")
+
+    def dead_letters(self):
+        """The most recent records that were given up on, as {"id", "user_id", "attempts", "error"} dicts."""
+        with self._lock:
+            return list(self._dead_letters)
+
+    def query(self, vector, top_k, filter=None, include_metadata=True, include_values=False):
+        user_id = filter_user_id(filter)
+        self._flush_before_read(None if user_id is None else (lambda entry_id, entry: entry.user_id == user_id))
+        return self.backing.query(vector, top_k, filter=filter, include_metadata=include_metadata,
+                                  include_values=include_values)
+
+    def fetch(self, ids):
+        ids = list(ids)
+        wanted = set(ids)
+        self._flush_before_read(lambda entry_id, entry: entry_id in wanted)
+        return self.backing.fetch(ids)
+
+    def delete(self, ids):
+        ids = list(ids)
+        with self._flush_lock:
+            with self._lock:
+                for vector_id in ids:
+                    self._failed.pop(vector_id, None)
+                    entry = self._pending.pop(vector_id, None)
+                    if entry is not None:
+                        self._pending_bytes -= entry.nbytes
+            self.backing.delete(ids)
+
+    def list_by_user(self, user_id, filter=None, include_values=False):
+        self._flush_before_read(lambda entry_id, entry: entry.user_id == user_id)
+        return self.backing.list_by_user(user_id, filter=filter, include_values=include_values)
+
+    def user_pages(self, user_id, filter=None, page_size=1000):
+        self._flush_before_read(lambda entry_id, entry: entry.user_id == user_id)
+        return self.backing.user_pages(user_id, filter=filter, page_size=page_size)
+
+    def iter_ids(self, prefix, page_size=100):
+        self._flush_before_read(lambda entry_id, entry: entry_id.startswith(prefix))
+        return self.backing.iter_ids(prefix, page_size=page_size)
+
+    def describe(self):
+        return self.backing.describe()
+
+    def stats(self):
+        """Return buffer size, batch size and flush latency counters."""
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "pending_bytes": self._pending_bytes,
+                "upserts": self.upserts,
+                "coalesced": self.coalesced,
+                "batches": self.batches,
+                "flushed_records": self.flushed_records,
+                "avg_batch_size": round(self.flushed_records / self.batches, 2) if self.batches else 0.0,
+                "max_batch_size": self.max_batch_size,
+                "batch_sizes": {
+                    (f"<={bound}" if bound is not None else f">{BATCH_SIZE_BUCKETS[-1]}"): count
+                    for bound, count in self.batch_sizes.items()
+                },
+                "avg_flush_ms": round(self.flush_seconds * 1000 / self.batches, 2) if self.batches else 0.0,
+                "max_flush_ms": round(self.max_flush_seconds * 1000, 2),
+                "flush_errors": self.flush_errors,
+                "retried_records": self.retried_records,
+                "dead_lettered": self.dead_lettered,
+                "read_flushes": self.read_flushes,
+                "sync_flushes": self.sync_flushes
+            }
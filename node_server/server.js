@@ -5,6 +5,7 @@ const { body, validationResult } = require('express-validator'); // Input valida
 const xss = require('xss'); // XSS protection
 const path = require("path");
 const fs = require("fs");
+const crypto = require("crypto");
 const pdfParse = require("pdf-parse");  // Import the pdf-parse library
 const axios = require("axios");
 const githubRoutes = require("./src/github");
@@ -702,11 +703,11 @@ app.post("/api/submit", async (req, res) => {
             collectedData.github = githubResponse.data;
             if (githubResponse.data.repositories) {
                 githubResponse.data.repositories.forEach(repo => {
-                    documents.push(`Repository Name: ${repo.name} - Readme.md: ${repo.readme}`);
+                    documents.push({ document: `Repository Name: ${repo.name} - Readme.md: ${repo.readme}`, source: "github" });
                 });
             }
 
-            documents.push(JSON.stringify(githubResponse.data.profile))
+            documents.push({ document: JSON.stringify(githubResponse.data.profile), source: "github" })
 
             combinedText += `GitHub Profile: ${JSON.stringify(collectedData.github)} `;
         }
@@ -719,7 +720,7 @@ app.post("/api/submit", async (req, res) => {
             collectedData.linkedin = linkedinResponse.data.profile;
 
             // Store LinkedIn data in Pinecone
-            documents.push(JSON.stringify(linkedinResponse.data.profile));
+            documents.push({ document: JSON.stringify(linkedinResponse.data.profile), source: "linkedin" });
 
             combinedText += `LinkedIn Profile: ${JSON.stringify(collectedData.linkedin)} `;
         }
@@ -729,7 +730,7 @@ app.post("/api/submit", async (req, res) => {
                 username: data.socialProfiles.twitter.username
             });
             collectedData.twitter = twitterResponse.data;
-            documents.push(JSON.stringify(collectedData.twitter));
+            documents.push({ document: JSON.stringify(collectedData.twitter), source: "twitter" });
         }
 
         if (data.socialProfiles.medium) {
@@ -738,7 +739,7 @@ app.post("/api/submit", async (req, res) => {
             });
             collectedData.medium = mediumResponse.data;
             mediumResponse.data.articles.forEach(article => {
-                documents.push(JSON.stringify(`Medium Aricle \n Title: ${article.title} \n Link: ${article.link} \n Content: ${article.content}`));
+                documents.push({ document: JSON.stringify(`Medium Aricle \n Title: ${article.title} \n Link: ${article.link} \n Content: ${article.content}`), source: "medium" });
             })
         }
         if (data.socialProfiles.reddit) {
@@ -747,18 +748,23 @@ app.post("/api/submit", async (req, res) => {
             });
             collectedData.reddit = redditResponse.data;
             redditResponse.data.posts.forEach(post => {
-                documents.push(JSON.stringify(`Reddit Post \n Title: ${post.title} \n Link: ${post.url} \n Content: ${post.content}`));
+                documents.push({ document: JSON.stringify(`Reddit Post \n Title: ${post.title} \n Link: ${post.url} \n Content: ${post.content}`), source: "reddit" });
             })
         }
 
         if (data.pdfs) {
             collectedData.pdfs = data.pdfs;
             data.pdfs.forEach(pdf => {
-                documents.push(JSON.stringify(`PDF Name: ${pdf.filename} \n PDF Content: ${pdf.text}`));
+                documents.push({
+                    document: JSON.stringify(`PDF Name: ${pdf.filename} \n PDF Content: ${pdf.text}`),
+                    source: "pdf",
+                    pdf_filename: pdf.filename
+                });
             })
 
         }
 
+        let ingestionJobId = null;
         const token = req.headers.authorization?.split(" ")[1];
         if (token) {
             let decoded;
@@ -766,8 +772,19 @@ app.post("/api/submit", async (req, res) => {
                 decoded = jwt.verify(token, JWT_SECRET_KEY);
                 const username = decoded.username;
 
-                for (const doc of documents) {
-                    await axios.post(`${config.llamaServer}/process`, { document: doc, username: username });
+                if (documents.length > 0) {
+                    // Send every collected document in one request so they are embedded as a batch.
+                    // It is ingested in the background. The job key gives the documents stable vector
+                    // IDs, so resubmitting them overwrites instead of storing them twice, and after a
+                    // partially failed job only the documents that failed are processed again.
+                    const jobKey = crypto.createHash('sha256').update(JSON.stringify(documents)).digest('hex');
+                    const ingestion = await axios.post(`${config.llamaServer}/process_batch`, {
+                        documents: documents,
+                        username: username,
+                        async: true,
+                        job_key: jobKey
+                    });
+                    ingestionJobId = ingestion.data.job_id || null;
                 }
 
                 if (data.socialProfiles.github) {
@@ -827,7 +844,8 @@ app.post("/api/submit", async (req, res) => {
 URL: ${imageUrl}
 AI Generated Caption: ${image.caption || ''}
 User Description: ${image.description || ''}`, 
-                                    username: username 
+                                    username: username,
+                                    source: "image"
                                 });
                                 console.log(`Image uploaded and processed: ${imageUrl}`);
                             } catch (processingError) {
@@ -850,7 +868,7 @@ User Description: ${image.description || ''}`,
             return res.status(401).json({ success: false, message: "Unauthorized: No token provided" });
         }
 
-        res.json({ success: true, message: "Data sent successfully" });
+        res.json({ success: true, message: "Data sent successfully", ingestionJobId: ingestionJobId });
 
     } catch (error) {
         console.error("Error in /api/submit:", error); // Log the full error object
@@ -1198,7 +1216,8 @@ app.post('/api/query/:username', apiLimiter, async (req, res) => {
                 success: true,
                 response: response.data.response,
                 memory_confirmation_needed: response.data.memory_confirmation_needed || false,
-                memory_data: response.data.memory_data || null
+                memory_data: response.data.memory_data || null,
+                memory_analysis_id: response.data.memory_analysis_id || null
             };
             
             // Only store chats if user is talking to their own model
@@ -1766,6 +1785,41 @@ app.post('/store_memory', async (req, res) => {
     }
 });
 
+// Proxy route for polling the background memory analysis of an answer. The analysis
+// holds extracted personal data, so only the owner of the model can read it.
+app.get('/memory_analysis/:analysisId', authenticateToken, async (req, res) => {
+    try {
+        const response = await axios.get(`${config.llamaServer}/memory_analysis/${encodeURIComponent(req.params.analysisId)}`, {
+            params: { username: req.user.username }
+        });
+        res.json(response.data);
+    } catch (error) {
+        const status = error.response ? error.response.status : 500;
+        res.status(status).json({
+            success: false,
+            message: "Failed to get memory analysis",
+            error: error.message
+        });
+    }
+});
+
+// Proxy route for polling a background ingestion job started by /api/submit
+app.get('/api/jobs/:jobId', authenticateToken, async (req, res) => {
+    try {
+        const response = await axios.get(`${config.llamaServer}/jobs/${encodeURIComponent(req.params.jobId)}`, {
+            params: { username: req.user.username }
+        });
+        res.json(response.data);
+    } catch (error) {
+        const status = error.response ? error.response.status : 500;
+        res.status(status).json({
+            success: false,
+            message: "Failed to get ingestion job",
+            error: error.message
+        });
+    }
+});
+
 // Add GDPR data access endpoint
 app.get('/api/user/data-export', authenticateToken, async (req, res) => {
     try {